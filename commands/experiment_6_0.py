@@ -40,6 +40,11 @@ baseline_mask_type = "gaussian"
 projection_type = "prediction"
 projection_top_k = 1
 alpha_mask_type = "static"
+# all alpha values of an image in one loop with shared noise. the sweep gives
+# alpha_mask its own pattern, i.e. its "i" below is intentionally replaced and
+# every alpha value is combined with every image of the job instead of being
+# zipped with it (the same tasks for a single image per job)
+alpha_sweep = True
 demo = False
 inconsistency_measure = InconsistencyMeasures.dssim
 stats_log_level = 1 # necessary for dssim
@@ -90,6 +95,7 @@ if __name__ == "__main__":
             min_change=min_change,
             alpha_mask_type=alpha_mask_type,
             alpha_mask_value=alpha_mask_value,
+            alpha_sweep=alpha_sweep,
             projection_type=projection_type,
             projection_top_k=projection_top_k,
             baseline_mask_type=baseline_mask_type,
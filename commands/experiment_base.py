@@ -34,6 +34,8 @@ def _sweeper_cmd(
     method_args = " ".join([f"--{k} {v}" for k, v in kwargs.items()])
     method_args = method_args.replace("--demo False", "--no_demo")
     method_args = method_args.replace("--demo True", "")
+    method_args = method_args.replace("--alpha_sweep True", "--alpha_sweep")
+    method_args = method_args.replace("--alpha_sweep False", "")
 
     logger.debug(f"method_args: {method_args}")
     logger.debug(f"array_process: {array_process}")
@@ -5,10 +5,7 @@ import sys
 
 sys.path.append(os.getcwd())
 from source import driver_helpers, configs
-from source.operations import gather_stats
-from source.inconsistency_measures import measure_inconsistency
-from source import project_manager
-from source.utils import Action
+from source.utils import Action, PhaseTimer
 
 
 parser = argparse.ArgumentParser()
@@ -18,52 +15,104 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logger.getEffectiveLevel())
 
 
+# action specific modules are imported inside each branch to keep
+# light actions (e.g. merge_stats) from loading jax and tensorflow.
 if driver_args.action == Action.gather_stats:
-    iterator = enumerate(action_args.samplers_and_kwargs)
-    for sindex, (sampler, static_kwargs, dynamic_kwargs, meta_kwargs) in iterator:
-        logger.info(f"task {sindex}/{action_args.num_samplers} started.")
-        stats, stats_metadata = gather_stats(sampler, dynamic_kwargs, meta_kwargs)
-        logger.info(
-            f"task {sindex}/{action_args.num_samplers} "
-            f"finsied in {stats_metadata['time_to_compute']:.3f}s "
-            "\nnumber of samples "
-            f"{stats_metadata['batch_index'] * meta_kwargs['batch_size']}",
-        )
-        if driver_args.write_demo:
-            driver_helpers.sample_demo(
-                static_kwargs,
-                dynamic_kwargs,
-                meta_kwargs,
-                stats,
+    from source.operations import gather_group_stats
+    from source import tuning
+
+    iterator = iter(action_args.samplers_and_kwargs)
+    sindex = 0
+    with driver_helpers.profiler_trace(
+        driver_args.profiler_dir, driver_args.profile
+    ), driver_helpers.BackgroundWriter(driver_args.writer_queue_size) as writer:
+        for gindex in range(action_args.num_groups):
+            timer = PhaseTimer()
+            with timer.phase("process_args"):
+                sampler, static_kwargs, dynamic_kwargs, group_meta_kwargs = next(
+                    iterator
+                )
+            if driver_args.tune_batch_size or driver_args.memory_budget:
+                if gindex == 0:
+                    # tasks share the architecture and input shape, the batch
+                    # size is tuned for the first (largest) group as a whole
+                    with timer.phase("tune_batch_size"):
+                        batch_size = driver_helpers.select_batch_size(
+                            driver_args,
+                            sampler,
+                            dynamic_kwargs,
+                            group_meta_kwargs,
+                        )
+                    logger.info(f"tuned batch size {batch_size}")
+                group_meta_kwargs = [
+                    tuning.with_batch_size(meta_kwargs, batch_size)
+                    for meta_kwargs in group_meta_kwargs
+                ]
+            logger.info(
+                f"tasks {sindex}-{sindex + len(group_meta_kwargs) - 1}"
+                f"/{action_args.num_samplers} started."
             )
-        saving_metadata = driver_helpers.save_gather_stats_data(
-            driver_args.save_raw_data_dir,
-            driver_args.skip_data,
-            stats,
-        )
-        driver_helpers.save_gather_stats_metadata(
-            driver_args.save_metadata_dir,
-            # driver_args.skip_data,
-            {
-                **stats_metadata,  # stats dependent metadata
-                **saving_metadata,  # raw data dependent metadata
-                **meta_kwargs,  # stats independent metadata
-            },
+            results = gather_group_stats(sampler, dynamic_kwargs, group_meta_kwargs)
+            for (stats, stats_metadata), meta_kwargs in zip(results, group_meta_kwargs):
+                logger.info(
+                    f"task {sindex}/{action_args.num_samplers} "
+                    f"finsied in {stats_metadata['time_to_compute']:.3f}s "
+                    "\nnumber of samples "
+                    f"{stats_metadata['batch_index'] * meta_kwargs['batch_size']}",
+                )
+                logger.debug(
+                    f"task {sindex} carry bytes {stats_metadata['carry_bytes']} "
+                    f"({stats_metadata['aliased_carry_buffers']} buffers in place) "
+                    f"peak program bytes {stats_metadata.get('peak_program_bytes')}"
+                )
+                # blocks only when writer_queue_size tasks are waiting to be saved
+                with timer.phase("enqueue_save"):
+                    writer.submit(
+                        driver_helpers.save_gather_stats_task,
+                        driver_args,
+                        sindex,
+                        stats,
+                        stats_metadata,
+                        meta_kwargs,
+                        dict(timer.timings),
+                    )
+                sindex += 1
+elif driver_args.action == Action.convert_weights:
+    from source import model_manager
+
+    for architecture in action_args.architectures:
+        model_manager.convert_weights(
+            architecture,
+            action_args.input_shape,
+            action_args.num_classes,
+            driver_args.weights_dir,
         )
+elif driver_args.action == Action.precompute_predictions:
+    from source import predictions
+
+    for architecture in action_args.architectures:
+        predictions.precompute_predictions(architecture, action_args)
 elif driver_args.action == Action.merge_stats:
+    from source import project_manager
+
     project_manager.merge_experiment_metadata(
         driver_args.save_metadata_dir,
     )
 elif driver_args.action == Action.compute_inconsistency:
-    stats = measure_inconsistency(
-        action_args.data_loader,
-        action_args.inconsistency_measure,
-    )
-    driver_helpers.save_inconsistency(
+    from source.inconsistency_measures import measure_inconsistency
+
+    with driver_helpers.InconsistencyWriter(
         driver_args.save_metadata_dir,
-        stats,  # raw data dependent metadata
         action_args.pivot_column,
         action_args.inconsistency_measure_name,
-    )
+        action_args.pivot_values,
+        action_args.num_rows,
+        action_args.write_chunk_size,
+    ) as writer:
+        measure_inconsistency(
+            action_args.data_loader,
+            action_args.inconsistency_measure,
+            writer.write,
+        )
 else:
     raise NotImplementedError
@@ -20,14 +20,29 @@ class DefaultArgs:
     inconsistency_measures = [v for v in dir(InconsistencyMeasures) if "__" not in v]
     methods = ["noise_interpolation", "fisher_information"]
     logging_levels = [logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR]
-    architectures = ["resnet50"]
+    architectures = [
+        "resnet18",
+        "resnet34",
+        "resnet50",
+        "resnet101",
+        "resnet152",
+        "vgg16",
+        "vgg19",
+        "tiny_cnn",  # randomly initialized, for tests
+    ]
     output_layers = ["logits", "log_softmax", "softmax"]
     actions = [v for v in dir(Action) if "__" not in v]
 
     c1 = 0.01**2  # SSIM constant
     c2 = 0.03**2  # SSIM constant
+    ssim_window_size = 7
+    ssim_window_sigma = 1.5
     downsampling_factor = 5
     prefetch_factor = 4
+    num_workers = 8
+    data_loaders = ["numpy", "tensorflow"]
+    data_loader = data_loaders[0]
+    write_chunk_size = 1024
     pivot_indices = ["image_index", "projection_index"]
     pivot_column = "alpha_mask_value"
     seed = 42
@@ -35,15 +50,40 @@ class DefaultArgs:
     input_shape = (1, 224, 224, 3)
     logging_level = logging.INFO
     stats_log_level = 0
+    stream_downsampling_factor = None  # no reduced streams
+    pack_streams = True  # stack same-shaped statistics in one buffer
+    key_policies = ["shared", "decorrelated"]
+    key_policy = key_policies[0]  # pivot column values share their noise
+    prng_impls = ["threefry2x32", "rbg", "unsafe_rbg"]
+    prng_impl = prng_impls[0]  # rbg variants are faster on accelerators
+    inconsistency_streams = ["vanilla_grad_mask", "vanilla_grad_mask_reduced"]
+    inconsistency_stream = inconsistency_streams[0]
     skip_data = None
+    storage_codecs = ["npy", "lossless", "float16", "int8"]
+    storage_codec = storage_codecs[0]
+    storage_compressors = ["zlib", "zstd"]
+    storage_compressor = storage_compressors[0]
+    writer_queue_size = 2
     monitored_statistic = "meanx2"
     output_layer = output_layers[1]  # see paper for why
     monitored_stream = "vanilla_grad_mask"
     min_change = 1e-2
     batch_size = 32
     max_batches = 10000 // batch_size
+    memory_budget = None  # GiB, fit the batch size to the budget if given
+    max_batch_size = 1024
+    calibration_batches = 5  # batches measured per candidate batch size
+    predictions_dir = None  # top-k tables of precompute_predictions
+    predictions_top_k = 5
+    predictions_batch_size = 256
+    max_group_size = 1  # tasks that only differ in dynamic args run together
+    alpha_sweep = False  # gather all alpha values of an image in one loop
+    remat_policies = ["none", "full", "dots", "dots_no_batch"]
+    remat_policy = remat_policies[0]  # store all activations
     action = Action.gather_stats
-    dataset = "imagenet"
+    datasets = ["imagenet", "imagenet_numpy"]
+    # the tfds pipeline, imagenet_numpy (tensorflow free) is opt-in
+    dataset = datasets[0]
     # args we don't want to be compiled by jax
     args_state = json.dumps(
         {k: v[1] for k, v in _args_pattern_state.items()}, separators=(";", ":")
@@ -58,6 +98,9 @@ class DefaultArgs:
     jupyter_data_dir = "/local_storage/users/amirme/jupyter_data"
     visualizations_dir = os.path.join(jupyter_data_dir, "visualizations")
     profiler_dir = os.path.join(jupyter_data_dir, "profiler")
+    timings_dir = None  # timings are only logged unless given or profiling
+    tuning_cache = os.path.join(jupyter_data_dir, "batch_size_cache.json")
+    weights_dir = None  # weight store, converted from flaxmodels on first use
 
     image_height = input_shape[1]
     image_index = 0
@@ -1,17 +1,28 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
-import PIL
-from matplotlib import pyplot as plt
+import random
+import PIL.Image
 import numpy as np
 import argparse
 from pandas import Series
-import tensorflow as tf
-import tensorflow_datasets as tfds
 import jax.numpy as jnp
 import logging
+import sys
+
+sys.path.append(os.getcwd())
+from source.storage import load_array
 
 logger = logging.getLogger(__name__)
 
+# same extensions and split folder as tfds.folder_dataset.ImageFolder
+_supported_image_formats = (".jpg", ".jpeg", ".png")
+_split = "val"
+
+
 def preprocess(x, img_size):
+    import tensorflow as tf
+
     x = tf.keras.layers.experimental.preprocessing.CenterCrop(
         height=img_size,
         width=img_size,
@@ -22,6 +33,8 @@ def preprocess(x, img_size):
 
 
 def save_axis(names, fig, axes, save_output_dir):
+    from matplotlib import pyplot as plt
+
     plt.draw()
     for ax, name in zip(axes.flatten(), names):
         extent = ax.get_tightbbox(fig.canvas.renderer).transformed(
@@ -34,6 +47,8 @@ def save_axis(names, fig, axes, save_output_dir):
 
 # move to visualization.py
 def plot_masks(masks, titles, imshow_args={}, ncols=5):
+    from matplotlib import pyplot as plt
+
     ncols = ncols
     nrows = np.ceil(len(masks) / ncols).astype(int)
     scale_factor = 4
@@ -80,10 +95,10 @@ def fisher_information(dynamic_meanx2, static_meanx2, prior):
     $A = \sum_i^k E_x[(\nabla (\log f(x))_i)^2] q_i$
     $B = E_x[(\sum_i^k \nabla (\log f(x))_i q_i)^2]
     """
-    static_meanx2 = static_meanx2.loc[:, "data_path"].apply(np.load)
+    static_meanx2 = static_meanx2.loc[:, "data_path"].apply(load_array)
     static_meanx2 = np.stack(static_meanx2, axis=0)
 
-    dynamic_meanx2 = dynamic_meanx2.loc[:, "data_path"].apply(np.load)
+    dynamic_meanx2 = dynamic_meanx2.loc[:, "data_path"].apply(load_array)
     dynamic_meanx2 = dynamic_meanx2.to_numpy()[0]
     assert static_meanx2.shape[0] == prior.shape[0]
     e2q = (static_meanx2 * prior).sum(axis=0)
@@ -116,6 +131,8 @@ def single_query_imagenet(dataset_dir, image_index, input_shape):
 
 
 def query_imagenet(args):
+    import tensorflow_datasets as tfds
+
     args.image = []
     args.label = []
     args.image_path = []
@@ -149,6 +166,81 @@ def query_imagenet(args):
         assert args.image[-1].shape == args.input_shape
 
 
+def center_crop(x: np.ndarray, img_size: int):
+    """
+    numpy counterpart of the keras CenterCrop layer used in `preprocess`.
+    images smaller than img_size are first resized so that the largest
+    centered square fits.
+    """
+    height, width = x.shape[:2]
+    if height < img_size or width < img_size:
+        side = min(height, width)
+        top, left = (height - side) // 2, (width - side) // 2
+        x = PIL.Image.fromarray(x[top : top + side, left : left + side])
+        x = np.asarray(x.resize((img_size, img_size), PIL.Image.BILINEAR))
+        return x
+    top, left = (height - img_size) // 2, (width - img_size) // 2
+    return x[top : top + img_size, left : left + img_size]
+
+
+def preprocess_numpy(x, img_size):
+    x = np.asarray(x.convert("RGB"))
+    x = center_crop(x, img_size)
+    x = np.expand_dims(x, axis=0).astype(np.float32) / 255.0
+    return x
+
+
+@functools.lru_cache(maxsize=None)
+def list_image_folder(dataset_dir: str):
+    """
+    lists the `split/label/image` layout in the same (deterministically
+    shuffled) order as tfds.folder_dataset.ImageFolder so that an image_index
+    refers to the same image in both pipelines.
+
+    returns:
+        image_paths, labels (indices into the sorted label names)
+    """
+    split_dir = os.path.join(dataset_dir, _split)
+    label_names = sorted(
+        f for f in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, f))
+    )
+    examples = []
+    for label, label_name in enumerate(label_names):
+        label_dir = os.path.join(split_dir, label_name)
+        examples.extend(
+            (os.path.join(label_dir, f), label)
+            for f in sorted(os.listdir(label_dir))
+            if f.lower().endswith(_supported_image_formats)
+        )
+    random.Random(_split).shuffle(examples)
+    logger.info(f"the dataset size is {len(examples)}")
+    image_paths, labels = zip(*examples)
+    return image_paths, labels
+
+
+def query_imagenet_numpy(args, num_workers=8):
+    """
+    tensorflow free version of `query_imagenet`. images are decoded by PIL in
+    a thread pool, center cropped and normalized to [0, 1] with numpy.
+    """
+    image_paths, labels = list_image_folder(args.dataset_dir)
+    image_height = args.input_shape[1]  # (N, H, W, C)
+
+    def _load(image_index):
+        with PIL.Image.open(image_paths[image_index]) as image:
+            return preprocess_numpy(image, image_height)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        args.image = list(executor.map(_load, args.image_index))
+    args.label = [labels[image_index] for image_index in args.image_index]
+    args.image_path = [image_paths[image_index] for image_index in args.image_index]
+
+    for image in args.image:
+        assert image.shape == tuple(
+            args.input_shape
+        ), f"expected image of shape {args.input_shape} got {image.shape}"
+
+
 def load_images(image_paths: Series, img_size):
     image_paths = image_paths.apply(PIL.Image.open)
     image_paths = image_paths.apply(
@@ -1,25 +1,20 @@
 import argparse
+import contextlib
 from datetime import datetime
+from functools import partial
 import json
 import os
+import queue
 import sys
+import threading
 import logging
 from typing import List
 import numpy as np
 import pandas as pd
-import jax
-import jax.numpy as jnp
-import tensorflow as tf
 
 sys.path.append(os.getcwd())
 from source.configs import DefaultArgs
-from source.data_manager import query_imagenet
-from source.explanation_methods.noise_interpolation import NoiseInterpolation
-from source.model_manager import init_resnet50_forward
-from source.inconsistency_measures import (
-    _measure_inconsistency_cosine_distance,
-    _measure_inconsistency_DSSIM,
-)
+from source.storage import StorageCodecs, save_array, load_array, load_shape
 from source.utils import (
     Action,
     InconsistencyMeasures,
@@ -27,7 +22,9 @@ from source.utils import (
     Stream,
     StreamNames,
     Statistics,
+    PhaseTimer,
     debug_nice,
+    prefetch_batches,
 )
 
 logger = logging.getLogger(__name__)
@@ -41,31 +38,80 @@ methods_switch = Switch()
 dataset_query_func_switch = Switch()
 init_architecture_forward_switch = Switch()
 
-methods_switch.register(
+# heavy dependencies (jax, tensorflow, flaxmodels) are imported on first use
+# so that actions like merge_stats start without loading them.
+
+
+def _load_noise_interpolation():
+    from source.explanation_methods.noise_interpolation import NoiseInterpolation
+
+    return NoiseInterpolation()
+
+
+def _load_query_imagenet():
+    from source.data_manager import query_imagenet
+
+    return query_imagenet
+
+
+def _load_query_imagenet_numpy():
+    from source.data_manager import query_imagenet_numpy
+
+    return query_imagenet_numpy
+
+
+def _load_init_forward(architecture):
+    def loader():
+        from source.model_manager import init_forward
+
+        return partial(init_forward, architecture)
+
+    return loader
+
+
+methods_switch.register_lazy(
     "noise_interpolation",
-    NoiseInterpolation(),
+    _load_noise_interpolation,
 )
-dataset_query_func_switch.register(
+dataset_query_func_switch.register_lazy(
     "imagenet",
-    query_imagenet,
+    _load_query_imagenet,
 )
-init_architecture_forward_switch.register(
-    "resnet50",
-    init_resnet50_forward,
+dataset_query_func_switch.register_lazy(
+    "imagenet_numpy",
+    _load_query_imagenet_numpy,
 )
+for architecture in DefaultArgs.architectures:
+    init_architecture_forward_switch.register_lazy(
+        architecture,
+        _load_init_forward(architecture),
+    )
 
 
 def base_parser(parser, default_args: DefaultArgs):
     args = _parse_general_args(parser, default_args)
 
     if args.action == Action.gather_stats:
-        action_args, write_demo = _parse_gather_stats_args(parser, default_args)
+        action_args = _parse_gather_stats_args(parser, default_args)
         driver_args = argparse.Namespace(
             action=args.action,
-            write_demo=write_demo,
             save_raw_data_dir=args.save_raw_data_dir,
             save_metadata_dir=args.save_metadata_dir,
             skip_data=args.skip_data,
+            storage_codec=args.storage_codec,
+            storage_compressor=args.storage_compressor,
+            writer_queue_size=args.writer_queue_size,
+            memory_budget=args.memory_budget,
+            max_batch_size=args.max_batch_size,
+            tune_batch_size=args.tune_batch_size,
+            calibration_batches=args.calibration_batches,
+            tuning_cache=args.tuning_cache,
+            # the tuned batch size depends on the rematerialization
+            remat_policy=parser.parse_known_args()[0].remat_policy,
+            profiler_dir=args.profiler_dir,
+            profile=args.profile,
+            timings_dir=args.timings_dir
+            or (args.profiler_dir if args.profile else None),
         )
     elif args.action == Action.compute_inconsistency:
         action_args = _parse_measure_inconsistency_args(parser, default_args)
@@ -79,12 +125,109 @@ def base_parser(parser, default_args: DefaultArgs):
             action=args.action,
             save_metadata_dir=args.save_metadata_dir,
         )
+    elif args.action == Action.convert_weights:
+        action_args = _parse_convert_weights_args(parser, default_args)
+        driver_args = argparse.Namespace(
+            action=args.action,
+            weights_dir=args.weights_dir,
+        )
+    elif args.action == Action.precompute_predictions:
+        action_args = _parse_precompute_predictions_args(parser, default_args)
+        driver_args = argparse.Namespace(
+            action=args.action,
+            predictions_dir=args.predictions_dir,
+        )
     else:
         raise NotImplementedError("other actions are not implemented")
 
     return driver_args, action_args
 
 
+def _parse_convert_weights_args(parser, default_args):
+    parser.add_argument(
+        "--architectures",
+        type=str,
+        nargs="+",
+        default=default_args.architectures,
+        choices=default_args.architectures,
+    )
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=default_args.num_classes,
+    )
+    parser.add_argument(
+        "--input_shape",
+        nargs=4,
+        type=int,
+        default=default_args.input_shape,
+    )
+    args = parser.parse_args()
+    assert args.weights_dir is not None, "--weights_dir is required"
+    return args
+
+
+def _parse_precompute_predictions_args(parser, default_args):
+    parser.add_argument(
+        "--architectures",
+        type=str,
+        nargs="+",
+        required=True,
+        choices=default_args.architectures,
+    )
+    parser.add_argument(
+        "--output_layer",
+        type=str,
+        default=default_args.output_layer,
+        choices=default_args.output_layers,
+    )
+    parser.add_argument(
+        "--dataset_dir",
+        type=str,
+        default=default_args.dataset_dir,
+    )
+    parser.add_argument(
+        "--num_images",
+        type=int,
+        default=None,
+        help="predict the first images only, all images by default",
+    )
+    parser.add_argument(
+        "--num_classes",
+        type=int,
+        default=default_args.num_classes,
+    )
+    parser.add_argument(
+        "--input_shape",
+        nargs=4,
+        type=int,
+        default=default_args.input_shape,
+    )
+    parser.add_argument(
+        "--top_k",
+        type=int,
+        default=default_args.predictions_top_k,
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=default_args.predictions_batch_size,
+    )
+    parser.add_argument(
+        "--prefetch_factor",
+        type=int,
+        default=default_args.prefetch_factor,
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=default_args.num_workers,
+    )
+    args = parser.parse_args()
+    assert args.predictions_dir is not None, "--predictions_dir is required"
+    return args
+
+
 def _parse_measure_inconsistency_args(parser, default_args):
     parser.add_argument(
         "--batch_size",
@@ -107,6 +250,17 @@ def _parse_measure_inconsistency_args(parser, default_args):
         type=int,
         default=default_args.prefetch_factor,
     )
+    parser.add_argument(
+        "--data_loader",
+        type=str,
+        default=default_args.data_loader,
+        choices=default_args.data_loaders,
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=default_args.num_workers,
+    )
     parser.add_argument(
         "--downsampling_factor",
         type=int,
@@ -128,31 +282,106 @@ def _parse_measure_inconsistency_args(parser, default_args):
         type=float,
         default=default_args.c2,
     )
+    parser.add_argument(
+        "--write_chunk_size",
+        type=int,
+        default=default_args.write_chunk_size,
+    )
+    parser.add_argument(
+        "--pairwise_inconsistency",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--ssim_window_size",
+        type=int,
+        default=default_args.ssim_window_size,
+    )
+    parser.add_argument(
+        "--ssim_window_sigma",
+        type=float,
+        default=default_args.ssim_window_sigma,
+    )
+    parser.add_argument(
+        "--inconsistency_stream",
+        type=str,
+        default=default_args.inconsistency_stream,
+        choices=default_args.inconsistency_streams,
+    )
 
     args, _ = parser.parse_known_args()
-    data_loader = _make_loader(
+    args.downsampling_factor = get_effective_downsampling_factor(
+        args.save_metadata_dir,
+        args.inconsistency_stream,
+        args.downsampling_factor,
+    )
+    data_loader, pivot_values, num_rows = _make_loader(
         args.save_metadata_dir,
         args.pivot_indices,
         args.batch_size,
         args.inconsistency_measure,
         args.pivot_column,
         prefetch_factor=args.prefetch_factor,
+        data_loader=args.data_loader,
+        num_workers=args.num_workers,
+        stream_name=args.inconsistency_stream,
     )
     inconsistency_measure_func = get_inconsistency_measure(args)
 
     return argparse.Namespace(
         data_loader=data_loader,
         pivot_column=args.pivot_column,
+        pivot_values=pivot_values,
+        num_rows=num_rows,
+        write_chunk_size=args.write_chunk_size,
         inconsistency_measure=inconsistency_measure_func,
         inconsistency_measure_name=args.inconsistency_measure,
     )
 
 
+def get_effective_downsampling_factor(
+    save_metadata_dir, stream_name, downsampling_factor
+):
+    """
+    reduced streams are already downsampled by stream_downsampling_factor
+    during gather_stats, so only the remaining factor is applied by the
+    inconsistency measures.
+    """
+    if stream_name != StreamNames.vanilla_grad_mask_reduced:
+        return downsampling_factor
+    merged_metadata_path = os.path.join(save_metadata_dir, "merged_metadata.csv")
+    merged_metadata = pd.read_csv(merged_metadata_path)
+    assert "stream_downsampling_factor" in merged_metadata.columns, (
+        f"Could not find stream_downsampling_factor in {merged_metadata_path}. "
+        "Make sure the experiment was run with --stream_downsampling_factor"
+    )
+    stream_downsampling_factor = merged_metadata["stream_downsampling_factor"].unique()
+    assert (
+        len(stream_downsampling_factor) == 1
+    ), f"expected a single stream_downsampling_factor got {stream_downsampling_factor}"
+    stream_downsampling_factor = int(stream_downsampling_factor[0])
+    assert downsampling_factor % stream_downsampling_factor == 0, (
+        f"downsampling_factor {downsampling_factor} must be a multiple of "
+        f"stream_downsampling_factor {stream_downsampling_factor}"
+    )
+    logger.info(
+        f"{stream_name} is already downsampled by {stream_downsampling_factor}."
+    )
+    return downsampling_factor // stream_downsampling_factor
+
+
 def get_inconsistency_measure(args):
+    import jax
+    from source.inconsistency_measures import (
+        _measure_inconsistency_cosine_distance,
+        _measure_inconsistency_DSSIM,
+    )
+
     if args.inconsistency_measure == InconsistencyMeasures.cosine_distance:
         inconsistency_measure_func = _measure_inconsistency_cosine_distance(
             downsampling_factor=args.downsampling_factor,
             downsampling_method=jax.image.ResizeMethod.LINEAR,
+            pairwise=args.pairwise_inconsistency,
         )
     elif args.inconsistency_measure == InconsistencyMeasures.dssim:
         inconsistency_measure_func = _measure_inconsistency_DSSIM(
@@ -160,6 +389,9 @@ def get_inconsistency_measure(args):
             downsampling_method=jax.image.ResizeMethod.LINEAR,
             c1=args.c1,
             c2=args.c2,
+            window_size=args.ssim_window_size,
+            window_sigma=args.ssim_window_sigma,
+            pairwise=args.pairwise_inconsistency,
         )
     else:
         raise NotImplementedError("other inconsistency measures are not implemented")
@@ -185,10 +417,9 @@ def _parse_gather_stats_args(parser, default_args):
     logger.debug("added base args to parser.")
 
     args = parser.parse_args()
-    write_demo = args.write_demo
     args = _process_gather_stats_args(args)
     logger.debug("processing args finished.")
-    return args, write_demo
+    return args
 
 
 def _parse_general_args(parser, default_args):
@@ -203,6 +434,64 @@ def _parse_general_args(parser, default_args):
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--storage_codec",
+        type=str,
+        default=default_args.storage_codec,
+        choices=default_args.storage_codecs,
+    )
+    parser.add_argument(
+        "--storage_compressor",
+        type=str,
+        default=default_args.storage_compressor,
+        choices=default_args.storage_compressors,
+    )
+    parser.add_argument(
+        "--writer_queue_size",
+        type=int,
+        default=default_args.writer_queue_size,
+        help="number of finished tasks waiting to be written, 0 writes synchronously",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=float,
+        default=default_args.memory_budget,
+        help="device memory in GiB, picks the largest batch size that fits",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=default_args.max_batch_size,
+    )
+    parser.add_argument(
+        "--tune_batch_size",
+        action="store_true",
+        help="pick the batch size with the highest measured throughput",
+    )
+    parser.add_argument(
+        "--calibration_batches",
+        type=int,
+        default=default_args.calibration_batches,
+    )
+    parser.add_argument(
+        "--tuning_cache",
+        type=str,
+        default=default_args.tuning_cache,
+        help="json file of the tuned batch size per architecture, device and input shape",
+    )
+    parser.add_argument(
+        "--weights_dir",
+        type=str,
+        default=default_args.weights_dir,
+        help="directory of the memory mapped pretrained weights (weight store)",
+    )
+    parser.add_argument(
+        "--predictions_dir",
+        type=str,
+        default=default_args.predictions_dir,
+        help="directory of the precomputed top-k predictions, the prediction "
+        "projections of gather_stats are read from it if given",
+    )
     parser.add_argument(
         "--save_raw_data_dir",
         type=str,
@@ -213,6 +502,22 @@ def _parse_general_args(parser, default_args):
         type=str,
         default=default_args.save_metadata_dir,
     )
+    parser.add_argument(
+        "--profiler_dir",
+        type=str,
+        default=default_args.profiler_dir,
+    )
+    parser.add_argument(
+        "--timings_dir",
+        type=str,
+        default=default_args.timings_dir,
+        help="write the timings of every task as json, profiler_dir with --profile",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+    )
     parser.add_argument(
         "--dry_run",
         action="store_true",
@@ -237,13 +542,19 @@ def _parse_general_args(parser, default_args):
     args, _ = parser.parse_known_args()
 
     if args.assert_device:
+        import jax
+
         assert jax.device_count() > 0, "jax devices are not available"
 
     if args.disable_jit:
+        import jax
+
         logger.info("jit is disabled.")
         jax.config.update("jax_disable_jit", True)
 
     if args.dry_run:
+        import jax
+
         jax.config.update("jax_log_compiles", True)
         # jax.config.update('jax_platform_name', 'cpu')
 
@@ -258,6 +569,7 @@ def _parse_general_args(parser, default_args):
     logging.getLogger("source.inconsistency_measures").setLevel(args.logging_level)
     logging.getLogger("source.data_manager").setLevel(args.logging_level)
     logging.getLogger("source.operations").setLevel(args.logging_level)
+    logging.getLogger("source.predictions").setLevel(args.logging_level)
     logging.getLogger("__main__").setLevel(args.logging_level)
 
     logger.debug("added general args to parser.")
@@ -299,6 +611,27 @@ def _add_base_args(parser, default_args):
         type=int,
         default=default_args.batch_size,
     )
+    parser.add_argument(
+        "--max_group_size",
+        type=int,
+        default=default_args.max_group_size,
+        help="gather the stats of up to this many tasks that only differ in "
+        "dynamic args with one vmapped loop",
+    )
+    parser.add_argument(
+        "--alpha_sweep",
+        action="store_true",
+        default=default_args.alpha_sweep,
+        help="gather the stats of all alpha mask values of an image with one "
+        "vmapped loop sharing the noise of the samples",
+    )
+    parser.add_argument(
+        "--remat_policy",
+        type=str,
+        default=default_args.remat_policy,
+        choices=default_args.remat_policies,
+        help="recompute the activations of every residual block in the gradient",
+    )
     parser.add_argument(
         "--num_classes",
         type=int,
@@ -330,6 +663,7 @@ def _add_base_args(parser, default_args):
         "--dataset",
         type=str,
         default=default_args.dataset,
+        choices=default_args.datasets,
     )
     parser.add_argument(
         "--dataset_dir",
@@ -347,6 +681,38 @@ def _add_base_args(parser, default_args):
         type=int,
         default=default_args.stats_log_level,
     )
+    parser.add_argument(
+        "--stream_downsampling_factor",
+        type=int,
+        default=default_args.stream_downsampling_factor,
+        help="also accumulate vanilla_grad_mask statistics downsampled by this factor",
+    )
+    parser.add_argument(
+        "--stream_collapse_channels",
+        action="store_true",
+        help="collapse the color channels of the reduced statistics",
+    )
+    parser.add_argument(
+        "--pack_streams",
+        action=argparse.BooleanOptionalAction,
+        default=default_args.pack_streams,
+        help="carry same-shaped statistics in a single stacked buffer",
+    )
+    parser.add_argument(
+        "--key_policy",
+        type=str,
+        default=default_args.key_policy,
+        choices=default_args.key_policies,
+        help="share the random streams of the pivot column values of an image "
+        "(common random numbers) or decorrelate them",
+    )
+    parser.add_argument(
+        "--prng_impl",
+        type=str,
+        default=default_args.prng_impl,
+        choices=default_args.prng_impls,
+        help="implementation of the random number generator of the samples",
+    )
     parser.add_argument(
         "--args_state",
         type=json_semicolon_loads,
@@ -360,6 +726,8 @@ def _add_base_args(parser, default_args):
 
 
 def _process_gather_stats_args(args):
+    import jax.numpy as jnp
+
     os.makedirs(args.save_raw_data_dir, exist_ok=True)
     os.makedirs(args.save_metadata_dir, exist_ok=True)
     logger.debug("created the save directories.")
@@ -426,6 +794,21 @@ def _process_gather_stats_args(args):
                 Statistics.meanx,
             )
         ] = jnp.zeros(shape=args.input_shape)
+
+    if args.stream_downsampling_factor or args.stream_collapse_channels:
+        args.stream_downsampling_factor = args.stream_downsampling_factor or 1
+        args.stats.update(
+            {
+                Stream(StreamNames.vanilla_grad_mask_reduced, statistic): jnp.zeros(
+                    shape=get_reduced_shape(
+                        args.input_shape,
+                        args.stream_downsampling_factor,
+                        args.stream_collapse_channels,
+                    )
+                )
+                for statistic in (Statistics.meanx, Statistics.meanx2)
+            }
+        )
     logger.debug("initialized the stats.")
 
     method_args = _process_method_kwargs(args)
@@ -434,13 +817,17 @@ def _process_gather_stats_args(args):
     return method_args
 
 
-def sample_demo(static_kwargs, dynamic_kwargs, meta_kwargs, stats):
-    logger.info("sampling the demo.")
-    method = meta_kwargs["method"]
-    demo_stats = methods_switch[method].sample_demo(
-        static_kwargs, dynamic_kwargs, meta_kwargs
+def get_reduced_shape(input_shape, downsampling_factor, collapse_channels):
+    N, H, W, C = input_shape
+    assert (
+        H // downsampling_factor > 0 and W // downsampling_factor > 0
+    ), f"downsampling factor {downsampling_factor} is too large for {input_shape}"
+    return (
+        N,
+        H // downsampling_factor,
+        W // downsampling_factor,
+        1 if collapse_channels else C,
     )
-    stats.update(demo_stats)
 
 
 def _make_loader(
@@ -450,6 +837,9 @@ def _make_loader(
     measure_inconsistency_name: str,
     pivot_column: str,
     prefetch_factor: int,
+    data_loader: str = DefaultArgs.data_loader,
+    num_workers: int = DefaultArgs.num_workers,
+    stream_name: str = DefaultArgs.inconsistency_stream,
 ):
     input_shape, merged_metadata_tuple = safely_load_metadata(
         save_metadata_dir,
@@ -462,38 +852,59 @@ def _make_loader(
         measure_inconsistency_name,
         pivot_column,
         merged_metadata_tuple,
+        stream_name,
     )
 
     index_keys = get_index_keys(merged_metadata_tuple)
+    pivot_values = get_pivot_values(merged_metadata_tuple)
+    num_rows = len(merged_metadata_tuple[0])
+    first_data_path = merged_metadata_tuple[0].iloc[0, 0]
     merged_metadata_tuple = make_iterator(merged_metadata_tuple)
 
-    def _generator():
-        for items in zip(*merged_metadata_tuple):
-            sample = []
-            for indices, paths in items:
-                sample.append(np.stack(paths.apply(np.load)))
-            sample = tuple(sample)
-            index = {k: v for k, v in zip(index_keys, indices)}
-            yield {"data": sample, **index}
-
-    indices_signature, samples_signature = get_output_signatures(
-        input_shape,
-        sample_keys,
-        index_keys,
-    )
-
-    dataset = tf.data.Dataset.from_generator(
-        _generator,
-        output_signature={
-            **samples_signature,
-            **indices_signature,
-        },
-    )
-    iterator = dataset.batch(batch_size).prefetch(prefetch_factor).as_numpy_iterator()
-    return iterator
+    def _load_sample(items):
+        sample = []
+        for indices, paths in items:
+            sample.append(np.stack(paths.apply(load_array)).astype(np.float32))
+        sample = tuple(sample)
+        index = {k: np.int32(v) for k, v in zip(index_keys, indices)}
+        return {"data": sample, **index}
+
+    if data_loader == "numpy":
+        iterator = prefetch_batches(
+            _load_sample,
+            zip(*merged_metadata_tuple),
+            batch_size,
+            prefetch_factor,
+            num_workers,
+        )
+    elif data_loader == "tensorflow":
+        import tensorflow as tf
+
+        # reduced streams are stored at a different shape than input_shape
+        sample_shape = load_shape(first_data_path)
+        input_shape = (input_shape[0], *sample_shape)
+        indices_signature, samples_signature = get_output_signatures(
+            input_shape,
+            sample_keys,
+            index_keys,
+        )
+        dataset = tf.data.Dataset.from_generator(
+            lambda: map(_load_sample, zip(*merged_metadata_tuple)),
+            output_signature={
+                **samples_signature,
+                **indices_signature,
+            },
+        )
+        dataset = dataset.batch(batch_size).prefetch(prefetch_factor)
+        iterator = dataset.as_numpy_iterator()
+    else:
+        raise NotImplementedError(f"data loader {data_loader} is not implemented")
+    return iterator, pivot_values, num_rows
 
 
 def get_output_signatures(input_shape, sample_keys, index_keys):
+    import tensorflow as tf
+
     indices_signature = {k: tf.TensorSpec(shape=(), dtype=tf.int32) for k in index_keys}
     samples_signature = {
         "data": (tf.TensorSpec(shape=input_shape, dtype=tf.float32),) * len(sample_keys)
@@ -506,6 +917,14 @@ def get_output_signatures(input_shape, sample_keys, index_keys):
     return indices_signature, samples_signature
 
 
+def get_pivot_values(merged_metadata):
+    assert isinstance(
+        merged_metadata, tuple
+    ), f"merged_metadata must be a tuple, got {type(merged_metadata)}"
+
+    return merged_metadata[0].columns.to_numpy()
+
+
 def get_index_keys(merged_metadata):
     assert isinstance(
         merged_metadata, tuple
@@ -519,10 +938,12 @@ def prepare_metadata(
     measure_inconsistency_name,
     pivot_column,
     merged_metadata,
+    stream_name=StreamNames.vanilla_grad_mask,
 ):
     sample_keys, merged_metadata_tuple = filter_relevant_parts(
         measure_inconsistency_name,
         merged_metadata,
+        stream_name,
     )
 
     merged_metadata_tuple = pivot_metadata(
@@ -567,31 +988,26 @@ def pivot_metadata(pivot_indices, pivot_column, merged_metadata_tuple):
     return merged_metadata_tuple
 
 
-def filter_relevant_parts(measure_inconsistency_name, merged_metadata):
+def filter_relevant_parts(
+    measure_inconsistency_name,
+    merged_metadata,
+    stream_name=StreamNames.vanilla_grad_mask,
+):
     if measure_inconsistency_name == InconsistencyMeasures.cosine_distance:
         meanx2_metadata = merged_metadata[
-            (merged_metadata["stream_name"] == "vanilla_grad_mask")
+            (merged_metadata["stream_name"] == stream_name)
             & (merged_metadata["stream_statistic"] == "meanx2")
         ]
         keys = ("meanx2",)
         return keys, (meanx2_metadata,)
 
     elif measure_inconsistency_name == InconsistencyMeasures.dssim:
-        meanx2_metadata = merged_metadata[
-            (merged_metadata["stream_name"] == "vanilla_grad_mask")
-            & (merged_metadata["stream_statistic"] == "meanx2")
-        ]
         meanx_metadata = merged_metadata[
-            (merged_metadata["stream_name"] == "vanilla_grad_mask")
+            (merged_metadata["stream_name"] == stream_name)
             & (merged_metadata["stream_statistic"] == "meanx")
         ]
-        assert len(meanx2_metadata) == len(meanx_metadata), (
-            f"meanx2_metadata and meanx_metadata must have"
-            f" the same length, got {len(meanx2_metadata)}"
-            f" and {len(meanx_metadata)}"
-        )
-        keys = ("meanx", "meanx2")
-        return keys, (meanx_metadata, meanx2_metadata)
+        keys = ("meanx",)
+        return keys, (meanx_metadata,)
 
 
 def safely_load_metadata(save_metadata_dir, pivot_indices, pivot_column):
@@ -655,16 +1071,27 @@ def _process_method_kwargs(args):
     return args
 
 
-def save_gather_stats_data(save_raw_data_dir, skip_data, stats):
+def save_gather_stats_data(
+    save_raw_data_dir,
+    skip_data,
+    stats,
+    storage_codec=DefaultArgs.storage_codec,
+    storage_compressor=DefaultArgs.storage_compressor,
+):
+    """
+    saves every stream of stats to a separate file. maps (H, W, C) are saved
+    with storage_codec, other streams are always saved as raw npy files.
+    """
     path_prefix = datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
-    get_npy_file_path = lambda key: os.path.join(
-        save_raw_data_dir, f"{path_prefix}.{key}.npy"
-    )
+    get_file_path = lambda key: os.path.join(save_raw_data_dir, f"{path_prefix}.{key}")
 
     # temporary metadata
     npy_file_paths = []
     stream_name = []
     stream_statistic = []
+    stream_shape = []
+    stream_codec = []
+    max_abs_error = []
     metadata = {}
 
     logger.debug("updating metadata experiment keys.")
@@ -672,28 +1099,65 @@ def save_gather_stats_data(save_raw_data_dir, skip_data, stats):
 
     logger.debug("saving the raw data and updating metadata sample keys.")
     for key, value in stats.items():
-        file_path = f"{key.name}.{key.statistic}"
-        npy_file_path = get_npy_file_path(file_path)
-        if skip_data and skip_data in npy_file_path:
-            logger.info(f"skipped writing {npy_file_path}")
+        file_path = get_file_path(f"{key.name}.{key.statistic}")
+        if skip_data and skip_data in file_path:
+            logger.info(f"skipped writing {file_path}")
             continue
 
-        np.save(npy_file_path, value.squeeze())
+        # keep the channel axis of images, e.g. (1, H, W, 1) -> (H, W, 1)
+        value = np.asarray(value)
+        if value.ndim == 4 and value.shape[0] == 1:
+            value = value[0]
+        else:
+            value = value.squeeze()
+        codec = storage_codec if value.ndim == 3 else StorageCodecs.npy
+        file_path, error = save_array(file_path, value, codec, storage_compressor)
 
         # update metadata
-        npy_file_paths.append(npy_file_path)
+        npy_file_paths.append(file_path)
         stream_name.append(key.name)
         stream_statistic.append(key.statistic)
+        stream_shape.append(str(value.shape))
+        stream_codec.append(codec)
+        max_abs_error.append(error)
 
     metadata["data_path"] = npy_file_paths
     metadata["stream_name"] = stream_name
     metadata["stream_statistic"] = stream_statistic
+    metadata["stream_shape"] = stream_shape
+    metadata["storage_codec"] = stream_codec
+    metadata["max_abs_error"] = max_abs_error
 
-    logger.info(f"saved the raw data to {get_npy_file_path('*')}")
+    logger.info(f"saved the raw data to {get_file_path('*')}")
 
     return metadata
 
 
+def profiler_trace(profiler_dir, profile):
+    if not profile:
+        return contextlib.nullcontext()
+    import jax
+
+    logger.info(f"writing the jax profiler trace to {profiler_dir}")
+    return jax.profiler.trace(profiler_dir)
+
+
+def save_gather_stats_timings(timings_dir, path_prefix, timings):
+    """
+    logs the timings of a task and writes them as json if timings_dir is given.
+    """
+    report = {"path_prefix": path_prefix, **timings}
+    logger.info(f"timings: {json.dumps(report)}")
+    if timings_dir is None:
+        return
+
+    json_file_path = os.path.join(timings_dir, f"{path_prefix}.timings.json")
+    os.makedirs(timings_dir, exist_ok=True)
+    with open(json_file_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.debug(f"saved the timings to {json_file_path}")
+
+
 def save_gather_stats_metadata(save_metadata_dir, metadata):
     csv_file_name = f"{metadata['path_prefix']}.csv"
     metadata_file_path = os.path.join(save_metadata_dir, csv_file_name)
@@ -708,6 +1172,7 @@ def save_gather_stats_metadata(save_metadata_dir, metadata):
 
     metadata["projection_index"] = int(metadata["projection_index"])
     metadata["input_shape"] = str(metadata["input_shape"])
+    metadata["key_data"] = str(metadata["key_data"])
 
     # convert metadata from dict to dataframe and save
     dataframe = pd.DataFrame(metadata)
@@ -715,17 +1180,238 @@ def save_gather_stats_metadata(save_metadata_dir, metadata):
     logger.info(f"saved the correspoding meta data to {metadata_file_path}")
 
 
-def save_inconsistency(
-    save_metadata_dir,
-    metadata,
-    pivot_column,
-    inconsistency_measure_name,
-):
-    csv_file_name = f"inconsistency_{inconsistency_measure_name}_{pivot_column}.csv"
-    metadata_file_path = os.path.join(save_metadata_dir, csv_file_name)
+class InconsistencyWriter:
+    """
+    streams the results of measure_inconsistency to disk in chunks of
+    `write_chunk_size` rows so that the host memory does not grow with
+    the number of images in the experiment. scalar results and indices are
+    appended to a csv file, pairwise matrices are written to a memory mapped
+    .npy file whose rows are aligned with the rows of the csv file.
+    """
 
-    # convert metadata from dict to dataframe and save
-    logger.debug(f"saving the inconsistency metadata {debug_nice(metadata)}")
-    dataframe = pd.DataFrame(metadata)
-    dataframe.to_csv(metadata_file_path, index=False)
-    logger.info(f"saved the correspoding meta data to {metadata_file_path}")
+    def __init__(
+        self,
+        save_metadata_dir,
+        pivot_column,
+        inconsistency_measure_name,
+        pivot_values,
+        num_rows,
+        write_chunk_size,
+    ):
+        file_name = f"inconsistency_{inconsistency_measure_name}_{pivot_column}"
+        self.metadata_file_path = os.path.join(save_metadata_dir, f"{file_name}.csv")
+        self.pairwise_file_path = os.path.join(
+            save_metadata_dir, f"{file_name}.pairwise.npy"
+        )
+        self.pivot_values_file_path = os.path.join(
+            save_metadata_dir, f"{file_name}.pivot_values.npy"
+        )
+        self.pivot_values = pivot_values
+        self.num_rows = num_rows
+        self.write_chunk_size = write_chunk_size
+
+        self.chunk = []
+        self.num_chunk_rows = 0
+        self.num_written_rows = 0
+        self.num_received_rows = 0
+        self.pairwise = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, results):
+        results = results.copy()
+        num_rows = len(results["inconsistency"])
+        pairwise_inconsistency = results.pop("pairwise_inconsistency", None)
+        if pairwise_inconsistency is not None:
+            self._write_pairwise(pairwise_inconsistency)
+        self.num_received_rows += num_rows
+
+        self.chunk.append(results)
+        self.num_chunk_rows += num_rows
+        if self.num_chunk_rows >= self.write_chunk_size:
+            self.flush()
+
+    def _write_pairwise(self, pairwise_inconsistency):
+        if self.pairwise is None:
+            self.pairwise = np.lib.format.open_memmap(
+                self.pairwise_file_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(self.num_rows, *pairwise_inconsistency.shape[1:]),
+            )
+        start = self.num_received_rows
+        self.pairwise[start : start + len(pairwise_inconsistency)] = (
+            pairwise_inconsistency
+        )
+
+    def flush(self):
+        if not self.chunk:
+            return
+        dataframe = pd.DataFrame(
+            {k: np.concatenate([v[k] for v in self.chunk]) for k in self.chunk[0]}
+        )
+        dataframe.to_csv(
+            self.metadata_file_path,
+            mode="w" if self.num_written_rows == 0 else "a",
+            header=self.num_written_rows == 0,
+            index=False,
+        )
+        self.num_written_rows += len(dataframe)
+        logger.debug(
+            f"wrote {len(dataframe)} rows to {self.metadata_file_path} "
+            f"({self.num_written_rows}/{self.num_rows})"
+        )
+        self.chunk = []
+        self.num_chunk_rows = 0
+
+    def close(self):
+        self.flush()
+        logger.info(f"saved the correspoding meta data to {self.metadata_file_path}")
+        if self.pairwise is not None:
+            self.pairwise.flush()
+            del self.pairwise
+            self.pairwise = None
+            np.save(self.pivot_values_file_path, self.pivot_values)
+            logger.info(f"saved the pairwise inconsistency to {self.pairwise_file_path}")
+
+
+class BackgroundWriter:
+    """
+    runs write tasks in a background thread so that the device can start the
+    next gather_stats task while the previous results are transferred to the
+    host and written to disk. at most `queue_size` finished tasks wait in the
+    queue, `submit` blocks when the queue is full. the first error of a task
+    is raised by the next `submit` or by `close`, which also waits for all
+    submitted tasks to finish. `queue_size=0` runs the tasks synchronously.
+    """
+
+    _stop = object()
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.error = None
+        self.thread = None
+        if queue_size > 0:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.thread = threading.Thread(
+                target=self._run, name="background_writer", daemon=True
+            )
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is self._stop:
+                    return
+                if self.error is None:
+                    func, args, kwargs = task
+                    func(*args, **kwargs)
+            except BaseException as e:
+                logger.error(f"background write failed: {e!r}")
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError("a background write failed") from self.error
+
+    def submit(self, func, *args, **kwargs):
+        self._raise_error()
+        if self.thread is None:
+            func(*args, **kwargs)
+            return
+        self.queue.put((func, args, kwargs))
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            logger.debug("waiting for the background writes to finish.")
+            self.queue.put(self._stop)
+            self.thread.join()
+        self._raise_error()
+
+
+def select_batch_size(driver_args, sampler, dynamic_kwargs, group_meta_kwargs):
+    """
+    picks the batch size of the experiment from measured throughput (cached)
+    or from the compiled memory that fits driver_args.memory_budget. the
+    members of the group are measured together, as they are gathered.
+    """
+    from source import tuning
+
+    if driver_args.tune_batch_size:
+        return tuning.cached_tune_batch_size(
+            sampler,
+            dynamic_kwargs,
+            group_meta_kwargs,
+            driver_args.tuning_cache,
+            driver_args.max_batch_size,
+            driver_args.calibration_batches,
+            driver_args.memory_budget,
+            remat_policy=driver_args.remat_policy,
+        )
+    return tuning.fit_batch_size(
+        sampler,
+        dynamic_kwargs,
+        group_meta_kwargs,
+        driver_args.memory_budget,
+        driver_args.max_batch_size,
+    )
+
+
+def save_gather_stats_task(
+    driver_args,
+    task_index,
+    stats,
+    stats_metadata,
+    meta_kwargs,
+    timings,
+):
+    """
+    saves the raw data, metadata and timings of a finished gather_stats task.
+    """
+    timer = PhaseTimer()
+    with timer.phase("save"):
+        saving_metadata = save_gather_stats_data(
+            driver_args.save_raw_data_dir,
+            driver_args.skip_data,
+            stats,
+            driver_args.storage_codec,
+            driver_args.storage_compressor,
+        )
+        save_gather_stats_metadata(
+            driver_args.save_metadata_dir,
+            # driver_args.skip_data,
+            {
+                **stats_metadata,  # stats dependent metadata
+                **saving_metadata,  # raw data dependent metadata
+                **meta_kwargs,  # stats independent metadata
+            },
+        )
+    save_gather_stats_timings(
+        driver_args.timings_dir,
+        saving_metadata["path_prefix"],
+        {
+            "task_index": task_index,
+            "time_to_project": meta_kwargs["time_to_project"],
+            # timings and the memory report of the task
+            **{
+                k: v
+                for k, v in stats_metadata.items()
+                if "time_to" in k or "bytes" in k or "buffers" in k
+            },
+            **timings,
+            **timer.timings,
+        },
+    )
@@ -1,5 +1,6 @@
 import argparse
 import copy
+import itertools
 from functools import partial
 import logging
 import jax
@@ -14,12 +15,15 @@ import numpy as np
 sys.path.append(os.getcwd())
 from source.data_manager import minmax_normalize
 from source.model_manager import forward_with_projection
-from source import neighborhoods, explainers, operations
+from source import neighborhoods, explainers, operations, predictions
 from source.utils import (
+    KeyPolicies,
+    KeyStreams,
     Statistics,
     Stream,
     StreamNames,
     AbstractFunction,
+    PhaseTimer,
     pattern_generator,
     debug_nice,
 )
@@ -50,11 +54,21 @@ class NoiseInterpolation:
         demo=False,
     ):
         if isinstance(baseline_mask, Callable):
-            baseline_mask = baseline_mask(key=key)
+            baseline_mask = baseline_mask(
+                key=operations.stream_key(key, KeyStreams.baseline_mask)
+            )
+        projection_key = operations.stream_key(key, KeyStreams.projection)
         if isinstance(projection, Callable):
-            projection = projection(key=key)
+            projection = projection(key=projection_key)
+        projection_choice = None
+        if isinstance(projection, operations.CategoricalProjection):
+            projection, projection_choice = operations.sample_projection(
+                projection_key, projection
+            )
         if isinstance(alpha_mask, Callable):
-            alpha_mask = alpha_mask(key=key)
+            alpha_mask = alpha_mask(
+                key=operations.stream_key(key, KeyStreams.alpha_mask)
+            )
 
         convex_combination_mask = operations.convex_combination_mask(
             source_mask=image,
@@ -76,8 +90,16 @@ class NoiseInterpolation:
             inputs=(convex_combination_mask, projection, forward),
         )
 
+        output = {
+            StreamNames.vanilla_grad_mask: vanilla_grad_mask,
+            StreamNames.results_at_projection: results_at_projection,
+            StreamNames.log_probs: log_probs,
+        }
+        if projection_choice is not None:
+            output[StreamNames.projection_choice] = projection_choice
         if demo:
-            return {
+            # captured from the first sample of the loop by gather_stats
+            output[StreamNames.demo] = {
                 Stream(
                     StreamNames.vanilla_grad_mask, Statistics.none
                 ): vanilla_grad_mask,
@@ -89,15 +111,13 @@ class NoiseInterpolation:
                 Stream(
                     "convex_combination_mask", Statistics.none
                 ): convex_combination_mask,
-                Stream("projection", Statistics.none): projection,
+                Stream("projection", Statistics.none): operations.dense_projection(
+                    projection, log_probs.shape[-1]
+                ),
                 Stream("alpha_mask", Statistics.none): alpha_mask,
                 Stream("baseline_mask", Statistics.none): baseline_mask,
             }
-        return {
-            StreamNames.vanilla_grad_mask: vanilla_grad_mask,
-            StreamNames.results_at_projection: results_at_projection,
-            StreamNames.log_probs: log_probs,
-        }
+        return output
 
     static_sampler = AbstractFunction(sampler.__func__)
     sampler_args = list(static_sampler.params.keys())
@@ -166,10 +186,18 @@ class NoiseInterpolation:
 
     @classmethod
     def process_args(cls, args):
+        if args.alpha_sweep:
+            zipped_pattern_value = cls.sweep_alpha_mask(
+                args.args_pattern, args.args_state
+            )
         mixed_args = cls.extract_mixed_args(args)
         mixed_pattern = cls.extract_mixed_pattern(args.args_pattern, mixed_args)
+        if args.alpha_sweep:
+            cls.check_alpha_sweep(mixed_pattern, mixed_args, zipped_pattern_value)
         mixed_args = cls.maybe_broadcast_shapes(mixed_pattern, mixed_args)
         num_samplers = cls.compute_num_samplers(mixed_args, mixed_pattern)
+        if args.alpha_sweep:
+            logger.info(f"the alpha sweep gathers {num_samplers} tasks")
 
         if logger.isEnabledFor(logging.INFO):
             cls.pretty_print_args(mixed_args)
@@ -180,20 +208,112 @@ class NoiseInterpolation:
                 f"mixed_pattern: {mixed_pattern}\nmixed_args: {nice_mixed_args}"
             )
 
-        combined_mixed_args = pattern_generator(mixed_pattern, mixed_args)
-        combined_mixed_args = map(cls._process_logics, combined_mixed_args)
-        combined_mixed_args = map(cls._process_args, combined_mixed_args)
+        # combinations that only differ in dynamic args are consecutive and
+        # gathered together by one vmapped loop
+        group_pattern_values = cls.extract_group_pattern_values(
+            mixed_pattern, args.args_state
+        )
+        group_pattern = {
+            k: v for k, v in mixed_pattern.items() if v in group_pattern_values
+        }
+        group_size = cls.compute_num_samplers(mixed_args, group_pattern)
+        # a sweep gathers all alpha mask values of an image together
+        max_group_size = group_size if args.alpha_sweep else args.max_group_size
+        group_sizes = cls.compute_group_sizes(num_samplers, group_size, max_group_size)
+
+        combined_mixed_args = pattern_generator(
+            mixed_pattern, mixed_args, innermost=group_pattern_values
+        )
+        groups = (
+            list(itertools.islice(combined_mixed_args, size)) for size in group_sizes
+        )
+        groups = map(
+            partial(
+                cls._process_group,
+                pivot_values=mixed_args["alpha_mask_value"],
+                group_arg_names=list(group_pattern),
+                dynamic_keys=[k for k, v in args.args_state.items() if "dynamic" in v],
+            ),
+            groups,
+        )
         splitted_args = cls._split_args_dicts(
-            combined_mixed_args,
+            itertools.chain.from_iterable(groups),
             args_state=args.args_state,
         )
-        samplers_and_kwargs = cls.sampler_generator(splitted_args)
+        samplers_and_kwargs = cls.sampler_generator(splitted_args, group_sizes)
 
         return argparse.Namespace(
             samplers_and_kwargs=samplers_and_kwargs,
             num_samplers=num_samplers,
+            num_groups=len(group_sizes),
+        )
+
+    @staticmethod
+    def sweep_alpha_mask(args_pattern, args_state):
+        """
+        gives alpha_mask its own pattern value, every alpha mask value is then
+        combined with every image instead of being zipped with it. returns the
+        pattern value alpha_mask was zipped with (None if not given).
+        """
+        assert "dynamic" in args_state.get("alpha_mask", ""), (
+            "an alpha sweep requires a dynamic alpha_mask, "
+            f"got the args state {args_state}"
+        )
+        zipped_pattern_value = args_pattern.get("alpha_mask")
+        args_pattern["alpha_mask"] = "alpha_sweep"
+        return zipped_pattern_value
+
+    @staticmethod
+    def check_alpha_sweep(mixed_pattern, mixed_args, zipped_pattern_value):
+        """
+        warns when alpha_mask was zipped with args of several values. the
+        sweep turns that zip into a product, every alpha mask value is
+        combined with each of their values, which changes the number of tasks.
+        returns the zipped args and their number of values.
+        """
+        zipped_args = {
+            arg_name: len(mixed_args[arg_name])
+            for arg_name, value in mixed_pattern.items()
+            if value == zipped_pattern_value and len(mixed_args[arg_name]) > 1
+        }
+        if zipped_args:
+            logger.warning(
+                f"alpha_mask was zipped with {zipped_args} (number of values) "
+                f"under the pattern {zipped_pattern_value}, the alpha sweep "
+                f"combines each of the {len(mixed_args['alpha_mask_value'])} "
+                "alpha mask values with every one of them instead"
+            )
+        return zipped_args
+
+    @staticmethod
+    def extract_group_pattern_values(mixed_pattern, args_state):
+        """
+        pattern values that only index args of dynamic sampler args e.g.
+        alpha_mask_type and alpha_mask_value of a dynamic alpha_mask.
+        """
+        dynamic_keys = [k for k, v in args_state.items() if "dynamic" in v]
+        return tuple(
+            value
+            for value in sorted(set(mixed_pattern.values()))
+            if all(
+                any(key in arg_name for key in dynamic_keys)
+                for arg_name, arg_value in mixed_pattern.items()
+                if arg_value == value
+            )
         )
 
+    @staticmethod
+    def compute_group_sizes(num_samplers, group_size, max_group_size):
+        """
+        splits every run of group_size consecutive combinations into groups of
+        at most max_group_size members.
+        """
+        max_group_size = min(group_size, max_group_size)
+        sizes = [max_group_size] * (group_size // max_group_size)
+        if group_size % max_group_size:
+            sizes.append(group_size % max_group_size)
+        return sizes * (num_samplers // group_size)
+
     @staticmethod
     def compute_num_samplers(mixed_args, mixed_pattern):
         num_samplers = 1
@@ -204,13 +324,26 @@ class NoiseInterpolation:
         return num_samplers
 
     @classmethod
-    def sampler_generator(cls, splitted_args):
-        for (
-            combined_dynamic_kwargs,
-            combined_static_kwargs,
-            combined_meta_kwargs,
-        ) in splitted_args:
+    def sampler_generator(cls, splitted_args, group_sizes):
+        """
+        yields a sampler, its static kwargs, the dynamic kwargs (stacked along
+        a leading axis for groups of more than one member) and the list of
+        meta kwargs of the members for every group.
+        """
+        splitted_args = iter(splitted_args)
+        for group_size in group_sizes:
+            members = [next(splitted_args) for _ in range(group_size)]
+            (
+                combined_dynamic_kwargs,
+                combined_static_kwargs,
+                _,
+            ) = members[0]
             combined_dynamic_kwargs = cls._sort_dynamic_kwargs(combined_dynamic_kwargs)
+            if group_size > 1:
+                combined_dynamic_kwargs = {
+                    k: jnp.stack([member[0][k] for member in members])
+                    for k in combined_dynamic_kwargs
+                }
             vmap_axis = (0,) + tuple(
                 None for _ in combined_dynamic_kwargs
             )  # 0 for key, None for dynamic args
@@ -218,8 +351,9 @@ class NoiseInterpolation:
                 combined_static_kwargs,
                 vmap_axis,
             )
+            group_meta_kwargs = [member[2] for member in members]
 
-            yield sampler, combined_static_kwargs, combined_dynamic_kwargs, combined_meta_kwargs
+            yield sampler, combined_static_kwargs, combined_dynamic_kwargs, group_meta_kwargs
 
     @classmethod
     def pretty_print_args(cls, mixed_args: argparse.Namespace):
@@ -237,9 +371,48 @@ class NoiseInterpolation:
             f"experiment args:\n{debug_nice(pretty_kwargs)}",
         )
 
+    @classmethod
+    def _process_group(
+        cls, group_args_dicts, pivot_values, group_arg_names, dynamic_keys
+    ):
+        """
+        processes the combinations of a group which only differ in the args of
+        group_arg_names (dynamic sampler args). the first member is processed
+        fully (e.g. the forward pass of a prediction projection), the others
+        reuse its processed args and only process their dynamic sampler args.
+        """
+        first, *others = group_args_dicts
+        first = cls._process_logics(first)
+        first = cls._process_key_data(first, pivot_values)
+        first = cls._process_args(first)
+        dynamic_processors = {
+            "projection": cls._process_projection,
+            "baseline_mask": cls._process_baseline_mask,
+            "alpha_mask": cls._process_alpha_mask,
+        }
+        members = [first]
+        for args_dict in others:
+            args_dict = cls._process_logics(args_dict)
+            member = {
+                **first,
+                **{name: args_dict[name] for name in group_arg_names},
+            }
+            member = cls._process_key_data(member, pivot_values)
+            for key in dynamic_keys:
+                if key in dynamic_processors:
+                    member = dynamic_processors[key](member)
+            members.append(member)
+        return members
+
     @classmethod
     def _process_args(cls, args_dict):
-        args_dict = cls._process_projection(args_dict)
+        timer = PhaseTimer()
+        with timer.phase("project"):
+            args_dict = cls._process_projection(args_dict)
+            jax.block_until_ready(
+                (args_dict["projection"], args_dict["projection_index"])
+            )
+        args_dict.update(timer.timings)
         args_dict = cls._process_baseline_mask(args_dict)
         args_dict = cls._process_alpha_mask(args_dict)
 
@@ -315,6 +488,11 @@ class NoiseInterpolation:
         inplace_infer(args_pattern, "min_change", "method")
         inplace_infer(args_pattern, "monitored_statistic_source_key", "method")
         inplace_infer(args_pattern, "batch_index_key", "method")
+        inplace_infer(args_pattern, "stream_downsampling_factor", "method")
+        inplace_infer(args_pattern, "pack_streams", "method")
+        inplace_infer(args_pattern, "key_policy", "method")
+        inplace_infer(args_pattern, "prng_impl", "method")
+        inplace_infer(args_pattern, "predictions_dir", "method")
 
         mixed_pattern = {}
         for arg_name in mixed_args:
@@ -374,6 +552,11 @@ class NoiseInterpolation:
             "monitored_statistic_source_key",
             "batch_index_key",
             "stats",
+            "stream_downsampling_factor",
+            "pack_streams",
+            "key_policy",
+            "prng_impl",
+            "predictions_dir",
         ]
         mixed_args = {}
         for arg_name in input_args:
@@ -383,7 +566,7 @@ class NoiseInterpolation:
             item = getattr(args, arg_name)
             mixed_args[arg_name] = item if isinstance(item, list) else [item]
 
-        mixed_args["demo"] = [False]
+        mixed_args["demo"] = [args.write_demo]
         return mixed_args
 
     @classmethod
@@ -422,6 +605,19 @@ class NoiseInterpolation:
                 meta_kwargs[k] = v
         return dynamic_kwargs, static_kwargs, meta_kwargs
 
+    @staticmethod
+    def _process_key_data(args_dict, pivot_values):
+        """
+        data folded into the root key of the task. tasks with the same key data
+        sample the same random streams, i.e. the values of the pivot column
+        (alpha_mask_value) of an image share their noise unless decorrelated.
+        """
+        key_data = [args_dict["image_index"]]
+        if args_dict["key_policy"] == KeyPolicies.decorrelated:
+            key_data.append(pivot_values.index(args_dict["alpha_mask_value"]))
+        args_dict["key_data"] = tuple(key_data)
+        return args_dict
+
     @classmethod
     def _process_logics(
         cls,
@@ -528,10 +724,30 @@ class NoiseInterpolation:
             )
             temp_projection_index = args_dict["label"]
         elif args_dict["projection_type"] == "prediction":
-            if args_dict["projection_distribution"] == "categorical":
+            if args_dict["predictions_dir"] is not None:
+                """
+                reads the top k predictions of the image from the table of
+                precompute_predictions instead of running the forward.
+                """
+                top_k_classes = predictions.lookup_top_k(
+                    args_dict["predictions_dir"],
+                    args_dict["architecture"],
+                    args_dict["output_layer"],
+                    args_dict["image_index"],
+                    args_dict["projection_top_k"],
+                )
                 (
+                    temp_projection_index,
                     temp_projection,
+                ) = operations.projection_from_top_k(
+                    distribution=args_dict["projection_distribution"],
+                    top_k_classes=top_k_classes,
+                    num_classes=args_dict["num_classes"],
+                )
+            elif args_dict["projection_distribution"] == "categorical":
+                (
                     temp_projection_index,
+                    temp_projection,
                 ) = operations.topk_categorical_random_projection(
                     image=args_dict["image"],
                     forward=args_dict["forward"],
@@ -575,17 +791,28 @@ class NoiseInterpolation:
         else:
             raise NotImplementedError
 
+        if isinstance(temp_projection_index, list):
+            # top k classes sorted by their predicted probability. the saved
+            # projection_index is the top-1 class (a pivot index must be a
+            # single class), the k classes are saved in projection_classes and
+            # parsed back by project_manager.load_experiment_metadata
+            args_dict["projection_classes"] = str(temp_projection_index)
+            temp_projection_index = temp_projection_index[0]
+        if isinstance(temp_projection, operations.CategoricalProjection):
+            # saliency conditioned on each of the classes in the same loop
+            num_projected_classes = temp_projection.indices.shape[0]
+            args_dict["stats"] = {
+                **args_dict["stats"],
+                Stream(
+                    StreamNames.vanilla_grad_mask, Statistics.meanx_per_class
+                ): jnp.zeros(
+                    shape=(num_projected_classes, *args_dict["input_shape"][1:])
+                ),
+                Stream(
+                    StreamNames.vanilla_grad_mask, Statistics.count_per_class
+                ): jnp.zeros(shape=(num_projected_classes,)),
+            }
+
         args_dict["projection"] = temp_projection
         args_dict["projection_index"] = temp_projection_index
         return args_dict
-
-    @classmethod
-    def sample_demo(cls, static_kwargs, dynamic_kwargs, meta_kwargs):
-        # we run a demo (one step of the algorithm after computations finished)
-        static_kwargs = static_kwargs.copy()
-        key = jax.random.PRNGKey(meta_kwargs["seed"])
-        static_kwargs["demo"] = True
-        static_kwargs["key"] = key
-        static_kwargs.update(dynamic_kwargs)
-        demo_output = cls._create_sampler(static_kwargs)()
-        return demo_output
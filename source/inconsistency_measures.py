@@ -16,7 +16,14 @@ def _measure_inconsistency_cosine_distance(
     batch_mean: jnp.ndarray,
     downsampling_factor,
     downsampling_method,
+    pairwise,
 ):
+    """
+    computes the cosine distance between the first and the rest of the pivot
+    columns. if pairwise is True, the cosine distance between all pairs of
+    columns is also returned as a (B, A, A) matrix. both are read from the
+    same Gram matrix of the normalized columns.
+    """
     assert batch_mean.ndim == 5, (
         "image batched group should be 5D (B,A,H,W,C) "
         "where B is the batch size and A is the number of columns in pivot table."
@@ -36,34 +43,108 @@ def _measure_inconsistency_cosine_distance(
         method=downsampling_method,
     )
 
-    downsampled = jnp.squeeze(downsampled, axis=-1)
-    downsampled_0 = downsampled[:, [0], ...].reshape((B, 1, -1))
-    downsampled_gt0 = downsampled[:, 1:, ...].reshape((B, T - 1, -1))
+    downsampled = downsampled.reshape((B, T, -1))
+    downsampled = downsampled / jnp.linalg.norm(downsampled, axis=-1, keepdims=True)
+    cosine_similarity = jnp.einsum("bin,bjn->bij", downsampled, downsampled)
+    pairwise_cosine_distance = 1 - cosine_similarity
+    cosine_distance = pairwise_cosine_distance[:, 0, 1:].mean(axis=-1)
+    assert cosine_distance.shape == (B,)
+    if pairwise:
+        return {
+            "inconsistency": cosine_distance,
+            "pairwise_inconsistency": pairwise_cosine_distance,
+        }
+    return cosine_distance
+
+
+def _gaussian_window(window_size, window_sigma):
+    x = jnp.arange(window_size) - (window_size - 1) / 2
+    window = jnp.exp(-(x**2) / (2 * window_sigma**2))
+    return window / window.sum()
+
 
-    norm_0 = jnp.linalg.norm(downsampled_0, axis=-1, keepdims=True)
-    norm_gt0 = jnp.linalg.norm(downsampled_gt0, axis=-1, keepdims=True)
+def _valid_filter_matrix(window, size):
+    """
+    banded (size - window_size + 1, size) matrix that applies the 1D window
+    along an axis of length size with valid padding.
+    """
+    window_size = window.shape[0]
+    num_outputs = size - window_size + 1
+    offsets = jnp.arange(size)[None, :] - jnp.arange(num_outputs)[:, None]
+    inside = (offsets >= 0) & (offsets < window_size)
+    return jnp.where(inside, window[jnp.clip(offsets, 0, window_size - 1)], 0.0)
 
-    average_cosine_similarity = jnp.einsum(
-        "bti,btj->b",
-        downsampled_0 / norm_0,
-        downsampled_gt0 / norm_gt0,
-    ) / (new_H * new_W * (T - 1))
 
-    return 1 - average_cosine_similarity
+def _windowed_mean(x, window):
+    """
+    filters the last two (spatial) axes of x with the separable window
+    (valid padding), leading axes are treated as a batch. the two passes
+    are expressed as matmuls with banded matrices.
+    """
+    H, W = x.shape[-2:]
+    filter_H = _valid_filter_matrix(window, H)
+    filter_W = _valid_filter_matrix(window, W)
+    return jnp.einsum("...hw,ih,jw->...ij", x, filter_H, filter_W)
+
+
+def _pairwise_ssim(batch_mean, c1, c2, window):
+    """
+    args:
+        batch_mean: (B, A, H, W) mean maps of the pivot columns
+        c1, c2: SSIM constants
+        window: 1D window of the separable filter
+    returns:
+        (B, A, A) windowed SSIM between every pair of pivot columns
+        averaged over the spatial dimensions.
+
+    the variances and covariances are taken over the pixels of a window of
+    the mean maps, i.e. the SSIM of the mean maps. the sampling variance is
+    left out as the columns are gathered separately and have no cross moments.
+    """
+    batch_meanx2 = batch_mean**2
+    batch_meanxy = batch_mean[:, :, None] * batch_mean[:, None, :]
+    mu = _windowed_mean(batch_mean, window)
+    sigma2 = _windowed_mean(batch_meanx2, window) - mu**2
+    mu_x = mu[:, :, None]
+    mu_y = mu[:, None, :]
+    sigma_xy = _windowed_mean(batch_meanxy, window) - mu_x * mu_y
+
+    l = (2 * mu_x * mu_y + c1) / (mu_x**2 + mu_y**2 + c1)
+    cs = (2 * sigma_xy + c2) / (sigma2[:, :, None] + sigma2[:, None, :] + c2)
+    return (l * cs).mean(axis=(-2, -1))
 
 
 @AbstractFunction
 def _measure_inconsistency_DSSIM(
-    batch_mean, batch_meanx2, c1, c2, downsampling_factor, downsampling_method
+    batch_mean,
+    c1,
+    c2,
+    downsampling_factor,
+    downsampling_method,
+    window_size,
+    window_sigma,
+    pairwise,
 ):
     """
-    computes the DSSIM between two images
+    computes the DSSIM between the first and the rest of the pivot columns
     DSSIM = (1-SSIM)/2
-    SSIM stands for structural similarity index measure
+    SSIM stands for structural similarity index measure and is computed
+    between the mean maps over gaussian windows on device for all pairs of
+    columns at once. the columns are gathered separately so there are no
+    cross moments to include their sampling variance.
+    if pairwise is True, the (B, A, A) DSSIM matrix is also returned.
     """
+    assert batch_mean.ndim == 5, (
+        "image batched group should be 5D (B,A,H,W,C) "
+        "where B is the batch size and A is the number of columns in pivot table."
+    )
     B, T, H, W, _ = batch_mean.shape
     new_H = H // downsampling_factor
     new_W = W // downsampling_factor
+    assert window_size <= min(new_H, new_W), (
+        f"window_size {window_size} is larger than "
+        f"the downsampled maps {(new_H, new_W)}"
+    )
     batch_mean: jax.Array = jax.image.resize(
         batch_mean,
         shape=(
@@ -75,47 +156,48 @@ def _measure_inconsistency_DSSIM(
         ),
         method=downsampling_method,
     )
-    batch_meanx2: jax.Array = jax.image.resize(
-        batch_meanx2,
-        shape=(
-            B,
-            T,
-            new_H,
-            new_W,
-            1,  # collapse the color channels
-        ),
-        method=downsampling_method,
-    )
-    batch_mean = np.squeeze(batch_mean, axis=-1)
-    batch_meanx2 = np.squeeze(batch_meanx2, axis=-1)
-    sigma2 = batch_meanx2 - batch_mean * 2
-    sigma = np.sqrt(sigma2)
-
-    l = (2 * batch_mean.prod(axis=1) + c1) / ((batch_mean**2).sum(axis=1) + c1)
-    c = (2 * sigma.prod(axis=1) + c2) / (sigma2.sum(axis=1) + c2)
-    # s = 0 we assume that sigmaxy is zero for all pairs of images
-    ssim = l * c
-    dssim = (1 - ssim) / 2
-    dssim = dssim.mean(axis=(2, 3))
+    batch_mean = jnp.squeeze(batch_mean, axis=-1)
+
+    window = _gaussian_window(window_size, window_sigma)
+    ssim = _pairwise_ssim(batch_mean, c1, c2, window)
+    pairwise_dssim = (1 - ssim) / 2
+    dssim = pairwise_dssim[:, 0, 1:].mean(axis=-1)
     assert dssim.shape == (B,)
+    if pairwise:
+        return {
+            "inconsistency": dssim,
+            "pairwise_inconsistency": pairwise_dssim,
+        }
     return dssim
 
 
-def measure_inconsistency(numpy_iterator, concrete_inconsistency_measure):
-    results = {"inconsistency": []}
+def measure_inconsistency(
+    numpy_iterator, concrete_inconsistency_measure, write_results
+):
+    """
+    computes the inconsistency of every batch and passes the results to
+    write_results. the next batch is dispatched to the device before the
+    results of the previous batch are pulled to the host.
+    """
     logger.debug(f"iterating over {debug_nice(numpy_iterator)}")
+    pending = None
     for batch in numpy_iterator:
         data = batch.pop("data")
         logger.debug(
             f"computing inconsistency for {debug_nice(data)} with {debug_nice(concrete_inconsistency_measure)}"
         )
         inconsistency = concrete_inconsistency_measure(*data)
-        results["inconsistency"].append(inconsistency)
-        for k, v in batch.items():
-            if k not in results:
-                results[k] = []
-            results[k].append(v)  # other keys are indices
-    for k in results:
-        logger.debug(f"concatenating {k}, {debug_nice(results[k])}")
-        results[k] = np.concatenate(results[k])
+        if pending is not None:
+            write_results(_pull_results(*pending))
+        pending = (inconsistency, batch)  # other keys are indices
+
+    if pending is not None:
+        write_results(_pull_results(*pending))
+
+
+def _pull_results(inconsistency, indices):
+    if not isinstance(inconsistency, dict):
+        inconsistency = {"inconsistency": inconsistency}
+    results = {k: np.asarray(v) for k, v in inconsistency.items()}
+    results.update(indices)
     return results
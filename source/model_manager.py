@@ -1,35 +1,322 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import flax.linen as nn
+from flax import traverse_util
 import flaxmodels as fm
 import jax
 import jax.numpy as jnp
+import numpy as np
 from functools import partial
 
+sys.path.append(os.getcwd())
+from source.operations import project
+from source.utils import Switch
+
+logger = logging.getLogger(__name__)
+
+architectures_switch = Switch()
+
+# parameters per (architecture, num_classes) and jitted forwards per
+# (architecture, output_layer, num_classes, remat_policy) of this process
+_params_cache = {}
+_forward_cache = {}
+weight_store_alignment = 64  # bytes, offset of every array in a weight store
+
+# what each residual block keeps for the backward pass, everything else is
+# recomputed from the block input.
+remat_policies_switch = Switch()
+remat_policies_switch.register("full", jax.checkpoint_policies.nothing_saveable)
+remat_policies_switch.register("dots", jax.checkpoint_policies.checkpoint_dots)
+remat_policies_switch.register(
+    "dots_no_batch",
+    jax.checkpoint_policies.checkpoint_dots_with_no_batch_dims,
+)
+
 
 def forward_with_projection(inputs, projection, forward):
     assert inputs.ndim == 4, "inputs should be a batch of images"
     assert inputs.shape[0] == 1, "batch size must match"
     log_prob = forward(inputs)
-    results_at_projection = (log_prob @ projection).squeeze()
+    results_at_projection = project(log_prob, projection).squeeze()
     return results_at_projection, (results_at_projection, log_prob)
 
 
-def init_resnet50_forward(args):
-    resnet50 = fm.ResNet50(
-        output=args.output_layer,
-        pretrained="imagenet",
+def remat_block(block, remat_policy):
+    """
+    wraps the residual blocks of a flaxmodels ResNet in jax.checkpoint so that
+    the gradient stores one activation per block instead of all of them.
+    """
+    if remat_policy == "none":
+        return block
+    remat = nn.remat(
+        block,
+        static_argnums=(3,),  # train, counting self
+        policy=remat_policies_switch[remat_policy],
+    )
+    # ResNet infers the downsampling from the block name, the name also keeps
+    # the parameter tree identical to the one of the plain block
+    remat.__name__ = block.__name__
+    return remat
+
+
+class TinyCNN(nn.Module):
+    """
+    a small randomly initialized stand-in for the pretrained models with the
+    same input/output contract (N, H, W, 3) -> (N, num_classes) so the hot
+    paths can be exercised offline on CPU.
+    """
+
+    num_classes: int = 1000
+    output: str = "log_softmax"
+
+    @nn.compact
+    def __call__(self, x, train=False):
+        x = nn.Conv(features=8, kernel_size=(3, 3), strides=(2, 2))(x)
+        x = nn.relu(x)
+        x = nn.Conv(features=16, kernel_size=(3, 3), strides=(2, 2))(x)
+        x = nn.relu(x)
+        x = jnp.mean(x, axis=(1, 2))
+        x = nn.Dense(features=self.num_classes)(x)
+        if self.output == "log_softmax":
+            return nn.log_softmax(x)
+        if self.output == "softmax":
+            return nn.softmax(x)
+        return x
+
+
+def _resnet(architecture, block):
+    def build(output_layer, num_classes=1000, remat_policy="none", pretrained=None):
+        assert (
+            remat_policy == "none" or output_layer != "activations"
+        ), "activations are not returned from rematerialized blocks"
+        return fm.resnet.ResNet(
+            output=output_layer,
+            pretrained=pretrained,
+            architecture=architecture,
+            num_classes=num_classes,
+            block=remat_block(block, remat_policy),
+        )
+
+    return build
+
+
+def _vgg(constructor):
+    def build(output_layer, num_classes=1000, remat_policy="none", pretrained=None):
+        assert (
+            remat_policy == "none"
+        ), "rematerialization is only implemented for the resnets"
+        return constructor(
+            output=output_layer,
+            pretrained=pretrained,
+            num_classes=num_classes,
+        )
+
+    return build
+
+
+def _tiny_cnn(output_layer, num_classes=1000, remat_policy="none", pretrained=None):
+    assert pretrained is None, "the tiny cnn has no pretrained weights"
+    return TinyCNN(num_classes=num_classes, output=output_layer)
+
+
+architectures_switch.register("resnet18", _resnet("resnet18", fm.resnet.BasicBlock))
+architectures_switch.register("resnet34", _resnet("resnet34", fm.resnet.BasicBlock))
+architectures_switch.register("resnet50", _resnet("resnet50", fm.resnet.Bottleneck))
+architectures_switch.register(
+    "resnet101", _resnet("resnet101", fm.resnet.Bottleneck)
+)
+architectures_switch.register(
+    "resnet152", _resnet("resnet152", fm.resnet.Bottleneck)
+)
+architectures_switch.register("vgg16", _vgg(fm.VGG16))
+architectures_switch.register("vgg19", _vgg(fm.VGG19))
+architectures_switch.register("tiny_cnn", _tiny_cnn)
+
+
+def weight_store_paths(weights_dir, architecture, num_classes):
+    name = f"{architecture}_{num_classes}"
+    return (
+        os.path.join(weights_dir, f"{name}.weights"),
+        os.path.join(weights_dir, f"{name}.json"),
+    )
+
+
+def _sha256(buffer):
+    return hashlib.sha256(memoryview(np.ascontiguousarray(buffer)).cast("B")).hexdigest()
+
+
+def save_weight_store(weights_dir, architecture, num_classes, params):
+    """
+    writes params as one flat file of aligned raw arrays and a json manifest
+    with the path, dtype, shape, offset and sha256 of every array. both files
+    are moved in place at the end, the manifest last, so concurrent tasks
+    never see a partially written store.
+    """
+    weights_path, manifest_path = weight_store_paths(
+        weights_dir, architecture, num_classes
+    )
+    os.makedirs(weights_dir, exist_ok=True)
+    arrays = []
+    offset = 0
+    with tempfile.NamedTemporaryFile(dir=weights_dir, delete=False) as file:
+        for path, value in traverse_util.flatten_dict(params).items():
+            value = np.ascontiguousarray(value)
+            padding = -offset % weight_store_alignment
+            file.write(b"\0" * padding)
+            offset += padding
+            file.write(value.tobytes())
+            arrays.append(
+                {
+                    "path": list(path),
+                    "dtype": str(value.dtype),
+                    "shape": list(value.shape),
+                    "offset": offset,
+                    "sha256": _sha256(value),
+                }
+            )
+            offset += value.nbytes
+    os.chmod(file.name, 0o644)  # temporary files are private
+    os.replace(file.name, weights_path)
+    manifest = {
+        "architecture": architecture,
+        "num_classes": num_classes,
+        "size": offset,
+        "arrays": arrays,
+    }
+    with tempfile.NamedTemporaryFile("w", dir=weights_dir, delete=False) as file:
+        json.dump(manifest, file)
+    os.chmod(file.name, 0o644)
+    os.replace(file.name, manifest_path)
+    logger.info(f"wrote the weights of {architecture} to {weights_path}")
+
+
+def load_weight_store(weights_dir, architecture, num_classes, verify=True):
+    """
+    memory maps a weight store and copies every array straight to the device.
+    the pages of the flat file are shared by all processes of a node.
+    """
+    weights_path, manifest_path = weight_store_paths(
+        weights_dir, architecture, num_classes
+    )
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    weights = np.memmap(weights_path, dtype=np.uint8, mode="r")
+    assert weights.size == manifest["size"], (
+        f"{weights_path} has {weights.size} bytes, "
+        f"its manifest expects {manifest['size']}"
     )
-    params = resnet50.init(
+    flat_params = {}
+    for array in manifest["arrays"]:
+        dtype = np.dtype(array["dtype"])
+        count = int(np.prod(array["shape"]))
+        value = np.frombuffer(
+            weights, dtype=dtype, count=count, offset=array["offset"]
+        ).reshape(array["shape"])
+        if verify and _sha256(value) != array["sha256"]:
+            raise ValueError(
+                f"checksum of {'/'.join(array['path'])} in {weights_path} does "
+                "not match its manifest, convert the weights again"
+            )
+        flat_params[tuple(array["path"])] = jax.device_put(value)
+    return traverse_util.unflatten_dict(flat_params)
+
+
+def init_params(architecture, input_shape, num_classes=1000):
+    """
+    initializes the parameters of an architecture, pretrained architectures
+    are loaded (and downloaded if necessary) by flaxmodels.
+    """
+    pretrained = None if architecture == "tiny_cnn" else "imagenet"
+    model = architectures_switch[architecture]("logits", num_classes, pretrained=pretrained)
+    return model.init(
         jax.random.PRNGKey(0),
-        jnp.empty(args.input_shape, dtype=jnp.float32),
+        jnp.empty(input_shape, dtype=jnp.float32),
     )
-    resnet50_forward = partial(
-        resnet50.apply,
-        params,
-        train=False,
+
+
+def convert_weights(architecture, input_shape, num_classes, weights_dir):
+    """
+    one time conversion of the flaxmodels checkpoint of an architecture to a
+    weight store, needs network access if the checkpoint is not downloaded.
+    """
+    params = init_params(architecture, input_shape, num_classes)
+    save_weight_store(weights_dir, architecture, num_classes, params)
+    # read back to make sure the store is complete
+    load_weight_store(weights_dir, architecture, num_classes)
+
+
+def load_params(architecture, input_shape, num_classes=1000, weights_dir=None):
+    """
+    returns the (pretrained) parameters of an architecture. they are loaded
+    once per process and, with weights_dir, from the weight store which is
+    written on first use.
+    """
+    key = (architecture, num_classes)
+    if key in _params_cache:
+        return _params_cache[key]
+
+    if weights_dir is None:
+        params = jax.device_put(init_params(architecture, input_shape, num_classes))
+    else:
+        _, manifest_path = weight_store_paths(weights_dir, architecture, num_classes)
+        if not os.path.exists(manifest_path):
+            logger.warning(
+                f"no weight store of {architecture} in {weights_dir}, converting "
+                "the flaxmodels checkpoint (use --action convert_weights ahead "
+                "of time on nodes without network)"
+            )
+            convert_weights(architecture, input_shape, num_classes, weights_dir)
+        logger.debug(f"loading the parameters of {architecture} from {weights_dir}")
+        params = load_weight_store(weights_dir, architecture, num_classes)
+
+    _params_cache[key] = params
+    return params
+
+
+def get_forward(
+    architecture,
+    output_layer,
+    input_shape,
+    num_classes=1000,
+    remat_policy="none",
+    weights_dir=None,
+):
+    """
+    returns the jitted forward of an architecture. forwards are shared between
+    calls with the same architecture, output_layer and remat_policy so tasks of
+    a sweep neither reload the weights nor retrace the model.
+    """
+    key = (architecture, output_layer, num_classes, remat_policy)
+    if key in _forward_cache:
+        return _forward_cache[key]
+
+    params = load_params(architecture, input_shape, num_classes, weights_dir)
+    # pretrained weights are already in params, the model does not load them
+    model = architectures_switch[architecture](
+        output_layer, num_classes, remat_policy, pretrained=None
+    )
+    forward = jax.jit(partial(model.apply, params, train=False))
+    _forward_cache[key] = forward
+    return forward
+
+
+def init_forward(architecture, args):
+    forward = get_forward(
+        architecture,
+        args.output_layer,
+        args.input_shape,
+        args.num_classes,
+        args.remat_policy,
+        args.weights_dir,
     )
     if hasattr(args, "forward"):
         assert isinstance(
             args.forward, list
         ), f"forward must be a list recieved {type(args.forward)}"
-        args.forward.append(resnet50_forward)
+        args.forward.append(forward)
     else:
-        args.forward = [resnet50_forward]
+        args.forward = [forward]
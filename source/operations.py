@@ -1,28 +1,106 @@
+from collections import namedtuple
 import functools
+import re
 import time
 from typing import Any, Dict, List, Callable, Tuple
 import jax.numpy as jnp
 import jax
 import numpy as np
 import logging
-from source.utils import Stream, StreamNames, Statistics, AbstractFunction
+from source.utils import (
+    Stream,
+    StreamNames,
+    Statistics,
+    AbstractFunction,
+    PhaseTimer,
+    reduced_stream_sources,
+)
 
 logger = logging.getLogger(__name__)
 
 
+# weighted sum of the log probs at `indices`, equivalent to a dense
+# (num_classes, 1) projection with `weights` at `indices` and zero elsewhere.
+SparseProjection = namedtuple("SparseProjection", ["indices", "weights"])
+# a class drawn from `indices` with probabilities `probs` for every sample
+CategoricalProjection = namedtuple("CategoricalProjection", ["indices", "probs"])
+
+
+def project(log_prob, projection):
+    """
+    projects log_prob (..., num_classes) to (..., 1). the implementation is
+    chosen at trace time from the type of the projection:
+        integer array of class indices: gather and sum
+        SparseProjection: gather and weighted sum
+        float (num_classes, 1) matrix: dense matmul
+    """
+    if isinstance(projection, SparseProjection):
+        gathered = jnp.take(log_prob, projection.indices, axis=-1)
+        return (gathered * projection.weights).sum(axis=-1, keepdims=True)
+    projection = jnp.asarray(projection)
+    if jnp.issubdtype(projection.dtype, jnp.integer):
+        gathered = jnp.take(log_prob, projection.reshape(-1), axis=-1)
+        return gathered.sum(axis=-1, keepdims=True)
+    return log_prob @ projection
+
+
+def dense_projection(projection, num_classes):
+    """
+    returns the (num_classes, 1) matrix of any projection e.g. for saving.
+    """
+    if isinstance(projection, SparseProjection):
+        indices, weights = projection
+    else:
+        projection = jnp.asarray(projection)
+        if not jnp.issubdtype(projection.dtype, jnp.integer):
+            return projection
+        indices = projection.reshape(-1)
+        weights = jnp.ones(indices.shape, dtype=jnp.float32)
+    return (
+        jnp.zeros(shape=(num_classes, 1), dtype=jnp.float32)
+        .at[indices, 0]
+        .add(weights)
+    )
+
+
 def static_projection(*, num_classes, index):
-    projection = jnp.zeros(
-        shape=(num_classes, 1),
-        dtype=jnp.float32,
+    """
+    sparse projection with unit weights on the class(es) at index.
+    """
+    indices = jnp.atleast_1d(jnp.asarray(index, dtype=jnp.int32))
+    if not isinstance(indices, jax.core.Tracer):
+        assert (
+            (0 <= indices) & (indices < num_classes)
+        ).all(), f"projection index {index} is out of range for {num_classes} classes"
+    return SparseProjection(
+        indices=indices,
+        weights=jnp.ones(indices.shape, dtype=jnp.float32),
+    )
+
+
+def sample_projection(key, projection: CategoricalProjection):
+    """
+    draws a class of a categorical projection. under the vmapped sampler
+    the draws of all samples of a batch become a single batched draw.
+
+    returns:
+        the drawn class index (an index-gather projection) and its position
+        in projection.indices
+    """
+    choice = jax.random.choice(
+        key,
+        projection.indices.shape[0],
+        p=projection.probs,
     )
-    projection = projection.at[index, 0].set(1.0)
-    return projection
+    return projection.indices[choice], choice
 
 
 def topk_uniform_projection(*, forward, image, k):
     log_probs = forward(image)
 
-    uptok_max = jnp.argpartition(log_probs.squeeze(), -k)[-k:]
+    # descending, unlike argpartition the order of the classes is defined
+    # so the first one is the top-1 prediction
+    uptok_max = jnp.argsort(-log_probs.squeeze())[:k]
     projection = static_projection(
         num_classes=log_probs.shape[1],
         index=uptok_max,
@@ -31,28 +109,64 @@ def topk_uniform_projection(*, forward, image, k):
     return [int(k) for k in uptok_max], projection
 
 
-def onehot_categorical(key, *, num_classes, indices):
-    sparse = jax.random.choice(key, indices, shape=(1,))
-    return static_projection(num_classes=num_classes, index=sparse)
-
-
 def topk_static_projection(*, forward, image, k):
     log_probs = forward(image)
     k_max = jnp.argpartition(log_probs.squeeze(), -k)[-k]
     return k_max, static_projection(num_classes=log_probs.shape[1], index=k_max)
 
 
+def projection_from_top_k(*, distribution, top_k_classes, num_classes):
+    """
+    the projection of a prediction distribution on precomputed top k classes
+    in descending order, same as the topk_*_projection functions.
+    """
+    k = len(top_k_classes)
+    if distribution == "categorical":
+        return top_k_classes, CategoricalProjection(
+            indices=jnp.asarray(top_k_classes, dtype=jnp.int32),
+            probs=jnp.full((k,), 1 / k, dtype=jnp.float32),
+        )
+    if distribution == "delta":
+        k_max = top_k_classes[-1]
+        return k_max, static_projection(num_classes=num_classes, index=k_max)
+    if distribution == "uniform":
+        return top_k_classes, static_projection(
+            num_classes=num_classes, index=top_k_classes
+        )
+    raise NotImplementedError(f"{distribution} projections are not implemented")
+
+
 def topk_categorical_random_projection(*, forward, image, k):
     log_probs = forward(image)
-    uptok_max = jnp.argpartition(log_probs.squeeze(), -k)[-k:]
+    uptok_max = jnp.argsort(-log_probs.squeeze())[:k]  # descending
 
-    return [int(k) for k in uptok_max], functools.partial(
-        onehot_categorical,
-        num_classes=log_probs.shape[1],
-        indices=uptok_max,
+    return [int(k) for k in uptok_max], CategoricalProjection(
+        indices=uptok_max.astype(jnp.int32),
+        probs=jnp.full((k,), 1 / k, dtype=jnp.float32),
     )
 
 
+def update_per_class_mean(mean, count, batch, choice):
+    """
+    running mean of the samples conditioned on the class drawn for them.
+
+    args:
+        mean: (k, ...) conditional means
+        count: (k,) number of samples seen per class
+        batch: (B, ...) samples
+        choice: (B,) position of the class drawn for every sample
+    """
+    batch = batch.reshape(batch.shape[0], *mean.shape[1:])
+    onehot = jax.nn.one_hot(choice, mean.shape[0], dtype=batch.dtype)
+    batch_count = onehot.sum(axis=0)
+    batch_sum = jnp.einsum("bk,b...->k...", onehot, batch)
+    new_count = count + batch_count
+    batch_count = batch_count.reshape(-1, *(1,) * (mean.ndim - 1))
+    denominator = jnp.maximum(new_count, 1).reshape(batch_count.shape)
+    mean = mean + (batch_sum - batch_count * mean) / denominator
+    return mean, new_count
+
+
 def resize_mask(
     *,
     source_mask: str,
@@ -126,122 +240,412 @@ def linear_combination_mask(
     return alpha_source_mask * source_mask + alpha_target_mask * target_mask
 
 
+@jax.tree_util.register_pytree_node_class
+class StatsCarry:
+    """
+    while_loop carry with a fixed array slot per stream (Stream key). the
+    slots of a buffer are stacked along a leading axis, with `pack` all
+    streams of the same shape and dtype share one buffer so that their
+    updates are written by a single fused kernel. the layout of the buffers
+    is static (pytree aux data) and only arrays are carried.
+    """
+
+    def __init__(self, layout, buffers, batch_index, monitored_change) -> None:
+        self.layout = layout  # tuple of the Stream keys of every buffer
+        self.buffers = buffers
+        self.batch_index = batch_index
+        self.monitored_change = monitored_change
+
+    @classmethod
+    def from_stats(cls, stats: Dict[Stream, jax.Array], pack=True):
+        groups = {}
+        for key, value in stats.items():
+            value = jnp.asarray(value)
+            group = (value.shape, value.dtype) if pack else key
+            groups.setdefault(group, []).append((key, value))
+        layout = tuple(tuple(key for key, _ in group) for group in groups.values())
+        buffers = tuple(
+            jnp.stack([value for _, value in group]) for group in groups.values()
+        )
+        return cls(
+            layout,
+            buffers,
+            batch_index=jnp.zeros(shape=(), dtype=jnp.int32),
+            monitored_change=jnp.full(shape=(), fill_value=jnp.inf, dtype=jnp.float32),
+        )
+
+    def _slot(self, key):
+        for buffer_index, keys in enumerate(self.layout):
+            if key in keys:
+                return buffer_index, keys.index(key)
+        raise KeyError(f"{key} is not a slot of the stats carry")
+
+    def __getitem__(self, key: Stream):
+        buffer_index, slot_index = self._slot(key)
+        return self.buffers[buffer_index][slot_index]
+
+    def __contains__(self, key: Stream):
+        return any(key in keys for keys in self.layout)
+
+    def keys(self):
+        return [key for keys in self.layout for key in keys]
+
+    def replace(self, new_values, **fields):
+        """
+        returns a carry with the slots in new_values (Stream -> array) and the
+        scalar fields (batch_index, monitored_change) replaced.
+        """
+        buffers = list(self.buffers)
+        for key, value in new_values.items():
+            buffer_index, slot_index = self._slot(key)
+            # dynamic update slices of a carried buffer are done in place
+            buffers[buffer_index] = buffers[buffer_index].at[slot_index].set(value)
+        fields = {
+            "batch_index": self.batch_index,
+            "monitored_change": self.monitored_change,
+            **fields,
+        }
+        return StatsCarry(self.layout, tuple(buffers), **fields)
+
+    def to_dict(self):
+        return {
+            key: buffer[slot_index]
+            for keys, buffer in zip(self.layout, self.buffers)
+            for slot_index, key in enumerate(keys)
+        }
+
+    def tree_flatten(self):
+        return (self.buffers, self.batch_index, self.monitored_change), self.layout
+
+    @classmethod
+    def tree_unflatten(cls, layout, children):
+        return cls(layout, *children)
+
+
 def gather_stats(sampler, dynamic_kwargs, meta_kwargs):
+    return _run_gather_stats(sampler, dynamic_kwargs, meta_kwargs)[0]
+
+
+def gather_group_stats(sampler, dynamic_kwargs, group_meta_kwargs):
+    """
+    gathers the stats of a group of tasks that only differ in their dynamic
+    args, stacked along a leading axis of dynamic_kwargs, in one vmapped loop.
+    a member whose stats converged stops updating while the others continue
+    (vmap of the while_loop), so every member gets the stats it would get on
+    its own. returns a list of (stats, metadata) per member.
+    """
+    if len(group_meta_kwargs) == 1:
+        return [gather_stats(sampler, dynamic_kwargs, group_meta_kwargs[0])]
+    return _run_gather_stats(
+        sampler,
+        dynamic_kwargs,
+        group_meta_kwargs[0],
+        group_meta_kwargs=group_meta_kwargs,
+    )
+
+
+def _run_gather_stats(
+    sampler, dynamic_kwargs, meta_kwargs, group_meta_kwargs=None
+):
+    timer = PhaseTimer()
     start = time.time()
+    with timer.phase("trace"):
+        lowered_loop, loop_initials, loop_args = lower_gather_stats(
+            sampler, dynamic_kwargs, meta_kwargs, group_meta_kwargs
+        )
+    with timer.phase("compile"):
+        compiled_loop = lowered_loop.compile()
+    report = memory_report(compiled_loop, loop_initials)
+    with timer.phase("execute"):
+        stats = compiled_loop(loop_initials, *loop_args)
+        stats = jax.block_until_ready(stats)
+    end = time.time()
+
+    members = [stats]
+    if group_meta_kwargs is not None:
+        group_size = len(group_meta_kwargs)
+        members = [
+            jax.tree_util.tree_map(lambda x: x[index], stats)
+            for index in range(group_size)
+        ]
+        report["group_size"] = group_size
+
+    results = []
+    for member in members:
+        # post processing stats dependent metadata
+        metadata = {}
+        metadata["time_to_compute"] = end - start
+        metadata.update(timer.timings)
+        metadata["batch_index"] = int(member.batch_index)
+        metadata["monitored_statistic_change"] = float(member.monitored_change)
+        metadata.update(report)
+        results.append((member.to_dict(), metadata))
+    return results
+
+
+def lower_gather_stats(
+    sampler, dynamic_kwargs, meta_kwargs, group_meta_kwargs=None
+):
+    """
+    traces the gather_stats loop and returns it lowered together with its
+    initial carry and the loop constants (root key and dynamic args) it is
+    called with. with group_meta_kwargs the dynamic args are stacked along a
+    leading axis and the loop is vmapped over the members of the group.
+    """
+    member_kwargs = dynamic_kwargs
+    if group_meta_kwargs is not None:
+        member_kwargs = jax.tree_util.tree_map(lambda x: x[0], dynamic_kwargs)
     (
         loop_initials,
+        _,
         concrete_stopping_condition,
         concrete_sample_and_update,
-    ) = init_loop(sampler, dynamic_kwargs, meta_kwargs)
-    stats = jax.lax.while_loop(
-        cond_fun=concrete_stopping_condition,
-        body_fun=concrete_sample_and_update,
-        init_val=loop_initials,
+    ) = init_loop(sampler, member_kwargs, meta_kwargs)
+    dynamic_args = tuple(dynamic_kwargs.values())
+    root_key = task_root_key(
+        meta_kwargs["seed"], meta_kwargs["key_data"], meta_kwargs["prng_impl"]
     )
-    end = time.time()
 
-    # post processing stats dependent metadata
-    batch_index_key = meta_kwargs["batch_index_key"]
-    monitored_statistic_key = meta_kwargs["monitored_statistic_key"]
-    metadata = {}
-    metadata["time_to_compute"] = end - start
-    metadata["batch_index"] = stats[batch_index_key]
-    metadata["monitored_statistic_change"] = float(stats[monitored_statistic_key])
+    def loop(init_val, root_key, dynamic_args):
+        # the root key and dynamic args are loop constants, only the stats are carried
+        return jax.lax.while_loop(
+            cond_fun=concrete_stopping_condition,
+            body_fun=lambda stats: concrete_sample_and_update(
+                stats, root_key, dynamic_args
+            ),
+            init_val=init_val,
+        )
+
+    if group_meta_kwargs is not None:
+        group_size = len(group_meta_kwargs)
+        loop_initials = jax.tree_util.tree_map(
+            lambda x: jnp.repeat(x[None], group_size, axis=0), loop_initials
+        )
+        root_key = jnp.stack(
+            [
+                task_root_key(m["seed"], m["key_data"], m["prng_impl"])
+                for m in group_meta_kwargs
+            ]
+        )
+        loop = jax.vmap(loop)
+    loop_args = (root_key, dynamic_args)
+    # the carry is donated so that the statistics are accumulated in place
+    lowered_loop = jax.jit(loop, donate_argnums=0).lower(loop_initials, *loop_args)
+    return lowered_loop, loop_initials, loop_args
+
+
+def aliased_parameters(hlo_text):
+    """
+    returns the (output, parameter) pairs of the input_output_alias of an
+    hlo module i.e. the outputs written into the buffers of a parameter.
+    """
+    header = hlo_text.split("\n", 1)[0]
+    match = re.search(r"input_output_alias=\{(.*?)\}, entry", header)
+    if match is None:
+        return []
+    return re.findall(r"\{([\d,]*)\}: \((\d+)", match.group(1))
 
-    del stats[Stream("dynamic_args", "none")]
-    del stats[batch_index_key]
-    del stats[monitored_statistic_key]
 
-    return stats, metadata
+def memory_report(compiled_loop, loop_initials):
+    """
+    device memory of a compiled gather_stats loop. checks in the hlo that
+    every buffer of the donated carry is updated in place and reports the
+    peak bytes of the program when the backend provides a memory analysis.
+    unlike the peak of the device memory stats, which is the peak of the
+    process so far, this is the peak of the task itself.
+    """
+    carry_leaves = jax.tree_util.tree_leaves(loop_initials)
+    aliased = aliased_parameters(compiled_loop.as_text())
+    report = {
+        "carry_bytes": sum(leaf.nbytes for leaf in carry_leaves),
+        "aliased_carry_buffers": len(aliased),
+    }
+    if len(aliased) < len(carry_leaves):
+        logger.warning(
+            f"only {len(aliased)} of {len(carry_leaves)} carry buffers are "
+            "updated in place, the rest are copied every task"
+        )
+
+    analysis = compiled_loop.memory_analysis()
+    if analysis is not None:
+        report["temp_bytes"] = analysis.temp_size_in_bytes
+        report["peak_program_bytes"] = (
+            analysis.argument_size_in_bytes
+            + analysis.output_size_in_bytes
+            - analysis.alias_size_in_bytes
+            + analysis.temp_size_in_bytes
+        )
+    return report
 
 
 def init_loop(sampler, dynamic_kwargs, meta_kwargs):
     monitored_statistic_key: Stream = meta_kwargs["monitored_statistic_key"]
+    batch_index_key = meta_kwargs["batch_index_key"]
     stats = meta_kwargs["stats"].copy()
     assert monitored_statistic_key.statistic == Statistics.abs_delta
-    assert stats[monitored_statistic_key] == jnp.inf
+    assert stats.pop(monitored_statistic_key) == jnp.inf
+    # the batch index and the monitored change are fields of the carry
+    stats.pop(batch_index_key)
 
-    seed = meta_kwargs["seed"]
     batch_size = meta_kwargs["batch_size"]
     max_batches = meta_kwargs["max_batches"]
     min_change = meta_kwargs["min_change"]
     monitored_statistic_source_key: Stream = meta_kwargs[
         "monitored_statistic_source_key"
     ]
-    batch_index_key = meta_kwargs["batch_index_key"]
 
-    stats[Stream("dynamic_args", "none")] = tuple(dynamic_kwargs.values())
+    dynamic_args = tuple(dynamic_kwargs.values())
+    # carry slots for the demo outputs of the sampler (if any) that are
+    # filled with the first sample of the first batch
+    demo_keys = init_demo_stats(
+        sampler, stats, batch_size, dynamic_args, meta_kwargs["prng_impl"]
+    )
     # concretize abstract stopping condition
     concrete_stopping_condition = stopping_condition(
         max_batches=max_batches,
         min_change=min_change,
-        monitored_statistic_key=monitored_statistic_key,
-        batch_index_key=batch_index_key,
     ).concretize()
 
     # concretize abstract update stats
     static_keys = tuple(
         key
         for key in stats.keys()
-        if hasattr(key, "statistic")
-        and key.statistic in (Statistics.meanx, Statistics.meanx2)
+        if key.statistic
+        in (Statistics.meanx, Statistics.meanx2, Statistics.meanx_per_class)
     )
+    # shapes of the streams that are reduced from the sampled batch
+    reduced_stream_shapes = {
+        key.name: stats[key].shape
+        for key in static_keys
+        if key.name in reduced_stream_sources
+    }
+
     concrete_update_stats = update_stats(
         stream_static_keys=static_keys,
         monitored_statistic_source_key=monitored_statistic_source_key,
-        monitored_statistic_key=monitored_statistic_key,
     ).concretize()
 
     # concretize abstract sample and update
     concrete_sample_and_update_stats = sample_and_update_stats(
-        seed=seed,
         batch_size=batch_size,
         sampler=sampler,
         concrete_update_stats=concrete_update_stats,
-        batch_index_key=batch_index_key,
+        reduced_stream_shapes=reduced_stream_shapes,
+        demo_keys=demo_keys,
     ).concretize()
 
-    return stats, concrete_stopping_condition, concrete_sample_and_update_stats
+    # stacking allocates fresh buffers for the carry, the arrays of
+    # meta_kwargs["stats"] are shared between tasks and must not be donated
+    stats = StatsCarry.from_stats(stats, pack=meta_kwargs["pack_streams"])
+    return (
+        stats,
+        dynamic_args,
+        concrete_stopping_condition,
+        concrete_sample_and_update_stats,
+    )
 
 
 @AbstractFunction
 def sample_and_update_stats(
-    stats,
+    stats: StatsCarry,
+    root_key,
+    dynamic_args,
     *,
-    seed,
     batch_size,
     sampler,
     concrete_update_stats,
-    batch_index_key,
+    reduced_stream_shapes,
+    demo_keys,
 ):
-    batch_index = stats[batch_index_key]  # lookup
-    batch_index += 1
+    batch_index = stats.batch_index + 1
+
+    batch_keys = jax.random.split(
+        jax.random.fold_in(root_key, batch_index), num=batch_size
+    )
+
+    sampled_batch = sampler(batch_keys, *dynamic_args)
+    demo = sampled_batch.pop(StreamNames.demo, {})
+    if demo_keys:
+        # the first sample of the first batch is written into the demo slots,
+        # the other iterations pass the carry through
+        stats = jax.lax.cond(
+            batch_index == 1,
+            lambda stats: stats.replace({key: demo[key][0] for key in demo_keys}),
+            lambda stats: stats,
+            stats,
+        )
+    sampled_batch = reduce_streams(sampled_batch, reduced_stream_shapes)
+    return concrete_update_stats(sampled_batch, stats, batch_index)
+
+
+def task_root_key(seed, key_data, prng_impl="threefry2x32"):
+    """
+    the key every random stream of a task is derived from by fold_in, first
+    with the batch index, then the sample (split) and last the KeyStreams
+    name. tasks with the same seed and key_data share their random streams.
+    it is created once per task, the loop only folds in and splits it.
+    """
+    key = jax.random.key(seed, impl=prng_impl)
+    for data in key_data:
+        key = jax.random.fold_in(key, data)
+    return key
+
+
+def stream_key(key, key_stream):
+    """
+    the key of a named random stream (KeyStreams) of a sample.
+    """
+    return jax.random.fold_in(key, key_stream)
+
+
+def init_demo_stats(sampler, stats, batch_size, dynamic_args, prng_impl):
+    """
+    adds zero initialized slots to stats for the demo outputs of the sampler
+    and returns their keys. shapes are inferred without compiling the sampler.
+    """
+    batch_keys = jax.eval_shape(
+        lambda: jax.random.split(jax.random.key(0, impl=prng_impl), batch_size)
+    )
+    sampled_batch = jax.eval_shape(sampler, batch_keys, *dynamic_args)
+    demo = sampled_batch.get(StreamNames.demo, {})
+    for key, value in demo.items():
+        stats[key] = jnp.zeros(shape=value.shape[1:], dtype=value.dtype)
+    return tuple(demo.keys())
+
 
-    key = jax.random.PRNGKey(seed + batch_index)
-    batch_keys = jax.random.split(key, num=batch_size)
+def squared_stream_name(name):
+    """
+    name of the squared samples of a stream in a sampled batch, used by
+    meanx2 instead of squaring the samples when present.
+    """
+    return f"{name}_squared"
 
-    sampled_batch = sampler(
-        batch_keys, *stats[Stream("dynamic_args", "none")]
-    )  # lookup
-    stats = concrete_update_stats(sampled_batch, stats, batch_index)
-    stats[batch_index_key] = batch_index
-    return stats
+
+def reduce_streams(sampled_batch, reduced_stream_shapes):
+    """
+    adds the reduced streams to the sampled batch by resizing every sample of
+    their source streams to the (1, H, W, C) shape of the reduced stream.
+    since resizing is linear, meanx of a reduced stream equals the resized
+    meanx of its source stream. the squared source samples are resized too
+    so that meanx2 of a reduced stream equals the resized meanx2 of its source.
+    """
+    for name, shape in reduced_stream_shapes.items():
+        resize = jax.vmap(lambda mask: resize_mask(source_mask=mask, shape=shape))
+        source = sampled_batch[reduced_stream_sources[name]]
+        sampled_batch[name] = resize(source)
+        sampled_batch[squared_stream_name(name)] = resize(source**2)
+    return sampled_batch
 
 
 @AbstractFunction
 def stopping_condition(
-    stats,
+    stats: StatsCarry,
     *,
     max_batches,
     min_change,
-    monitored_statistic_key: Stream,
-    batch_index_key,
 ):
-    change = stats[monitored_statistic_key]  # lookup
-    batch_index = stats[batch_index_key]  # lookup
-
-    value_condition = change > min_change
-    iteration_condition = batch_index < max_batches
+    value_condition = stats.monitored_change > min_change
+    iteration_condition = stats.batch_index < max_batches
 
     return value_condition & iteration_condition
 
@@ -249,27 +653,40 @@ def stopping_condition(
 @AbstractFunction
 def update_stats(
     sampled_batch: Dict[StreamNames, jax.Array],
-    stats: Dict[Stream, jax.Array],
+    stats: StatsCarry,
     batch_index: int,
     *,
     stream_static_keys: Tuple[Stream],
     monitored_statistic_source_key: Stream,
-    monitored_statistic_key: Stream,
 ):
-    monitored_statistic_old = stats[monitored_statistic_source_key]  # lookup
+    new_values = {}
     for key in stream_static_keys:
         if key.statistic == Statistics.meanx:
-            stats[key] = (1 / batch_index) * sampled_batch[key.name].mean(axis=0) + (
-                (batch_index - 1) / batch_index
-            ) * stats[key]
-        elif key.statistic == Statistics.meanx2:
-            stats[key] = (1 / batch_index) * (sampled_batch[key.name] ** 2).mean(
+            new_values[key] = (1 / batch_index) * sampled_batch[key.name].mean(
                 axis=0
             ) + ((batch_index - 1) / batch_index) * stats[key]
-
-    monitored_statistic_new = stats[monitored_statistic_source_key]  # lookup
-
-    stats[monitored_statistic_key] = jnp.abs(
-        monitored_statistic_new - monitored_statistic_old
-    ).max()  # lookup
-    return stats
+        elif key.statistic == Statistics.meanx2:
+            squares = sampled_batch.get(squared_stream_name(key.name))
+            if squares is None:
+                squares = sampled_batch[key.name] ** 2
+            new_values[key] = (1 / batch_index) * squares.mean(axis=0) + (
+                (batch_index - 1) / batch_index
+            ) * stats[key]
+        elif key.statistic == Statistics.meanx_per_class:
+            count_key = Stream(key.name, Statistics.count_per_class)
+            new_values[key], new_values[count_key] = update_per_class_mean(
+                stats[key],
+                stats[count_key],
+                sampled_batch[key.name],
+                sampled_batch[StreamNames.projection_choice],
+            )
+
+    monitored_change = jnp.abs(
+        new_values[monitored_statistic_source_key]
+        - stats[monitored_statistic_source_key]
+    ).max()
+    return stats.replace(
+        new_values,
+        batch_index=batch_index,
+        monitored_change=monitored_change,
+    )
@@ -0,0 +1,149 @@
+from functools import lru_cache
+import json
+import logging
+import os
+import sys
+
+import jax
+import numpy as np
+import PIL.Image
+
+sys.path.append(os.getcwd())
+from source.data_manager import list_image_folder, preprocess_numpy
+from source.model_manager import get_forward
+from source.utils import prefetch_batches
+
+logger = logging.getLogger(__name__)
+
+
+def predictions_paths(predictions_dir, architecture, output_layer):
+    """
+    the top-k table (npz) and its summary (json) of an architecture and output
+    layer. the rows of the table are indexed by image_index.
+    """
+    name = f"predictions_{architecture}_{output_layer}"
+    return (
+        os.path.join(predictions_dir, f"{name}.npz"),
+        os.path.join(predictions_dir, f"{name}.json"),
+    )
+
+
+def predict_top_k(
+    forward, load_image, num_images, top_k, batch_size, prefetch_factor, num_workers
+):
+    """
+    streams num_images images (by index) through forward in batches and
+    returns the top_k classes in descending order and their outputs. the last
+    batch is padded so that forward is compiled once.
+    """
+
+    @jax.jit
+    def batched_top_k(images):
+        values, indices = jax.lax.top_k(forward(images), top_k)
+        return indices, values
+
+    top_k_classes = np.empty((num_images, top_k), dtype=np.int16)
+    top_k_values = np.empty((num_images, top_k), dtype=np.float32)
+    start = 0
+    for images in prefetch_batches(
+        load_image, range(num_images), batch_size, prefetch_factor, num_workers
+    ):
+        num_valid = len(images)
+        if num_valid < batch_size:
+            padding = np.zeros((batch_size - num_valid, *images.shape[1:]))
+            images = np.concatenate([images, padding.astype(images.dtype)])
+        indices, values = jax.device_get(batched_top_k(images))
+        top_k_classes[start : start + num_valid] = indices[:num_valid]
+        top_k_values[start : start + num_valid] = values[:num_valid]
+        start += num_valid
+        logger.debug(f"predicted {start}/{num_images} images")
+    return top_k_classes, top_k_values
+
+
+def accuracy(top_k_classes, labels):
+    """top-1 and top-k accuracy of a top-k table."""
+    labels = np.asarray(labels)[:, None]
+    return {
+        "top_1_accuracy": float((top_k_classes[:, :1] == labels).mean()),
+        f"top_{top_k_classes.shape[1]}_accuracy": float(
+            (top_k_classes == labels).any(axis=1).mean()
+        ),
+    }
+
+
+def precompute_predictions(architecture, args):
+    """
+    writes the top-k table of the images of args.dataset_dir (ImageFolder
+    layout) for an architecture and returns its summary with the accuracy.
+    """
+    image_paths, labels = list_image_folder(args.dataset_dir)
+    num_images = len(image_paths)
+    if args.num_images is not None:
+        num_images = min(args.num_images, num_images)
+    forward = get_forward(
+        architecture,
+        args.output_layer,
+        args.input_shape,
+        args.num_classes,
+        weights_dir=args.weights_dir,
+    )
+
+    def load_image(image_index):
+        with PIL.Image.open(image_paths[image_index]) as image:
+            return preprocess_numpy(image, args.input_shape[1])[0]
+
+    top_k_classes, top_k_values = predict_top_k(
+        forward,
+        load_image,
+        num_images,
+        args.top_k,
+        args.batch_size,
+        args.prefetch_factor,
+        args.num_workers,
+    )
+    labels = np.asarray(labels[:num_images], dtype=np.int16)
+    summary = {
+        "architecture": architecture,
+        "output_layer": args.output_layer,
+        "dataset_dir": args.dataset_dir,
+        "num_images": num_images,
+        "top_k": args.top_k,
+        **accuracy(top_k_classes, labels),
+    }
+
+    os.makedirs(args.predictions_dir, exist_ok=True)
+    table_path, summary_path = predictions_paths(
+        args.predictions_dir, architecture, args.output_layer
+    )
+    np.savez(
+        table_path,
+        top_k_classes=top_k_classes,
+        top_k_values=top_k_values,
+        labels=labels,
+    )
+    with open(summary_path, "w") as file:
+        json.dump(summary, file, indent=2)
+    logger.info(f"saved the predictions of {architecture} to {table_path}")
+    logger.info(f"accuracy of {architecture}: {summary}")
+    return summary
+
+
+@lru_cache(maxsize=None)
+def load_predictions(table_path):
+    with np.load(table_path) as table:
+        return {k: table[k] for k in table.files}
+
+
+def lookup_top_k(predictions_dir, architecture, output_layer, image_index, k):
+    """
+    the precomputed top k classes of an image in descending order.
+    """
+    table_path, _ = predictions_paths(predictions_dir, architecture, output_layer)
+    top_k_classes = load_predictions(table_path)["top_k_classes"]
+    assert image_index < len(
+        top_k_classes
+    ), f"image {image_index} is not in the {len(top_k_classes)} predictions of {table_path}"
+    assert (
+        k <= top_k_classes.shape[1]
+    ), f"top {k} requested but only the top {top_k_classes.shape[1]} are in {table_path}"
+    return [int(c) for c in top_k_classes[image_index, :k]]
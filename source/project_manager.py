@@ -1,9 +1,9 @@
+import ast
 import numpy as np
 import pandas as pd
 from glob import glob
 import os
 
-import tensorflow as tf
 import logging
 
 logger = logging.getLogger(__name__)
@@ -36,7 +36,16 @@ def load_experiment_metadata(save_metadata_dir, glob_path: str = "*.csv"):
     ), f"Could not find any metadata files in {glob_path}"
 
     metadata_path = metadata_paths_merged[0]
-    return pd.read_csv(metadata_path, index_col=False)
+    metadata = pd.read_csv(metadata_path, index_col=False)
+    if "projection_classes" in metadata.columns:
+        # the top k classes of uniform and categorical projections, their
+        # projection_index is the top-1 class
+        metadata["projection_classes"] = metadata["projection_classes"].apply(
+            lambda classes: ast.literal_eval(classes)
+            if isinstance(classes, str)
+            else classes
+        )
+    return metadata
 
 
 def load_experiment_inconsistency(save_metadata_dir, glob_path: str = "*.csv"):
@@ -51,6 +60,22 @@ def load_experiment_inconsistency(save_metadata_dir, glob_path: str = "*.csv"):
     return pd.read_csv(metadata_path, index_col=False)
 
 
+def load_experiment_pairwise_inconsistency(
+    save_metadata_dir, glob_path: str = "inconsistency_*.pairwise.npy"
+):
+    glob_path = os.path.join(save_metadata_dir, glob_path)
+    pairwise_paths = glob(glob_path)
+    assert (
+        len(pairwise_paths) == 1
+    ), f"Could not find a unique pairwise inconsistency file in {glob_path}"
+
+    pairwise_path = pairwise_paths[0]
+    pivot_values_path = pairwise_path.replace(".pairwise.npy", ".pivot_values.npy")
+    # rows are aligned with the rows of the inconsistency csv file
+    pairwise_inconsistency = np.load(pairwise_path, mmap_mode="r")
+    return pairwise_inconsistency, np.load(pivot_values_path, allow_pickle=True)
+
+
 def merge_experiment_metadata(save_metadata_dir: str):
     glob_path: str = "*.csv"
     metadata_glob_path = os.path.join(save_metadata_dir, glob_path)
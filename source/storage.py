@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+from source.utils import Switch
+
+logger = logging.getLogger(__name__)
+
+
+class StorageCodecs:
+    npy = "npy"  # raw float32, readable with np.load
+    lossless = "lossless"
+    float16 = "float16"
+    int8 = "int8"
+
+
+class Compressors:
+    zlib = "zlib"
+    zstd = "zstd"  # requires the optional zstandard package
+
+
+compressors_switch = Switch()
+codecs_switch = Switch()
+
+# extension of the files written by the compressed codecs
+compressed_extension = ".npz"
+chunk_size = 1 << 20  # bytes of a compressed chunk
+
+
+class _Zlib:
+    level = 6
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class _Zstd:
+    level = 3
+
+    def __init__(self) -> None:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError(
+                "the zstd compressor requires the zstandard package, "
+                "install it or use the zlib compressor."
+            ) from e
+        self.compressor = zstandard.ZstdCompressor(level=self.level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+
+compressors_switch.register(Compressors.zlib, _Zlib())
+compressors_switch.register_lazy(Compressors.zstd, _Zstd)
+
+
+def byte_shuffle(x: np.ndarray) -> bytes:
+    """
+    groups the i-th bytes of all elements together. neighbouring values of
+    smooth maps share their high order bytes which then compress well.
+    """
+    x = np.ascontiguousarray(x)
+    return x.view(np.uint8).reshape(-1, x.dtype.itemsize).T.tobytes()
+
+
+def byte_unshuffle(data: bytes, dtype, shape) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    x = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1).T
+    return np.ascontiguousarray(x).view(dtype).reshape(shape)
+
+
+def _compress_chunks(data: bytes, compressor):
+    chunks = [
+        compressor.compress(data[start : start + chunk_size])
+        for start in range(0, len(data), chunk_size)
+    ]
+    chunk_lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+    return np.frombuffer(b"".join(chunks), dtype=np.uint8), chunk_lengths
+
+
+def _decompress_chunks(payload: np.ndarray, chunk_lengths, compressor) -> bytes:
+    offsets = np.concatenate([[0], np.cumsum(chunk_lengths)])
+    payload = payload.tobytes()
+    return b"".join(
+        compressor.decompress(payload[start:end])
+        for start, end in zip(offsets[:-1], offsets[1:])
+    )
+
+
+class LosslessCodec:
+    """
+    byte shuffled and chunk-wise compressed arrays in an (uncompressed) npz
+    container. the header records everything needed to decode the array.
+    """
+
+    name = StorageCodecs.lossless
+
+    def quantize(self, x: np.ndarray):
+        return x, {}
+
+    def dequantize(self, q: np.ndarray, header) -> np.ndarray:
+        return q
+
+    def save(self, path_without_extension, x, compressor_name=Compressors.zlib):
+        x = np.asarray(x)
+        q, header = self.quantize(x)
+        header.update(
+            codec=self.name,
+            compressor=compressor_name,
+            shape=list(x.shape),
+            dtype=str(x.dtype),
+            stored_dtype=str(q.dtype),
+        )
+        payload, chunk_lengths = _compress_chunks(
+            byte_shuffle(q),
+            compressors_switch[compressor_name],
+        )
+        path = f"{path_without_extension}{compressed_extension}"
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                header=np.array(json.dumps(header)),
+                payload=payload,
+                chunk_lengths=chunk_lengths,
+            )
+        return path, header
+
+    def load(self, container) -> np.ndarray:
+        header = json.loads(str(container["header"]))
+        data = _decompress_chunks(
+            container["payload"],
+            container["chunk_lengths"],
+            compressors_switch[header["compressor"]],
+        )
+        q = byte_unshuffle(data, header["stored_dtype"], header["shape"])
+        return self.dequantize(q, header).astype(header["dtype"], copy=False)
+
+
+class Float16Codec(LosslessCodec):
+    name = StorageCodecs.float16
+
+    def quantize(self, x: np.ndarray):
+        q = x.astype(np.float16)
+        assert np.isfinite(q).all() or not np.isfinite(x).all(), (
+            "values overflow float16, "
+            f"max abs value is {np.abs(x).max()} use a lossless codec"
+        )
+        max_abs_error = float(np.abs(q.astype(x.dtype) - x).max(initial=0.0))
+        return q, {"max_abs_error": max_abs_error}
+
+
+class Int8Codec(LosslessCodec):
+    """
+    per map affine quantization of [min, max] to 255 levels, the error is
+    bounded by half of the quantization step (`scale / 2`).
+    """
+
+    name = StorageCodecs.int8
+
+    def quantize(self, x: np.ndarray):
+        if x.size == 0:
+            low = high = 0.0
+        else:
+            # the range of the map only, e.g. 0 is outside of it for meanx2
+            low = float(x.min(initial=np.inf))
+            high = float(x.max(initial=-np.inf))
+        offset = (high + low) / 2
+        if high == low:
+            # empty and constant maps are stored exactly by the offset
+            scale = 1.0
+        else:
+            scale = (high - low) / 254
+        q = np.round((x - offset) / scale).astype(np.int8)
+        error = self._dequantize(q, scale, offset) - x
+        max_abs_error = float(np.abs(error).max(initial=0.0))
+        return q, {
+            "scale": scale,
+            "offset": offset,
+            "max_abs_error": max_abs_error,
+            "error_bound": scale / 2,
+        }
+
+    @staticmethod
+    def _dequantize(q, scale, offset):
+        return q.astype(np.float32) * scale + offset
+
+    def dequantize(self, q: np.ndarray, header) -> np.ndarray:
+        return self._dequantize(q, header["scale"], header["offset"])
+
+
+for codec in [LosslessCodec(), Float16Codec(), Int8Codec()]:
+    codecs_switch.register(codec.name, codec)
+
+
+def save_array(
+    path_without_extension,
+    x,
+    storage_codec=StorageCodecs.npy,
+    compressor_name=Compressors.zlib,
+):
+    """
+    saves x with the storage codec and returns the path of the written file
+    and the maximum absolute error introduced by the codec.
+    """
+    if storage_codec == StorageCodecs.npy:
+        path = f"{path_without_extension}.npy"
+        np.save(path, x)
+        return path, 0.0
+    path, header = codecs_switch[storage_codec].save(
+        path_without_extension, x, compressor_name
+    )
+    return path, header.get("max_abs_error", 0.0)
+
+
+def load_array(path, mmap_mode=None) -> np.ndarray:
+    """
+    loads an array written by save_array regardless of the codec.
+    mmap_mode only applies to raw npy files.
+    """
+    if not path.endswith(compressed_extension):
+        return np.load(path, mmap_mode=mmap_mode)
+    with np.load(path) as container:
+        header = json.loads(str(container["header"]))
+        return codecs_switch[header["codec"]].load(container)
+
+
+def load_shape(path):
+    if not path.endswith(compressed_extension):
+        return np.load(path, mmap_mode="r").shape
+    with np.load(path) as container:
+        return tuple(json.loads(str(container["header"]))["shape"])
@@ -0,0 +1,253 @@
+import json
+import logging
+import math
+import os
+import sys
+
+import jax
+
+sys.path.append(os.getcwd())
+from source.operations import gather_group_stats, lower_gather_stats, memory_report
+
+logger = logging.getLogger(__name__)
+
+gibibyte = 1 << 30
+
+
+def with_batch_size(meta_kwargs, batch_size):
+    """
+    returns a copy of meta_kwargs with batch_size replaced and max_batches
+    rescaled so that the maximum number of samples is preserved.
+    """
+    num_samples = meta_kwargs["batch_size"] * meta_kwargs["max_batches"]
+    return {
+        **meta_kwargs,
+        "batch_size": batch_size,
+        "max_batches": math.ceil(num_samples / batch_size),
+    }
+
+
+def with_group_batch_size(group_meta_kwargs, batch_size):
+    return [
+        with_batch_size(meta_kwargs, batch_size) for meta_kwargs in group_meta_kwargs
+    ]
+
+
+def compiled_peak_bytes(sampler, dynamic_kwargs, group_meta_kwargs):
+    """
+    peak device bytes of the compiled gather_stats loop of a group (vmapped
+    over its members), 0 when the backend does not provide a memory analysis
+    (e.g. cpu).
+    """
+    lowered_loop, loop_initials, _ = lower_gather_stats(
+        sampler,
+        dynamic_kwargs,
+        group_meta_kwargs[0],
+        group_meta_kwargs if len(group_meta_kwargs) > 1 else None,
+    )
+    report = memory_report(lowered_loop.compile(), loop_initials)
+    return report.get("peak_program_bytes", 0)
+
+
+def fit_batch_size(
+    sampler,
+    dynamic_kwargs,
+    group_meta_kwargs,
+    memory_budget,
+    max_batch_size,
+    peak_bytes=compiled_peak_bytes,
+):
+    """
+    returns the largest power of two batch size (up to max_batch_size) whose
+    gather_stats loop of the whole group fits in memory_budget GiB. only
+    compiles, nothing is executed. the batch size of the group is kept if
+    memory can't be measured.
+    """
+    meta_kwargs = group_meta_kwargs[0]
+    budget_bytes = memory_budget * gibibyte
+    batch_size = None
+    candidate = 1
+    while candidate <= max_batch_size:
+        candidate_bytes = peak_bytes(
+            sampler,
+            dynamic_kwargs,
+            with_group_batch_size(group_meta_kwargs, candidate),
+        )
+        if candidate_bytes == 0:
+            logger.warning(
+                "the backend does not report the memory of compiled programs, "
+                f"keeping batch size {meta_kwargs['batch_size']}"
+            )
+            return meta_kwargs["batch_size"]
+        logger.info(
+            f"batch size {candidate} needs {candidate_bytes / gibibyte:.3f} GiB "
+            f"of {memory_budget} GiB"
+        )
+        if candidate_bytes > budget_bytes:
+            break
+        batch_size = candidate
+        candidate *= 2
+
+    assert (
+        batch_size is not None
+    ), f"a single sample does not fit in the memory budget of {memory_budget} GiB"
+    return batch_size
+
+
+def measure_throughput(
+    sampler, dynamic_kwargs, group_meta_kwargs, calibration_batches
+):
+    """
+    runs a short gather_stats loop of calibration_batches batches for the
+    group and returns the samples per second of its execution and the peak
+    bytes of its compiled program (0 when the backend does not report it).
+    """
+    group_meta_kwargs = [
+        {
+            **meta_kwargs,
+            "max_batches": calibration_batches,
+            "min_change": -math.inf,  # never stop early
+        }
+        for meta_kwargs in group_meta_kwargs
+    ]
+    results = gather_group_stats(sampler, dynamic_kwargs, group_meta_kwargs)
+    num_samples = sum(
+        metadata["batch_index"] * meta_kwargs["batch_size"]
+        for (_, metadata), meta_kwargs in zip(results, group_meta_kwargs)
+    )
+    # the members of a group share the timings and the memory report
+    metadata = results[0][1]
+    peak_bytes = metadata.get("peak_program_bytes", 0)
+    return num_samples / metadata["time_to_execute"], peak_bytes
+
+
+def _is_out_of_memory(error):
+    return "RESOURCE_EXHAUSTED" in str(error)
+
+
+def tune_batch_size(
+    sampler,
+    dynamic_kwargs,
+    group_meta_kwargs,
+    max_batch_size,
+    calibration_batches,
+    memory_budget=None,
+    measure=measure_throughput,
+):
+    """
+    measures power of two batch sizes of the group in increasing order and
+    returns the one with the highest throughput together with the
+    measurements. stops at the first batch size that is slower than the best
+    one, runs out of memory or exceeds memory_budget (GiB).
+    """
+    measurements = {}
+    best_batch_size = None
+    candidate = 1
+    while candidate <= max_batch_size:
+        try:
+            samples_per_second, peak_bytes = measure(
+                sampler,
+                dynamic_kwargs,
+                with_group_batch_size(group_meta_kwargs, candidate),
+                calibration_batches,
+            )
+        except Exception as error:
+            if not _is_out_of_memory(error):
+                raise
+            logger.info(f"batch size {candidate} ran out of memory")
+            break
+        logger.info(
+            f"batch size {candidate}: {samples_per_second:.2f} samples/s "
+            f"{peak_bytes / gibibyte:.3f} GiB"
+        )
+        if memory_budget and peak_bytes > memory_budget * gibibyte:
+            break
+        measurements[candidate] = {
+            "samples_per_second": samples_per_second,
+            "peak_bytes": peak_bytes,
+        }
+        if (
+            best_batch_size is not None
+            and samples_per_second
+            < measurements[best_batch_size]["samples_per_second"]
+        ):
+            break
+        best_batch_size = candidate
+        candidate *= 2
+
+    assert best_batch_size is not None, "no batch size could be measured"
+    return best_batch_size, measurements
+
+
+def _shape_name(shape):
+    return "x".join(str(d) for d in shape)
+
+
+def tuning_cache_key(group_meta_kwargs, memory_budget=None, remat_policy="none"):
+    """
+    every setting that changes the compiled peak of the gather_stats loop,
+    a cached batch size is only reused when all of them are the same.
+    """
+    meta_kwargs = group_meta_kwargs[0]
+    device_kind = jax.devices()[0].device_kind
+    # the statistics (and their shapes) that are carried by the loop
+    statistics = ",".join(
+        sorted(
+            f"{key.name}.{key.statistic}:{_shape_name(jax.numpy.shape(value))}"
+            for key, value in meta_kwargs["stats"].items()
+        )
+    )
+    return "/".join(
+        [
+            meta_kwargs["architecture"],
+            device_kind,
+            _shape_name(meta_kwargs["input_shape"]),
+            f"group_{len(group_meta_kwargs)}",
+            f"output_layer_{meta_kwargs['output_layer']}",
+            f"remat_{remat_policy}",
+            f"budget_{memory_budget}",
+            f"packed_{meta_kwargs['pack_streams']}",
+            statistics,
+        ]
+    )
+
+
+def cached_tune_batch_size(
+    sampler,
+    dynamic_kwargs,
+    group_meta_kwargs,
+    cache_path,
+    max_batch_size,
+    calibration_batches,
+    memory_budget=None,
+    measure=measure_throughput,
+    remat_policy="none",
+):
+    """
+    tune_batch_size with its decisions cached in a json file per
+    tuning_cache_key, i.e. per (architecture, device kind, input shape) and
+    the other settings that change the compiled peak.
+    """
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as file:
+            cache = json.load(file)
+    key = tuning_cache_key(group_meta_kwargs, memory_budget, remat_policy)
+    if key in cache:
+        logger.info(f"using the cached batch size for {key}")
+        return cache[key]["batch_size"]
+
+    batch_size, measurements = tune_batch_size(
+        sampler,
+        dynamic_kwargs,
+        group_meta_kwargs,
+        max_batch_size,
+        calibration_batches,
+        memory_budget,
+        measure,
+    )
+    cache[key] = {"batch_size": batch_size, "measurements": measurements}
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    with open(cache_path, "w") as file:
+        json.dump(cache, file, indent=2)
+    return batch_size
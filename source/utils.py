@@ -1,9 +1,12 @@
-from collections import namedtuple
+from collections import namedtuple, deque
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import inspect
 from collections import OrderedDict
 import itertools
 import logging
+import time
 
 import numpy as np
 import pandas as pd
@@ -15,6 +18,8 @@ class Action:
     gather_stats = "gather_stats"
     compute_inconsistency = "compute_inconsistency"
     merge_stats = "merge_stats"
+    convert_weights = "convert_weights"
+    precompute_predictions = "precompute_predictions"
 
 
 class InconsistencyMeasures:
@@ -104,7 +109,7 @@ class AbstractFunction:
         return concrete_func
 
 
-def pattern_generator(pattern, values):
+def pattern_generator(pattern, values, innermost=()):
     """
     a pattern is not sensitive to actual values, but to the unique keys e.g.
     {"a": "b", "c": "d"} == {"a": "e", "c": "f"}
@@ -114,24 +119,38 @@ def pattern_generator(pattern, values):
     e.g.
     >>> pattern = {"a": "i", "c": "j"}
     >>> values = {"a": [1, 2], "c": [3, 4]}
-    >>> list(combine_patterns(pattern, values))
+    >>> list(pattern_generator(pattern, values))
     [
         {"a": 1, "c": 3},
         {"a": 1, "c": 4},
         {"a": 2, "c": 3},
         {"a": 2, "c": 4},
     ]
+    innermost is a tuple of pattern values that are iterated fastest, so that
+    consecutive combinations only differ in their args e.g.
+    >>> list(pattern_generator(pattern, values, innermost=("i",)))
+    [
+        {"a": 1, "c": 3},
+        {"a": 2, "c": 3},
+        {"a": 1, "c": 4},
+        {"a": 2, "c": 4},
+    ]
+    the other pattern values keep their (sorted) order.
     """
     pattern_keys = list(pattern.keys())
     pattern_values = list(pattern.values())
+    # values in innermost vary fastest, i.e. consecutive combinations only
+    # differ in the args of the innermost pattern values
+    unique_pattern_values = sorted(
+        set(pattern_values), key=lambda v: (v in innermost, str(v))
+    )
     list_values = [values[k] for k in pattern_keys]
-    unique_pattern_values = list(set(pattern_values))
     comb_index = [pattern_values.index(v) for v in unique_pattern_values]
     len_values = [len(list_values[i]) for i in comb_index]
     range_values = [range(l) for l in len_values]
-    combinations = list(itertools.product(*range_values))
     pattern_index = [unique_pattern_values.index(v) for v in pattern_values]
-    for combination in combinations:
+    # lazily, a sweep can have many combinations
+    for combination in itertools.product(*range_values):
         value_indices = [combination[index] for index in pattern_index]
         temp_values = {k: values[k][i] for i, k in zip(value_indices, pattern_keys)}
         yield temp_values
@@ -143,6 +162,18 @@ class StreamNames:
     results_at_projection = "results_at_projection"
     log_probs = "log_probs"
     image = "image"
+    # reduced resolution and/or channel collapsed version of vanilla_grad_mask
+    vanilla_grad_mask_reduced = "vanilla_grad_mask_reduced"
+    # nested dict of Stream(name, Statistics.none) of a single sample
+    demo = "demo"
+    # per sample position of the class drawn by a categorical projection
+    projection_choice = "projection_choice"
+
+
+# reduced streams are computed inside the loop from their source streams
+reduced_stream_sources = {
+    StreamNames.vanilla_grad_mask_reduced: StreamNames.vanilla_grad_mask,
+}
 
 
 class Statistics:
@@ -150,6 +181,22 @@ class Statistics:
     meanx = "meanx"
     meanx2 = "meanx2"
     abs_delta = "abs_delta"
+    # conditional mean and number of samples per class of a categorical projection
+    meanx_per_class = "meanx_per_class"
+    count_per_class = "count_per_class"
+
+
+class KeyStreams:
+    # independent random streams of a sample, folded into its key
+    baseline_mask = 0
+    alpha_mask = 1
+    projection = 2
+
+
+class KeyPolicies:
+    # random streams of the pivot column values (e.g. alpha_mask_value) of an image
+    shared = "shared"  # common random numbers
+    decorrelated = "decorrelated"
 
 
 Stream = namedtuple("Stream", ["name", "statistic"])
@@ -158,12 +205,92 @@ Stream = namedtuple("Stream", ["name", "statistic"])
 class Switch:
     def __init__(self):
         self.key_values = {}
+        self.lazy_key_values = {}
 
     def register(self, key, value):
         self.key_values[key] = value
 
+    def register_lazy(self, key, loader):
+        """
+        registers a key whose value is created by calling `loader()` on first
+        access, e.g. to defer importing heavy modules until they are needed.
+        """
+        self.lazy_key_values[key] = loader
+
     def __getitem__(self, key):
+        if key not in self.key_values and key in self.lazy_key_values:
+            logger.debug(f"resolving the lazily registered {key}")
+            self.key_values[key] = self.lazy_key_values.pop(key)()
         return self.key_values[key]
 
+    def __contains__(self, key):
+        return key in self.key_values or key in self.lazy_key_values
+
     def __setitem__(self, key, value):
         raise NotImplementedError("switch is read only")
+
+
+class PhaseTimer:
+    """
+    accumulates the wall-clock time of named phases of a task e.g.
+    >>> timer = PhaseTimer()
+    >>> with timer.phase("compile"):
+    ...     compiled = lowered.compile()
+    >>> timer.timings
+    {"time_to_compile": 0.53}
+    asynchronously dispatched jax computations must be blocked on inside
+    the phase, otherwise only the dispatch time is recorded.
+    """
+
+    def __init__(self) -> None:
+        self.timings = {}
+
+    @contextmanager
+    def phase(self, name):
+        key = f"time_to_{name}"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timings[key] = self.timings.get(key, 0.0) + elapsed
+
+
+def stack_samples(samples):
+    """
+    stacks a list of samples with the same (nested dict/tuple) structure
+    into a single batch of numpy arrays.
+    """
+    first = samples[0]
+    if isinstance(first, dict):
+        return {k: stack_samples([sample[k] for sample in samples]) for k in first}
+    if isinstance(first, tuple):
+        return tuple(stack_samples(list(items)) for items in zip(*samples))
+    return np.stack(samples)
+
+
+def prefetch_batches(load_sample, items, batch_size, prefetch_factor, num_workers):
+    """
+    loads samples in a thread pool and yields them in order, stacked into
+    batches of batch_size (the last batch may be smaller). at most
+    prefetch_factor batches are loaded ahead of the consumer.
+
+    args:
+        load_sample: function that loads a sample from an item
+        items: iterable of items, consumed lazily
+    """
+    assert batch_size > 0, f"batch_size must be positive got {batch_size}"
+    items = iter(items)
+    max_pending = batch_size * max(prefetch_factor, 1)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque(
+            executor.submit(load_sample, item)
+            for item in itertools.islice(items, max_pending)
+        )
+        while pending:
+            batch = []
+            while pending and len(batch) < batch_size:
+                batch.append(pending.popleft().result())
+                for item in itertools.islice(items, 1):
+                    pending.append(executor.submit(load_sample, item))
+            yield stack_samples(batch)
@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from source.model_manager import get_forward
+
+
+def init_tiny_cnn_forward(args):
+    tiny_cnn_forward = get_forward(
+        "tiny_cnn",
+        args.output_layer,
+        args.input_shape,
+        args.num_classes,
+    )
+    if hasattr(args, "forward"):
+        assert isinstance(
+            args.forward, list
+        ), f"forward must be a list recieved {type(args.forward)}"
+        args.forward.append(tiny_cnn_forward)
+    else:
+        args.forward = [tiny_cnn_forward]
@@ -0,0 +1,63 @@
+import argparse
+import os
+import sys
+import numpy as np
+import PIL.Image
+
+sys.path.append(os.getcwd())
+from source import data_manager
+
+image_size = 32
+
+
+def _make_image_folder(root, num_labels=3, num_images=4):
+    rng = np.random.default_rng(0)
+    for label in range(num_labels):
+        label_dir = os.path.join(root, "val", f"n{label:08d}")
+        os.makedirs(label_dir)
+        for index in range(num_images):
+            height, width = rng.integers(image_size - 8, 2 * image_size, size=2)
+            image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+            PIL.Image.fromarray(image).save(os.path.join(label_dir, f"{index}.JPEG"))
+    return str(root)
+
+
+def test_image_folder_order_matches_tfds(tmp_path):
+    import tensorflow_datasets as tfds
+
+    dataset_dir = _make_image_folder(tmp_path)
+    image_paths, labels = data_manager.list_image_folder(dataset_dir)
+
+    dataset = tfds.folder_dataset.ImageFolder(root_dir=dataset_dir)
+    dataset = dataset.as_dataset(split="val", shuffle_files=False)
+    for (image_path, label), example in zip(
+        zip(image_paths, labels), dataset.as_numpy_iterator()
+    ):
+        assert image_path == example["image/filename"].decode()
+        assert label == int(example["label"])
+
+
+def test_preprocess_numpy_matches_tensorflow(tmp_path):
+    image = np.random.default_rng(1).integers(0, 256, size=(45, 50, 3), dtype=np.uint8)
+    expected = data_manager.preprocess(image, image_size)
+    result = data_manager.preprocess_numpy(PIL.Image.fromarray(image), image_size)
+    assert result.shape == (1, image_size, image_size, 3)
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, expected, atol=1e-6)
+
+
+def test_query_imagenet_numpy(tmp_path):
+    dataset_dir = _make_image_folder(tmp_path)
+    args = argparse.Namespace(
+        dataset_dir=dataset_dir,
+        input_shape=[1, image_size, image_size, 3],
+        image_index=[0, 5, 11],
+    )
+    data_manager.query_imagenet_numpy(args)
+    image_paths, labels = data_manager.list_image_folder(dataset_dir)
+    assert len(args.image) == 3
+    assert args.label == [labels[0], labels[5], labels[11]]
+    assert args.image_path == [image_paths[0], image_paths[5], image_paths[11]]
+    for image in args.image:
+        assert image.shape == (1, image_size, image_size, 3)
+        assert 0.0 <= image.min() and image.max() <= 1.0
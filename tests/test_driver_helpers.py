@@ -0,0 +1,108 @@
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import pytest
+
+sys.path.append(os.getcwd())
+from source.driver_helpers import BackgroundWriter
+from source.utils import Switch, prefetch_batches
+
+# seconds allowed for importing the driver helpers (pandas and numpy only)
+import_time_budget = 3.0
+heavy_modules = ("jax", "tensorflow", "tensorflow_datasets", "flaxmodels")
+
+
+def _run_python(code):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.getcwd(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip(), time.perf_counter() - start
+
+
+def test_switch_resolves_lazily():
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return "value"
+
+    switch = Switch()
+    switch.register_lazy("key", loader)
+    assert "key" in switch
+    assert calls == []
+    assert switch["key"] == "value"
+    assert switch["key"] == "value"
+    assert calls == [1]
+
+
+def test_driver_helpers_import_budget():
+    code = (
+        "import sys\n"
+        "sys.path.append('.')\n"
+        "import source.driver_helpers\n"
+        f"print(','.join(m for m in {heavy_modules} if m in sys.modules))\n"
+    )
+    loaded, duration = _run_python(code)
+    assert loaded == "", f"driver_helpers loaded heavy modules at import: {loaded}"
+    assert (
+        duration < import_time_budget
+    ), f"importing driver_helpers took {duration:.2f}s > {import_time_budget}s"
+
+
+def test_merge_stats_does_not_load_heavy_modules(tmp_path):
+    code = (
+        "import runpy, sys\n"
+        "sys.argv = ['driver.py', '--action', 'merge_stats',"
+        f" '--save_metadata_dir', '{tmp_path}']\n"
+        "try:\n"
+        "    runpy.run_path('driver.py', run_name='__main__')\n"
+        "except Exception:\n"
+        "    pass  # an empty experiment is fine, only the imports matter\n"
+        f"print(','.join(m for m in {heavy_modules} if m in sys.modules))\n"
+    )
+    loaded, _ = _run_python(code)
+    assert loaded == "", f"merge_stats loaded heavy modules: {loaded}"
+
+
+def test_prefetch_batches_keeps_order():
+    def load_sample(index):
+        time.sleep(0.01 * (index % 3))  # finish out of order
+        return {"data": (np.full(2, index),), "index": np.int32(index)}
+
+    batches = list(prefetch_batches(load_sample, range(7), 3, 2, 4))
+    assert [len(batch["index"]) for batch in batches] == [3, 3, 1]
+    indices = np.concatenate([batch["index"] for batch in batches])
+    np.testing.assert_array_equal(indices, np.arange(7))
+    assert batches[0]["data"][0].shape == (3, 2)
+
+
+@pytest.mark.parametrize("queue_size", [0, 2])
+def test_background_writer_flushes_in_order(queue_size):
+    written = []
+
+    def slow_write(index):
+        time.sleep(0.01)
+        written.append(index)
+
+    with BackgroundWriter(queue_size) as writer:
+        for index in range(5):
+            writer.submit(slow_write, index)
+    assert written == list(range(5))
+
+
+def test_background_writer_propagates_errors():
+    def failing_write():
+        raise OSError("disk full")
+
+    writer = BackgroundWriter(queue_size=1)
+    writer.submit(failing_write)
+    with pytest.raises(RuntimeError) as error:
+        writer.close()
+    assert isinstance(error.value.__cause__, OSError)
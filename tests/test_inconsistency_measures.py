@@ -0,0 +1,110 @@
+import os
+import sys
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+sys.path.append(os.getcwd())
+from tests.assets.test_config import key, in_shape
+from source import inconsistency_measures
+
+c1 = 0.01**2
+c2 = 0.03**2
+
+
+def _concrete_dssim(downsampling_factor=5, pairwise=False):
+    return jax.jit(
+        inconsistency_measures._measure_inconsistency_DSSIM(
+            c1=c1,
+            c2=c2,
+            downsampling_factor=downsampling_factor,
+            downsampling_method=jax.image.ResizeMethod.LINEAR,
+            window_size=7,
+            window_sigma=1.5,
+            pairwise=pairwise,
+        ).concretize()
+    )
+
+
+def test_dssim_of_identical_columns():
+    batch_mean = jax.random.uniform(key, shape=(2, 1, *in_shape[1:]))
+    batch_mean = jnp.repeat(batch_mean, 3, axis=1)
+
+    dssim = _concrete_dssim(downsampling_factor=1)(batch_mean)
+    assert dssim.shape == (2,)
+    np.testing.assert_allclose(dssim, 0.0, atol=1e-5)
+
+
+def test_dssim_increases_with_perturbation():
+    key_1, key_2 = jax.random.split(key)
+    batch_mean = jax.random.uniform(key_1, shape=(1, 1, *in_shape[1:]))
+    noise = jax.random.normal(key_2, shape=(1, 1, *in_shape[1:]))
+    batch_mean = jnp.concatenate(
+        [batch_mean, batch_mean + 0.1 * noise, batch_mean + noise], axis=1
+    )
+
+    measure = _concrete_dssim()
+    small = measure(batch_mean[:, :2])
+    large = measure(batch_mean[:, ::2])
+    assert (0.0 < small).all() and (small < large).all()
+
+
+def test_pairwise_ssim_is_symmetric():
+    batch_mean = jax.random.normal(key, shape=(2, 4, 32, 32))
+    window = inconsistency_measures._gaussian_window(7, 1.5)
+
+    ssim = inconsistency_measures._pairwise_ssim(batch_mean, c1, c2, window)
+    assert ssim.shape == (2, 4, 4)
+    np.testing.assert_allclose(ssim, jnp.swapaxes(ssim, 1, 2), rtol=1e-5)
+
+
+def test_cosine_distance_matches_explicit_pairs():
+    # unnormalized maps, different scales per column
+    batch_mean = jax.random.normal(key, shape=(2, 3, 10, 10, 1))
+    batch_mean = batch_mean * jnp.array([1.0, 5.0, 0.1])[None, :, None, None, None]
+    results = inconsistency_measures._measure_inconsistency_cosine_distance(
+        downsampling_factor=1,
+        downsampling_method=jax.image.ResizeMethod.LINEAR,
+        pairwise=True,
+    ).concretize()(batch_mean)
+
+    maps = np.asarray(batch_mean).reshape(2, 3, -1)
+    for b in range(2):
+        distances = np.empty((3, 3))
+        for i in range(3):
+            for j in range(3):
+                cos = maps[b, i] @ maps[b, j]
+                cos /= np.linalg.norm(maps[b, i]) * np.linalg.norm(maps[b, j])
+                distances[i, j] = 1 - cos
+        np.testing.assert_allclose(
+            results["pairwise_inconsistency"][b], distances, atol=1e-5
+        )
+        # the first column against the rest
+        np.testing.assert_allclose(
+            results["inconsistency"][b], distances[0, 1:].mean(), atol=1e-5
+        )
+
+
+def test_pairwise_inconsistency():
+    batch_mean = jax.random.normal(key, shape=(2, 4, *in_shape[1:3], 1))
+    cosine_distance = jax.jit(
+        inconsistency_measures._measure_inconsistency_cosine_distance(
+            downsampling_factor=5,
+            downsampling_method=jax.image.ResizeMethod.LINEAR,
+            pairwise=True,
+        ).concretize()
+    )
+    for measure, data in [
+        (cosine_distance, (batch_mean,)),
+        (_concrete_dssim(1, pairwise=True), (batch_mean,)),
+    ]:
+        results = measure(*data)
+        assert results["inconsistency"].shape == (2,)
+        pairwise = results["pairwise_inconsistency"]
+        assert pairwise.shape == (2, 4, 4)
+        diagonal = jnp.diagonal(pairwise, axis1=1, axis2=2)
+        np.testing.assert_allclose(diagonal, 0.0, atol=1e-5)
+        # the scalar inconsistency is the first row of the pairwise matrix
+        np.testing.assert_allclose(
+            results["inconsistency"], pairwise[:, 0, 1:].mean(axis=-1), rtol=1e-6
+        )
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.getcwd())
+from source import labels
+
+
+def test_label_table_lookups():
+    table = labels.imagenet_label_table()
+    assert len(table) == 1000
+    assert table[0] == "tench, Tinca tinca"
+    assert table.name(3) == "tiger shark"
+    assert table.index("Tinca tinca") == 0
+    assert table.index(table[999]) == 999
+    with pytest.raises(KeyError):
+        table.index("crane")  # a bird and a machine
+    assert table.search("crane") == [134, 517]
+    assert table.search("SHARK") == [2, 3, 4]
+    assert table.search("white shark") == [2]
+    # parts of words
+    assert table.search("hark") == [2, 3, 4]
+    assert table.search("retriev") == [205, 206, 207, 208, 209]
+    # the directory of the test images
+    assert table.folder_indices(["n01491361"]) == [3]
+
+
+def test_imagenet_labels_dicts():
+    assert labels.IMAGENET_LABELS[1] == "goldfish, Carassius auratus"
+    assert labels.IMAGENET_LABELS_TO_IDX["goldfish, Carassius auratus"] == 1
+    assert len(labels.IMAGENET_LABELS) == 1000
@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import jax
+import numpy as np
+import pytest
+
+sys.path.append(os.getcwd())
+from tests.assets.test_config import key
+from source import model_manager
+
+small_shape = (1, 32, 32, 3)
+
+
+@pytest.mark.parametrize("remat_policy", ["full", "dots"])
+def test_remat_resnet50_matches_gradient(remat_policy):
+    image = jax.random.uniform(key, shape=small_shape)
+    models = [
+        model_manager.architectures_switch["resnet50"]("log_softmax", 1000, policy)
+        for policy in ["none", remat_policy]
+    ]
+    params = [model.init(jax.random.PRNGKey(0), image) for model in models]
+    # rematerialization keeps the parameter tree of the pretrained weights
+    assert jax.tree_util.tree_structure(params[0]) == jax.tree_util.tree_structure(
+        params[1]
+    )
+
+    grads = [
+        jax.grad(lambda x: model.apply(params[0], x, train=False)[0, 3])(image)
+        for model in models
+    ]
+    np.testing.assert_allclose(grads[0], grads[1], atol=1e-6)
+
+
+def test_forwards_share_params(tmp_path):
+    args = argparse.Namespace(
+        output_layer="log_softmax",
+        input_shape=small_shape,
+        num_classes=7,  # not used by other tests of this process
+        remat_policy="none",
+        weights_dir=str(tmp_path),
+    )
+    model_manager.init_forward("tiny_cnn", args)
+    model_manager.init_forward("tiny_cnn", args)
+    assert args.forward[0] is args.forward[1]
+    args.output_layer = "logits"
+    model_manager.init_forward("tiny_cnn", args)
+    image = jax.random.uniform(key, shape=small_shape)
+    np.testing.assert_allclose(
+        jax.nn.log_softmax(args.forward[2](image)), args.forward[0](image), atol=1e-6
+    )
+
+    # a new process maps the weight store written on first use
+    params = model_manager.load_params("tiny_cnn", small_shape, 7)
+    stored = model_manager.load_weight_store(str(tmp_path), "tiny_cnn", 7)
+    assert jax.tree_util.tree_structure(params) == jax.tree_util.tree_structure(
+        stored
+    )
+    for expected, result in zip(
+        jax.tree_util.tree_leaves(params), jax.tree_util.tree_leaves(stored)
+    ):
+        np.testing.assert_array_equal(expected, result)
+
+
+def test_weight_store_checksums(tmp_path):
+    weights_dir = str(tmp_path)
+    model_manager.convert_weights("tiny_cnn", small_shape, 5, weights_dir)
+    weights_path, _ = model_manager.weight_store_paths(weights_dir, "tiny_cnn", 5)
+    with open(weights_path, "r+b") as file:
+        file.seek(model_manager.weight_store_alignment)
+        file.write(b"\xff\xff\xff\xff")
+    with pytest.raises(ValueError, match="checksum"):
+        model_manager.load_weight_store(weights_dir, "tiny_cnn", 5)
@@ -1,15 +1,26 @@
+import argparse
 import copy
+from functools import partial
 import os
 import sys
 import jax
 
 import jax.numpy as jnp
 import numpy as np
+import pytest
 
 sys.path.append(os.getcwd())
 from tests.assets.test_config import key, in_shape
-from source import operations
-from source.utils import AbstractFunction
+from tests.assets.tiny_model import init_tiny_cnn_forward
+from source import operations, utils
+from source.explanation_methods.noise_interpolation import NoiseInterpolation
+from source.utils import (
+    AbstractFunction,
+    KeyStreams,
+    Stream,
+    StreamNames,
+    Statistics,
+)
 
 
 def test_static_call():
@@ -95,3 +106,368 @@ def test_linear_combination_mask():
 
     assert linear_combination.shape == in_shape
     np.testing.assert_allclose(linear_combination, expected, rtol=1e-6)
+
+
+def _toy_gather_stats_kwargs(max_batches=20, min_change=0.0):
+    def toy_sampler(batch_keys, image):
+        def _sampler(key, image):
+            grad = image + jax.random.normal(key, shape=image.shape)
+            return {
+                StreamNames.vanilla_grad_mask: grad,
+                StreamNames.results_at_projection: grad.sum(),
+                StreamNames.log_probs: jnp.zeros(shape=(1, 10)),
+            }
+
+        return jax.vmap(_sampler, in_axes=(0, None))(batch_keys, image)
+
+    monitored_statistic_source_key = Stream(
+        StreamNames.vanilla_grad_mask,
+        Statistics.meanx2,
+    )
+    monitored_statistic_key = Stream(
+        StreamNames.vanilla_grad_mask,
+        Statistics.abs_delta,
+    )
+    batch_index_key = Stream(StreamNames.batch_index, Statistics.none)
+    meta_kwargs = {
+        "seed": 0,
+        "batch_size": 4,
+        "max_batches": max_batches,
+        "min_change": min_change,
+        "monitored_statistic_key": monitored_statistic_key,
+        "monitored_statistic_source_key": monitored_statistic_source_key,
+        "batch_index_key": batch_index_key,
+        "pack_streams": True,
+        "key_data": (),
+        "prng_impl": "threefry2x32",
+        "stats": {
+            monitored_statistic_source_key: jnp.zeros(shape=in_shape),
+            Stream(
+                StreamNames.vanilla_grad_mask,
+                Statistics.meanx,
+            ): jnp.zeros(shape=in_shape),
+            monitored_statistic_key: jnp.inf,
+            batch_index_key: 0,
+        },
+    }
+    dynamic_kwargs = {"image": jnp.ones(shape=in_shape)}
+    return toy_sampler, dynamic_kwargs, meta_kwargs
+
+
+def test_gather_stats_timings():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    stats, metadata = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+
+    assert metadata["batch_index"] == meta_kwargs["max_batches"]
+    for phase in ["trace", "compile", "execute"]:
+        assert metadata[f"time_to_{phase}"] >= 0.0
+    assert metadata["time_to_compute"] >= metadata["time_to_execute"]
+    meanx = stats[Stream(StreamNames.vanilla_grad_mask, Statistics.meanx)]
+    np.testing.assert_allclose(meanx.mean(), 1.0, atol=1e-2)
+
+
+def test_stats_carry_layout():
+    stats = {
+        Stream(StreamNames.vanilla_grad_mask, Statistics.meanx): jnp.ones(in_shape),
+        Stream(StreamNames.vanilla_grad_mask, Statistics.meanx2): jnp.zeros(in_shape),
+        Stream(StreamNames.log_probs, Statistics.meanx): jnp.zeros(shape=(1, 10)),
+    }
+    carry = operations.StatsCarry.from_stats(stats, pack=True)
+    assert len(carry.buffers) == 2
+    assert len(operations.StatsCarry.from_stats(stats, pack=False).buffers) == 3
+
+    leaves, treedef = jax.tree_util.tree_flatten(carry)
+    carry = jax.tree_util.tree_unflatten(treedef, leaves)
+    key = Stream(StreamNames.vanilla_grad_mask, Statistics.meanx2)
+    carry = carry.replace({key: 2 * jnp.ones(in_shape)}, batch_index=3)
+    assert carry.batch_index == 3
+    result = carry.to_dict()
+    assert list(result) == list(stats)
+    np.testing.assert_array_equal(result[key], 2.0)
+    np.testing.assert_array_equal(
+        result[Stream(StreamNames.vanilla_grad_mask, Statistics.meanx)], 1.0
+    )
+
+
+def test_gather_stats_packed_streams():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs(max_batches=3)
+    expected, _ = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+    meta_kwargs["pack_streams"] = False
+    stats, metadata = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+    assert metadata["batch_index"] == 3
+    assert stats.keys() == expected.keys()
+    for key in stats:
+        np.testing.assert_allclose(stats[key], expected[key], atol=1e-6)
+
+
+def test_gather_group_stats_matches_separate_runs():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs(
+        max_batches=10, min_change=3.0
+    )
+    images = [scale * dynamic_kwargs["image"] for scale in (0.0, 1.0, 3.0)]
+    group_meta_kwargs = [copy.copy(meta_kwargs) for _ in images]
+    results = operations.gather_group_stats(
+        sampler, {"image": jnp.stack(images)}, group_meta_kwargs
+    )
+    assert len(results) == len(images)
+    for image, (stats, metadata) in zip(images, results):
+        expected, expected_metadata = operations.gather_stats(
+            sampler, {"image": image}, meta_kwargs
+        )
+        assert metadata["group_size"] == len(images)
+        # members stop at different batches, e.g. [3, 3, 7]
+        assert metadata["batch_index"] == expected_metadata["batch_index"]
+        for key in expected:
+            np.testing.assert_allclose(stats[key], expected[key], atol=1e-6)
+
+
+@pytest.mark.parametrize("prng_impl", ["threefry2x32", "rbg", "unsafe_rbg"])
+def test_random_streams_are_independent(prng_impl):
+    num_samples = 4096
+
+    def batch_noise(seed, batch_index, key_stream=KeyStreams.baseline_mask):
+        root_key = operations.task_root_key(seed, (3,), prng_impl)
+        batch_keys = jax.random.split(jax.random.fold_in(root_key, batch_index), 2)
+        return jax.random.normal(
+            operations.stream_key(batch_keys[0], key_stream), (num_samples,)
+        )
+
+    # the streams that collided when keys were PRNGKey(seed + batch_index)
+    streams = jnp.stack(
+        [
+            batch_noise(42, 2),
+            batch_noise(43, 1),
+            batch_noise(42, 1),
+            batch_noise(42, 1, KeyStreams.projection),
+            batch_noise(42, 1, KeyStreams.alpha_mask),
+        ]
+    )
+    correlation = np.corrcoef(streams) - np.eye(len(streams))
+    # 5 standard errors of the sample correlation of independent streams
+    assert np.abs(correlation).max() < 5 / np.sqrt(num_samples)
+    np.testing.assert_allclose(
+        streams.mean(axis=1), 0.0, atol=5 / np.sqrt(num_samples)
+    )
+
+
+def test_key_data_shares_or_decorrelates_noise():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs(max_batches=2)
+    images = jnp.stack([dynamic_kwargs["image"]] * 3)
+    key_data = [(5, 0), (5, 0), (5, 1)]
+    group_meta_kwargs = [{**meta_kwargs, "key_data": data} for data in key_data]
+    results = operations.gather_group_stats(
+        sampler, {"image": images}, group_meta_kwargs
+    )
+    meanx = Stream(StreamNames.vanilla_grad_mask, Statistics.meanx)
+    shared, same_data, decorrelated = [stats[meanx] for stats, _ in results]
+    np.testing.assert_array_equal(shared, same_data)
+    assert not np.allclose(shared, decorrelated)
+
+    sample_key = jax.random.PRNGKey(0)
+    stream_keys = [
+        operations.stream_key(sample_key, stream)
+        for stream in (KeyStreams.baseline_mask, KeyStreams.projection)
+    ]
+    assert not np.array_equal(stream_keys[0], stream_keys[1])
+
+
+def test_alpha_sweep_groups_alpha_values_per_image():
+    args_pattern = {"alpha_mask": "i", "image": "i", "projection": "i"}
+    args_state = {"alpha_mask": "dynamic", "image": "dynamic"}
+    zipped_pattern_value = NoiseInterpolation.sweep_alpha_mask(
+        args_pattern, args_state
+    )
+    assert zipped_pattern_value == "i"
+    mixed_args = {
+        "alpha_mask_value": [0.0, 0.5, 1.0],
+        "image_index": [3, 4],
+        "projection_index": [7, 8],
+    }
+    mixed_pattern = NoiseInterpolation.extract_mixed_pattern(args_pattern, mixed_args)
+    # the zip of the alpha mask values with the images becomes a product
+    zipped_args = NoiseInterpolation.check_alpha_sweep(
+        mixed_pattern, mixed_args, zipped_pattern_value
+    )
+    assert zipped_args == {"image_index": 2, "projection_index": 2}
+    group_pattern_values = NoiseInterpolation.extract_group_pattern_values(
+        mixed_pattern, args_state
+    )
+    assert group_pattern_values == ("alpha_sweep",)
+    combinations = list(
+        utils.pattern_generator(
+            mixed_pattern, mixed_args, innermost=group_pattern_values
+        )
+    )
+    assert [c["image_index"] for c in combinations] == [3, 3, 3, 4, 4, 4]
+    assert [c["alpha_mask_value"] for c in combinations[:3]] == [0.0, 0.5, 1.0]
+    assert NoiseInterpolation.compute_group_sizes(6, 3, 3) == [3, 3]
+
+
+def test_gather_stats_updates_carry_in_place():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs(max_batches=2)
+    meta_kwargs["pack_streams"] = False
+    lowered, loop_initials, _ = operations.lower_gather_stats(
+        sampler, dynamic_kwargs, meta_kwargs
+    )
+    aliased = operations.aliased_parameters(lowered.compile().as_text())
+    assert len(aliased) == len(jax.tree_util.tree_leaves(loop_initials))
+
+    # the shared initial stats of the task are not donated
+    stats, metadata = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+    assert metadata["aliased_carry_buffers"] == len(aliased)
+    assert metadata["carry_bytes"] > 0
+    for value in meta_kwargs["stats"].values():
+        assert not getattr(value, "is_deleted", lambda: False)()
+
+
+def test_gather_stats_reduced_streams():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs(max_batches=5)
+    reduced_shape = (1, in_shape[1] // 4, in_shape[2] // 4, 1)
+    for statistic in (Statistics.meanx, Statistics.meanx2):
+        meta_kwargs["stats"][
+            Stream(StreamNames.vanilla_grad_mask_reduced, statistic)
+        ] = jnp.zeros(shape=reduced_shape)
+    stats, _ = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+
+    # resizing is linear so the reduced moments are the resized moments
+    for statistic in (Statistics.meanx, Statistics.meanx2):
+        full = stats[Stream(StreamNames.vanilla_grad_mask, statistic)]
+        reduced = stats[Stream(StreamNames.vanilla_grad_mask_reduced, statistic)]
+        assert reduced.shape == reduced_shape
+        np.testing.assert_allclose(
+            reduced,
+            operations.resize_mask(source_mask=full, shape=reduced_shape),
+            atol=1e-5,
+        )
+
+
+def test_gather_stats_captures_demo():
+    small_shape = (1, 32, 32, 3)
+    args = argparse.Namespace(
+        num_classes=10, output_layer="log_softmax", input_shape=small_shape
+    )
+    init_tiny_cnn_forward(args)
+    static_kwargs = {
+        "forward": args.forward[-1],
+        "projection": operations.static_projection(num_classes=10, index=0),
+        "baseline_mask": partial(jax.random.normal, shape=small_shape),
+        "normalize_sample": True,
+        "demo": True,
+    }
+    dynamic_kwargs = {
+        "alpha_mask": 0.5 * jnp.ones(shape=(1, 1, 1, 1)),
+        "image": jax.random.uniform(key, shape=small_shape),
+    }
+    sampler = NoiseInterpolation._create_sampler(static_kwargs, (0, None, None))
+    _, _, meta_kwargs = _toy_gather_stats_kwargs(max_batches=3)
+    meta_kwargs["stats"] = {
+        k: jnp.zeros(shape=small_shape) if jnp.ndim(v) == 4 else v
+        for k, v in meta_kwargs["stats"].items()
+    }
+    stats, _ = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+
+    # the demo is the first sample of the first batch
+    root_key = operations.task_root_key(
+        meta_kwargs["seed"], meta_kwargs["key_data"], meta_kwargs["prng_impl"]
+    )
+    first_key = jax.random.split(
+        jax.random.fold_in(root_key, 1), meta_kwargs["batch_size"]
+    )[0]
+    single_sampler = NoiseInterpolation._create_sampler(static_kwargs)
+    expected = single_sampler(first_key, *dynamic_kwargs.values())
+    expected = expected[StreamNames.demo]
+    for key_name in [StreamNames.vanilla_grad_mask, "convex_combination_mask"]:
+        demo_key = Stream(key_name, Statistics.none)
+        assert stats[demo_key].shape == expected[demo_key].shape
+        np.testing.assert_allclose(stats[demo_key], expected[demo_key], atol=1e-5)
+
+    # the demo is taken from the outputs of the loop, the model (its forward
+    # and backward convolutions) appears as often as without the demo
+    def num_convolutions(demo):
+        demo_sampler = NoiseInterpolation._create_sampler(
+            {**static_kwargs, "demo": demo}, (0, None, None)
+        )
+        lowered, _, _ = operations.lower_gather_stats(
+            demo_sampler, dynamic_kwargs, meta_kwargs
+        )
+        return lowered.as_text().count("convolution")
+
+    assert num_convolutions(True) == num_convolutions(False) > 0
+
+
+def test_projection_implementations_agree():
+    num_classes = 10
+    log_prob = jax.random.normal(key, shape=(1, num_classes))
+    indices = jnp.array([2, 7])
+    sparse = operations.static_projection(num_classes=num_classes, index=indices)
+    dense = operations.dense_projection(sparse, num_classes)
+    assert dense.shape == (num_classes, 1)
+
+    expected = log_prob[0, 2] + log_prob[0, 7]
+    for projection in [sparse, dense, indices]:
+        result = operations.project(log_prob, projection)
+        assert result.shape == (1, 1)
+        np.testing.assert_allclose(result.squeeze(), expected, rtol=1e-6)
+
+
+def test_update_per_class_mean():
+    key_1, key_2 = jax.random.split(key)
+    batches = jax.random.normal(key_1, shape=(3, 8, 1, 4, 4, 1))
+    choices = jax.random.randint(key_2, shape=(3, 8), minval=0, maxval=3)
+    mean = jnp.zeros(shape=(3, 4, 4, 1))
+    count = jnp.zeros(shape=(3,))
+    for batch, choice in zip(batches, choices):
+        mean, count = operations.update_per_class_mean(mean, count, batch, choice)
+
+    samples = batches.reshape(-1, 4, 4, 1)
+    choices = choices.reshape(-1)
+    for k in range(3):
+        assert count[k] == (choices == k).sum()
+        np.testing.assert_allclose(
+            mean[k], samples[choices == k].mean(axis=0), atol=1e-5
+        )
+
+
+def test_categorical_projection_in_loop():
+    small_shape = (1, 32, 32, 3)
+    args = argparse.Namespace(
+        num_classes=10, output_layer="log_softmax", input_shape=small_shape
+    )
+    init_tiny_cnn_forward(args)
+    image = jax.random.uniform(key, shape=small_shape)
+    classes, projection = operations.topk_categorical_random_projection(
+        forward=args.forward[-1], image=image, k=3
+    )
+    assert len(classes) == 3
+    static_kwargs = {
+        "forward": args.forward[-1],
+        "projection": projection,
+        "baseline_mask": partial(jax.random.normal, shape=small_shape),
+        "normalize_sample": True,
+        "demo": False,
+    }
+    dynamic_kwargs = {"alpha_mask": jnp.zeros(shape=(1, 1, 1, 1)), "image": image}
+    sampler = NoiseInterpolation._create_sampler(static_kwargs, (0, None, None))
+    _, _, meta_kwargs = _toy_gather_stats_kwargs(max_batches=4)
+    meta_kwargs["stats"] = {
+        k: jnp.zeros(shape=small_shape) if jnp.ndim(v) == 4 else v
+        for k, v in meta_kwargs["stats"].items()
+    }
+    meta_kwargs["stats"][
+        Stream(StreamNames.vanilla_grad_mask, Statistics.meanx_per_class)
+    ] = jnp.zeros(shape=(3, *small_shape[1:]))
+    meta_kwargs["stats"][
+        Stream(StreamNames.vanilla_grad_mask, Statistics.count_per_class)
+    ] = jnp.zeros(shape=(3,))
+    stats, _ = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+
+    count = stats[Stream(StreamNames.vanilla_grad_mask, Statistics.count_per_class)]
+    assert count.sum() == 4 * meta_kwargs["batch_size"]
+    per_class = stats[Stream(StreamNames.vanilla_grad_mask, Statistics.meanx_per_class)]
+    meanx = stats[Stream(StreamNames.vanilla_grad_mask, Statistics.meanx)]
+    # the unconditional mean is the count weighted conditional mean
+    np.testing.assert_allclose(
+        (per_class * count[:, None, None, None]).sum(axis=0) / count.sum(),
+        meanx[0],
+        atol=1e-5,
+    )
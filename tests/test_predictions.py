@@ -0,0 +1,88 @@
+import os
+import sys
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+sys.path.append(os.getcwd())
+from tests.assets.test_config import key
+from source import operations, predictions
+
+
+def _toy_forward(images):
+    return jax.nn.log_softmax(images.reshape(images.shape[0], -1), axis=-1)
+
+
+def test_predict_top_k_matches_single_images():
+    images = np.asarray(jax.random.normal(key, shape=(7, 2, 2, 3)))
+    top_k_classes, top_k_values = predictions.predict_top_k(
+        _toy_forward,
+        lambda index: images[index],
+        num_images=7,
+        top_k=3,
+        batch_size=3,  # the last batch is padded
+        prefetch_factor=2,
+        num_workers=2,
+    )
+    for index, image in enumerate(images):
+        log_probs = _toy_forward(image[None])
+        expected = jnp.argsort(-log_probs.squeeze())[:3]
+        np.testing.assert_array_equal(top_k_classes[index], expected)
+        np.testing.assert_allclose(
+            top_k_values[index], log_probs[0, expected], rtol=1e-6
+        )
+
+    labels = top_k_classes[:, 1].copy()
+    labels[0] = -1
+    result = predictions.accuracy(top_k_classes, labels)
+    assert result == {"top_1_accuracy": 0.0, "top_3_accuracy": 6 / 7}
+
+
+def test_projection_from_top_k_matches_forward():
+    image = jax.random.normal(key, shape=(1, 2, 2, 3))
+    top_k_classes = [int(c) for c in jnp.argsort(-_toy_forward(image).squeeze())[:2]]
+    for distribution, topk_projection in [
+        ("uniform", operations.topk_uniform_projection),
+        ("delta", operations.topk_static_projection),
+    ]:
+        expected_index, expected = topk_projection(
+            forward=_toy_forward, image=image, k=2
+        )
+        index, projection = operations.projection_from_top_k(
+            distribution=distribution, top_k_classes=top_k_classes, num_classes=12
+        )
+        assert index == expected_index
+        np.testing.assert_array_equal(projection.indices, expected.indices)
+
+
+def test_categorical_projection_from_a_written_table(tmp_path):
+    images = np.asarray(jax.random.normal(key, shape=(5, 2, 2, 3)))
+    top_k_classes, top_k_values = predictions.predict_top_k(
+        _toy_forward,
+        lambda index: images[index],
+        num_images=5,
+        top_k=3,
+        batch_size=2,
+        prefetch_factor=2,
+        num_workers=2,
+    )
+    table_path, _ = predictions.predictions_paths(tmp_path, "toy", "log_softmax")
+    np.savez(table_path, top_k_classes=top_k_classes, top_k_values=top_k_values)
+
+    for image_index, image in enumerate(images):
+        looked_up = predictions.lookup_top_k(
+            tmp_path, "toy", "log_softmax", image_index, 2
+        )
+        index, projection = operations.projection_from_top_k(
+            distribution="categorical", top_k_classes=looked_up, num_classes=12
+        )
+        expected_index, expected = operations.topk_categorical_random_projection(
+            forward=_toy_forward, image=image[None], k=2
+        )
+        assert index == expected_index
+        np.testing.assert_array_equal(
+            projection.indices, top_k_classes[image_index, :2]
+        )
+        np.testing.assert_array_equal(projection.indices, expected.indices)
+        np.testing.assert_array_equal(projection.probs, expected.probs)
@@ -0,0 +1,76 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.getcwd())
+from source import storage
+from source.driver_helpers import save_gather_stats_data
+from source.utils import Stream, StreamNames, Statistics
+
+
+def _saliency_map(shape=(32, 32, 3)):
+    x = np.random.default_rng(0).normal(size=shape)
+    return np.cumsum(np.cumsum(x, axis=0), axis=1).astype(np.float32)
+
+
+@pytest.mark.parametrize("compressor", ["zlib", "zstd"])
+def test_lossless_round_trip(tmp_path, compressor):
+    if compressor == "zstd":
+        pytest.importorskip("zstandard")
+    x = _saliency_map()
+    path, error = storage.save_array(
+        os.path.join(tmp_path, "x"), x, storage.StorageCodecs.lossless, compressor
+    )
+    assert path.endswith(storage.compressed_extension)
+    assert error == 0.0
+    y = storage.load_array(path)
+    assert y.dtype == x.dtype
+    np.testing.assert_array_equal(x, y)
+    assert storage.load_shape(path) == x.shape
+
+
+@pytest.mark.parametrize("codec", ["float16", "int8"])
+def test_lossy_error_bounds(tmp_path, codec):
+    x = _saliency_map()
+    path, error = storage.save_array(os.path.join(tmp_path, "x"), x, codec)
+    y = storage.load_array(path)
+    assert y.dtype == np.float32 and y.shape == x.shape
+    np.testing.assert_allclose(np.abs(y - x).max(), error, rtol=1e-6)
+    if codec == "int8":
+        step = (x.max() - x.min()) / 254
+        assert error <= step / 2 + 1e-6
+    assert os.path.getsize(path) < x.nbytes
+
+
+@pytest.mark.parametrize("sign", [1.0, -1.0])
+def test_int8_uses_the_range_of_the_map(tmp_path, sign):
+    # all positive (e.g. meanx2) or all negative maps
+    x = sign * (np.abs(_saliency_map()) + 10.0)
+    path, error = storage.save_array(os.path.join(tmp_path, "x"), x, "int8")
+    step = (x.max() - x.min()) / 254
+    assert error <= step / 2 + 1e-6
+    np.testing.assert_allclose(storage.load_array(path), x, atol=step / 2 + 1e-5)
+
+    for x in [np.full((4, 4), 3.5, dtype=np.float32), np.zeros((0, 4), np.float32)]:
+        path, error = storage.save_array(os.path.join(tmp_path, "y"), x, "int8")
+        assert error == 0.0
+        np.testing.assert_array_equal(storage.load_array(path), x)
+
+
+def test_save_gather_stats_data_codec(tmp_path):
+    x = _saliency_map()
+    stats = {
+        Stream(StreamNames.vanilla_grad_mask, Statistics.meanx): x[None],
+        Stream(StreamNames.log_probs, Statistics.meanx): np.zeros((1, 10)),
+    }
+    metadata = save_gather_stats_data(tmp_path, None, stats, "int8")
+    metadata = pd.DataFrame(metadata)
+
+    assert metadata["storage_codec"].tolist() == ["int8", "npy"]
+    assert metadata["data_path"].iloc[1].endswith(".npy")
+    loaded = metadata["data_path"].apply(storage.load_array)
+    assert loaded.iloc[0].shape == x.shape
+    assert np.abs(loaded.iloc[0] - x).max() <= metadata["max_abs_error"].iloc[0]
+    assert loaded.iloc[1].shape == (10,)
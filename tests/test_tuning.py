@@ -0,0 +1,144 @@
+import os
+import sys
+
+import jax.numpy as jnp
+
+sys.path.append(os.getcwd())
+from tests.test_operations import _toy_gather_stats_kwargs
+from source import tuning
+
+
+def _linear_peak_bytes(sampler, dynamic_kwargs, group_meta_kwargs):
+    # every sample of every member of the group takes 1/8 GiB
+    num_samples = sum(meta_kwargs["batch_size"] for meta_kwargs in group_meta_kwargs)
+    return num_samples * tuning.gibibyte // 8
+
+
+def test_fit_batch_size_to_memory_budget():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    batch_size = tuning.fit_batch_size(
+        sampler,
+        dynamic_kwargs,
+        [meta_kwargs],
+        memory_budget=2.5,
+        max_batch_size=1024,
+        peak_bytes=_linear_peak_bytes,
+    )
+    assert batch_size == 16
+    batch_size = tuning.fit_batch_size(
+        sampler,
+        dynamic_kwargs,
+        [meta_kwargs],
+        memory_budget=2.5,
+        max_batch_size=8,
+        peak_bytes=_linear_peak_bytes,
+    )
+    assert batch_size == 8
+
+
+def test_fit_batch_size_of_a_group_to_memory_budget():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    group_meta_kwargs = [meta_kwargs] * 4
+    group_dynamic_kwargs = {
+        k: jnp.stack([v] * len(group_meta_kwargs)) for k, v in dynamic_kwargs.items()
+    }
+    batch_size = tuning.fit_batch_size(
+        sampler,
+        group_dynamic_kwargs,
+        group_meta_kwargs,
+        memory_budget=2.5,
+        max_batch_size=1024,
+        peak_bytes=_linear_peak_bytes,
+    )
+    # the members share the budget, a single member would fit 16
+    assert batch_size == 4
+    group_peak_bytes = _linear_peak_bytes(
+        sampler,
+        group_dynamic_kwargs,
+        tuning.with_group_batch_size(group_meta_kwargs, batch_size),
+    )
+    assert group_peak_bytes <= 2.5 * tuning.gibibyte
+
+
+def test_compiled_peak_bytes_of_a_group():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    group_dynamic_kwargs = {k: jnp.stack([v] * 3) for k, v in dynamic_kwargs.items()}
+    meta_kwargs.update(
+        architecture="tiny_cnn", input_shape=[1, 8, 8, 3], output_layer="logits"
+    )
+    # the vmapped loop of the group is compiled (0 on backends without a
+    # memory analysis)
+    peak_bytes = tuning.compiled_peak_bytes(
+        sampler, group_dynamic_kwargs, [meta_kwargs] * 3
+    )
+    assert peak_bytes >= 0
+    assert tuning.tuning_cache_key([meta_kwargs] * 3) != tuning.tuning_cache_key(
+        [meta_kwargs]
+    )
+
+
+def test_with_batch_size_preserves_samples():
+    _, _, meta_kwargs = _toy_gather_stats_kwargs(max_batches=10)
+    tuned = tuning.with_batch_size(meta_kwargs, 3)
+    assert tuned["batch_size"] == 3
+    assert tuned["max_batches"] * 3 >= 10 * meta_kwargs["batch_size"]
+    assert meta_kwargs["max_batches"] == 10
+
+
+def test_cached_tune_batch_size(tmp_path):
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    meta_kwargs.update(
+        architecture="tiny_cnn", input_shape=[1, 8, 8, 3], output_layer="logits"
+    )
+    measured = []
+
+    def measure(sampler, dynamic_kwargs, group_meta_kwargs, calibration_batches):
+        batch_size = group_meta_kwargs[0]["batch_size"]
+        measured.append(batch_size)
+        # throughput saturates at 8
+        return min(batch_size, 8) * 100 - batch_size, batch_size * 10
+
+    cache_path = str(tmp_path / "cache.json")
+    for _ in range(2):
+        batch_size = tuning.cached_tune_batch_size(
+            sampler,
+            dynamic_kwargs,
+            [meta_kwargs],
+            cache_path,
+            max_batch_size=64,
+            calibration_batches=2,
+            measure=measure,
+        )
+        assert batch_size == 8
+    assert measured == [1, 2, 4, 8, 16]
+
+    # settings that change the compiled peak are tuned again
+    for settings in [
+        {"memory_budget": 100},
+        {"remat_policy": "full"},
+    ]:
+        measured.clear()
+        tuning.cached_tune_batch_size(
+            sampler,
+            dynamic_kwargs,
+            [meta_kwargs],
+            cache_path,
+            max_batch_size=64,
+            calibration_batches=2,
+            measure=measure,
+            **settings,
+        )
+        assert measured == [1, 2, 4, 8, 16]
+    meta_kwargs["output_layer"] = "log_softmax"
+    key = tuning.tuning_cache_key([meta_kwargs])
+    meta_kwargs["stats"] = dict(list(meta_kwargs["stats"].items())[1:])
+    assert tuning.tuning_cache_key([meta_kwargs]) != key
+
+
+def test_measure_throughput():
+    sampler, dynamic_kwargs, meta_kwargs = _toy_gather_stats_kwargs()
+    samples_per_second, peak_bytes = tuning.measure_throughput(
+        sampler, dynamic_kwargs, [tuning.with_batch_size(meta_kwargs, 2)], 3
+    )
+    assert samples_per_second > 0
+    assert peak_bytes >= 0
@@ -1,15 +1,449 @@
+"""
+benchmark suite for the hot paths of gather_stats and compute_inconsistency.
+a small randomly initialized CNN replaces the pretrained ResNet50 so that the
+suite runs offline on CPU. results are written as json and can be compared
+against a stored baseline e.g.
+    python tests/tests_performance.py --output bench.json
+    python tests/tests_performance.py --baseline bench.json --tolerance 0.2
+"""
 import argparse
+from functools import partial
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    "--input_shape",
-    nargs=4,
-    type=int,
-    default=(1, 3, 224, 224),
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.getcwd())
+from source import driver_helpers, operations, project_manager
+from source.explanation_methods.noise_interpolation import NoiseInterpolation
+from source.inconsistency_measures import (
+    _measure_inconsistency_cosine_distance,
+    _measure_inconsistency_DSSIM,
 )
+from source.utils import InconsistencyMeasures, Stream, StreamNames, Statistics
+from tests.assets.tiny_model import init_tiny_cnn_forward
+
+logger = logging.getLogger(__name__)
+
+benchmarks = {}
+
+
+def benchmark(unit, higher_is_better):
+    def register(func):
+        benchmarks[func.__name__] = (func, unit, higher_is_better)
+        return func
+
+    return register
+
+
+def median_time(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def make_gather_stats_kwargs(args):
+    init_tiny_cnn_forward(args)
+    key = jax.random.PRNGKey(args.seed)
+    static_kwargs = {
+        "forward": args.forward[-1],
+        "projection": operations.static_projection(
+            num_classes=args.num_classes,
+            index=0,
+        ),
+        "baseline_mask": partial(jax.random.normal, shape=args.input_shape),
+        "normalize_sample": True,
+        "demo": False,
+    }
+    dynamic_kwargs = {
+        "alpha_mask": 0.5 * jnp.ones(shape=(1, 1, 1, 1)),
+        "image": jax.random.uniform(key, shape=args.input_shape),
+    }
+    monitored_statistic_source_key = Stream(
+        StreamNames.vanilla_grad_mask,
+        Statistics.meanx2,
+    )
+    monitored_statistic_key = Stream(
+        StreamNames.vanilla_grad_mask,
+        Statistics.abs_delta,
+    )
+    batch_index_key = Stream(StreamNames.batch_index, Statistics.none)
+    meta_kwargs = {
+        "seed": args.seed,
+        "batch_size": args.batch_size,
+        "max_batches": args.max_batches,
+        "min_change": 0.0,  # always run max_batches
+        "monitored_statistic_key": monitored_statistic_key,
+        "monitored_statistic_source_key": monitored_statistic_source_key,
+        "batch_index_key": batch_index_key,
+        "pack_streams": args.pack_streams,
+        "key_data": (),
+        "prng_impl": args.prng_impl,
+        "stats": {
+            monitored_statistic_source_key: jnp.zeros(shape=args.input_shape),
+            Stream(
+                StreamNames.vanilla_grad_mask,
+                Statistics.meanx,
+            ): jnp.zeros(shape=args.input_shape),
+            Stream(
+                StreamNames.results_at_projection,
+                Statistics.meanx,
+            ): jnp.zeros(shape=()),
+            Stream(
+                StreamNames.log_probs,
+                Statistics.meanx,
+            ): jnp.zeros(shape=(1, args.num_classes)),
+            monitored_statistic_key: jnp.inf,
+            batch_index_key: 0,
+        },
+    }
+    sampler = NoiseInterpolation._create_sampler(
+        static_kwargs,
+        (0,) + tuple(None for _ in dynamic_kwargs),
+    )
+    return sampler, dynamic_kwargs, meta_kwargs
+
+
+def make_inconsistency_batch(args):
+    key_1, key_2 = jax.random.split(jax.random.PRNGKey(args.seed))
+    shape = (args.batch_size, args.num_alphas, *args.input_shape[1:])
+    batch_meanx = jax.random.normal(key_1, shape=shape)
+    batch_meanx2 = batch_meanx**2 + jax.random.uniform(key_2, shape=shape)
+    return batch_meanx, batch_meanx2
+
+
+def make_stats(args):
+    key = jax.random.PRNGKey(args.seed)
+    return {
+        Stream(StreamNames.vanilla_grad_mask, statistic): jax.random.normal(
+            jax.random.fold_in(key, i), shape=args.input_shape
+        )
+        for i, statistic in enumerate([Statistics.meanx, Statistics.meanx2])
+    }
+
+
+def write_fake_experiment(save_raw_data_dir, save_metadata_dir, args):
+    stats = make_stats(args)
+    for image_index in range(args.num_images):
+        for alpha_mask_value in np.linspace(0, 1, args.num_alphas):
+            metadata = driver_helpers.save_gather_stats_data(
+                save_raw_data_dir,
+                None,
+                stats,
+            )
+            metadata["image_index"] = image_index
+            metadata["projection_index"] = 0
+            metadata["alpha_mask_value"] = alpha_mask_value
+            metadata["input_shape"] = str(args.input_shape)
+            pd.DataFrame(metadata).to_csv(
+                os.path.join(save_metadata_dir, f"{metadata['path_prefix']}.csv"),
+                index=False,
+            )
+
+
+@benchmark(unit="samples/s", higher_is_better=True)
+def gather_stats_throughput(args):
+    sampler, dynamic_kwargs, meta_kwargs = make_gather_stats_kwargs(args)
+    execution_times = []
+    for _ in range(args.repeats):
+        _, metadata = operations.gather_stats(sampler, dynamic_kwargs, meta_kwargs)
+        execution_times.append(metadata["time_to_execute"])
+    num_samples = args.max_batches * args.batch_size
+    return num_samples / float(np.median(execution_times))
+
+
+@benchmark(unit="s", higher_is_better=False)
+def sampler_compile_time(args):
+    sampler, dynamic_kwargs, meta_kwargs = make_gather_stats_kwargs(args)
+    batch_keys = jax.random.split(jax.random.PRNGKey(args.seed), args.batch_size)
+
+    def compile_sampler():
+        jax.jit(sampler).lower(batch_keys, *dynamic_kwargs.values()).compile()
+
+    return median_time(compile_sampler, args.repeats)
+
+
+@benchmark(unit="samples/s", higher_is_better=True)
+def noise_generation_throughput(args):
+    root_key = operations.task_root_key(args.seed, (), args.prng_impl)
+
+    @jax.jit
+    def generate(batch_index):
+        batch_keys = jax.random.split(
+            jax.random.fold_in(root_key, batch_index), args.batch_size
+        )
+        return jax.vmap(partial(jax.random.normal, shape=args.input_shape))(batch_keys)
+
+    jax.block_until_ready(generate(0))  # warm up
+
+    def run_generate():
+        for batch_index in range(1, args.num_iterations + 1):
+            noise = generate(batch_index)
+        jax.block_until_ready(noise)
+
+    num_samples = args.num_iterations * args.batch_size
+    return num_samples / median_time(run_generate, args.repeats)
+
+
+@benchmark(unit="ms/batch", higher_is_better=False)
+def update_stats_overhead(args):
+    _, _, meta_kwargs = make_gather_stats_kwargs(args)
+    stats = meta_kwargs["stats"].copy()
+    del stats[meta_kwargs["monitored_statistic_key"]]
+    del stats[meta_kwargs["batch_index_key"]]
+    static_keys = tuple(
+        key
+        for key in stats
+        if key.statistic in (Statistics.meanx, Statistics.meanx2)
+    )
+    stats = operations.StatsCarry.from_stats(stats, pack=args.pack_streams)
+    update_stats = operations.update_stats(
+        stream_static_keys=static_keys,
+        monitored_statistic_source_key=meta_kwargs["monitored_statistic_source_key"],
+    ).concretize()
+    update_stats = jax.jit(update_stats)
+    key = jax.random.PRNGKey(args.seed)
+    sampled_batch = {
+        StreamNames.vanilla_grad_mask: jax.random.normal(
+            key, shape=(args.batch_size, *args.input_shape)
+        ),
+        StreamNames.results_at_projection: jnp.zeros(shape=(args.batch_size,)),
+        StreamNames.log_probs: jnp.zeros(shape=(args.batch_size, 1, args.num_classes)),
+    }
+    # a strongly typed batch_index keeps the carry types of the input and the
+    # output equal, otherwise the timed loop recompiles on the second update
+    jax.block_until_ready(update_stats(sampled_batch, stats, jnp.int32(1)))  # warm up
+
+    def run_updates():
+        temp_stats = stats
+        for batch_index in range(1, args.num_iterations + 1):
+            temp_stats = update_stats(
+                sampled_batch, temp_stats, jnp.int32(batch_index)
+            )
+        jax.block_until_ready(temp_stats)
+
+    return 1e3 * median_time(run_updates, args.repeats) / args.num_iterations
+
+
+def _inconsistency_throughput(measure, data, args):
+    measure = jax.jit(measure.concretize())
+    jax.block_until_ready(measure(*data))  # warm up
+
+    def run_measure():
+        for _ in range(args.num_iterations):
+            result = measure(*data)
+        jax.block_until_ready(result)
+
+    return args.num_iterations * args.batch_size / median_time(run_measure, args.repeats)
+
+
+@benchmark(unit="images/s", higher_is_better=True)
+def cosine_distance_throughput(args):
+    batch_meanx, _ = make_inconsistency_batch(args)
+    measure = _measure_inconsistency_cosine_distance(
+        downsampling_factor=args.downsampling_factor,
+        downsampling_method=jax.image.ResizeMethod.LINEAR,
+        pairwise=False,
+    )
+    return _inconsistency_throughput(measure, (batch_meanx,), args)
+
+
+@benchmark(unit="images/s", higher_is_better=True)
+def dssim_throughput(args):
+    batch_meanx, _ = make_inconsistency_batch(args)
+    measure = _measure_inconsistency_DSSIM(
+        downsampling_factor=args.downsampling_factor,
+        downsampling_method=jax.image.ResizeMethod.LINEAR,
+        c1=0.01**2,
+        c2=0.03**2,
+        window_size=7,
+        window_sigma=1.5,
+        pairwise=False,
+    )
+    return _inconsistency_throughput(measure, (batch_meanx,), args)
+
+
+@benchmark(unit="MB/s", higher_is_better=True)
+def make_loader_io_rate(args):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        write_fake_experiment(temp_dir, temp_dir, args)
+        project_manager.merge_experiment_metadata(temp_dir)
+
+        def load_all():
+            loader, _, _ = driver_helpers._make_loader(
+                temp_dir,
+                ["image_index", "projection_index"],
+                args.batch_size,
+                InconsistencyMeasures.dssim,
+                "alpha_mask_value",
+                prefetch_factor=4,
+            )
+            for _ in loader:
+                pass
+
+        total_time = median_time(load_all, args.repeats)
+    finally:
+        shutil.rmtree(temp_dir)
+    num_bytes = args.num_images * args.num_alphas * np.prod(args.input_shape) * 4
+    return num_bytes / 2**20 / total_time
+
+
+@benchmark(unit="MB/s", higher_is_better=True)
+def save_gather_stats_data_write_rate(args):
+    stats = make_stats(args)
+    temp_dir = tempfile.mkdtemp()
+    try:
+
+        def save_all():
+            for _ in range(args.num_iterations):
+                driver_helpers.save_gather_stats_data(temp_dir, None, stats)
+
+        total_time = median_time(save_all, args.repeats)
+    finally:
+        shutil.rmtree(temp_dir)
+    num_bytes = args.num_iterations * sum(v.size * 4 for v in stats.values())
+    return num_bytes / 2**20 / total_time
+
+
+@benchmark(unit="ms/file", higher_is_better=False)
+def merge_experiment_metadata_scaling(args):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        row = pd.DataFrame(
+            {
+                "data_path": ["a.npy", "b.npy"],
+                "stream_name": ["vanilla_grad_mask"] * 2,
+                "stream_statistic": ["meanx", "meanx2"],
+                "image_index": [0, 0],
+                "alpha_mask_value": [0.0, 0.0],
+            }
+        )
+        for i in range(args.num_metadata_files):
+            row.to_csv(os.path.join(temp_dir, f"{i}.csv"), index=False)
+
+        def merge():
+            project_manager.merge_experiment_metadata(temp_dir)
+            os.remove(os.path.join(temp_dir, "merged_metadata.csv"))
+
+        total_time = median_time(merge, args.repeats)
+    finally:
+        shutil.rmtree(temp_dir)
+    return 1e3 * total_time / args.num_metadata_files
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if result["value"] is None:
+            regressions.append(name)
+            continue
+        if name not in baseline or baseline[name]["value"] is None:
+            logger.warning(f"{name} is not in the baseline, skipped comparison.")
+            continue
+        ratio = result["value"] / baseline[name]["value"]
+        if not result["higher_is_better"]:
+            ratio = 1 / ratio
+        # ratio > 1 means faster than the baseline
+        result["baseline_value"] = baseline[name]["value"]
+        result["speedup"] = ratio
+        logger.info(f"{name}: {ratio:.3f}x the baseline")
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--benchmarks",
+        nargs="+",
+        type=str,
+        default=list(benchmarks),
+        choices=list(benchmarks),
+    )
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num_iterations", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_batches", type=int, default=8)
+    parser.add_argument("--num_classes", type=int, default=1000)
+    parser.add_argument("--output_layer", type=str, default="log_softmax")
+    parser.add_argument("--input_shape", nargs=4, type=int, default=(1, 224, 224, 3))
+    parser.add_argument("--downsampling_factor", type=int, default=5)
+    parser.add_argument("--num_alphas", type=int, default=7)
+    parser.add_argument("--num_images", type=int, default=4)
+    parser.add_argument("--num_metadata_files", type=int, default=500)
+    parser.add_argument(
+        "--pack_streams", action=argparse.BooleanOptionalAction, default=True
+    )
+    parser.add_argument("--prng_impl", type=str, default="threefry2x32")
+    args = parser.parse_args()
+    args.input_shape = tuple(args.input_shape)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    args = parse_args()
+
+    results = {}
+    for name in args.benchmarks:
+        func, unit, higher_is_better = benchmarks[name]
+        logger.info(f"running {name}")
+        results[name] = {
+            "value": None,
+            "unit": unit,
+            "higher_is_better": higher_is_better,
+        }
+        try:
+            results[name]["value"] = func(args)
+        except Exception as e:
+            # a broken hot path is reported but does not hide the others
+            logger.exception(f"{name} failed")
+            results[name]["error"] = repr(e)
+            continue
+        logger.info(f"{name}: {results[name]['value']:.4f} {unit}")
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+
+    report = {
+        "platform": platform.platform(),
+        "device_kind": jax.devices()[0].device_kind,
+        "jax_version": jax.__version__,
+        "config": {k: v for k, v in vars(args).items() if k != "forward"},
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"saved the benchmark results to {args.output}")
+    else:
+        print(json.dumps(report, indent=2))
 
-args = parser.parse_args()
-args.input_shape = tuple(args.input_shape)
-print(args.input_shape)
-print("type(args.input_shape)", type(args.input_shape))
-print("args.input_shape[0]", args.input_shape[0])
+    failures = [k for k, v in results.items() if v["value"] is None]
+    if regressions or failures:
+        logger.error(
+            f"regressions against the baseline: {regressions}, failures: {failures}"
+        )
+        sys.exit(1)